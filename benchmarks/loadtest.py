@@ -0,0 +1,489 @@
+"""
+End-to-end load test for the bot.
+
+Two stand-ins run in a child process: a fake Ollama server (/api/chat NDJSON at a configurable token rate and
+first-token latency; several of them with --ollama-backends) and a fake Telegram Bot API server that hands out
+synthetic updates through getUpdates and records sendMessage / editMessageText. The bot itself is bot/run.py's main(), started unchanged in this process
+and pointed at both stand-ins (with --webhook the stand-in pushes updates to the bot's webhook server).
+
+For every concurrency level each simulated private chat sends its messages one after another, waiting for the
+complete reply before the next one. End-to-end latency is measured from the moment an update is handed to the
+bot until the final reply text reaches the fake Bot API.
+
+    python benchmarks/loadtest.py --chats 1,10,100,1000 --output loadtest.json
+
+Webhook intake with more concurrent chats than workers and fewer Ollama slots than either (the workers must not
+wait for generations):
+
+    python benchmarks/loadtest.py --webhook --webhook-workers 4 --ollama-concurrency 2 --chats 50
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+BOT_TOKEN = "123456:loadtest"
+END_MARKER = "BENCHEOF"
+FIRST_USER_ID = 100000
+
+# ---------------------------------------------------------------------------
+# Stand-ins (child process)
+# ---------------------------------------------------------------------------
+
+class FakeOllama:
+    """Streams fixed replies from /api/chat the way Ollama does: one JSON object per line, then a done object."""
+
+    def __init__(self, tokens, token_rate, first_token_latency):
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.first_token_latency = first_token_latency
+        self.requests = 0
+        self.loaded = set()
+
+    async def chat(self, request):
+        payload = await request.json()
+        self.requests += 1
+        self.loaded.add(payload.get("model"))
+        if not payload.get("messages"):
+            # Preload request: Ollama only loads the model
+            return web.json_response({"model": payload.get("model"), "done": True, "done_reason": "load"})
+        started = time.monotonic_ns()
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        await asyncio.sleep(self.first_token_latency)
+        interval = 1.0 / self.token_rate if self.token_rate > 0 else 0
+        eval_started = time.monotonic_ns()
+        for index in range(self.tokens):
+            token = "word." if index % 12 == 11 else "word "
+            line = {"model": payload.get("model"), "message": {"role": "assistant", "content": token}, "done": False}
+            await response.write(json.dumps(line).encode() + b"\n")
+            if interval:
+                await asyncio.sleep(interval)
+        now = time.monotonic_ns()
+        done = {
+            "model": payload.get("model"),
+            "message": {"role": "assistant", "content": f" {END_MARKER}"},
+            "done": True,
+            "total_duration": now - started,
+            "eval_count": self.tokens,
+            "eval_duration": now - eval_started,
+            "prompt_eval_count": sum(len(m.get("content") or "") // 4 for m in payload.get("messages", [])),
+        }
+        await response.write(json.dumps(done).encode() + b"\n")
+        await response.write_eof()
+        return response
+
+    async def tags(self, request):
+        return web.json_response({"models": [{"name": "bench", "size": 0, "details": {"families": ["llama"]}}]})
+
+    async def ps(self, request):
+        return web.json_response({"models": [{"name": name, "model": name} for name in sorted(self.loaded)]})
+
+
+class FakeTelegram:
+    """
+    Minimal Bot API: getUpdates long-polls a queue of synthetic updates, the send/edit methods are recorded.
+    The /bench/run endpoint drives one load level and returns the measured latencies.
+    """
+
+    def __init__(self, telegram_latency):
+        self.telegram_latency = telegram_latency
+        self.webhook_url = None  # set by setWebhook; updates are then POSTed instead of served by getUpdates
+        self.webhook_secret = None
+        self._webhook_session = None
+        self.updates = asyncio.Queue()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.calls = {}
+        self.waiting = {}  # chat_id -> future resolved by the reply carrying END_MARKER
+        self.first_reply_at = {}  # chat_id -> time of the first sendMessage after the update
+        self.polling = asyncio.Event()
+
+    def _message(self, chat_id, text):
+        self.next_message_id += 1
+        return {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": {"id": int(BOT_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Bench"},
+            "text": text or "",
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.telegram_latency:
+            await asyncio.sleep(self.telegram_latency)
+
+        if method == "getUpdates":
+            self.polling.set()
+            return web.json_response({"ok": True, "result": await self._get_updates(data)})
+        if method == "setWebhook":
+            self.webhook_url = data["url"]
+            self.webhook_secret = data.get("secret_token")
+            self.polling.set()
+            return web.json_response({"ok": True, "result": True})
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            return web.json_response({"ok": True, "result": True})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": int(BOT_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+            }})
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(data["chat_id"])
+            text = data.get("text", "")
+            if method == "sendMessage":
+                self.first_reply_at.setdefault(chat_id, time.monotonic())
+            if END_MARKER in text:
+                future = self.waiting.pop(chat_id, None)
+                if future is not None and not future.done():
+                    future.set_result(time.monotonic())
+            return web.json_response({"ok": True, "result": self._message(chat_id, text)})
+        return web.json_response({"ok": True, "result": True})
+
+    async def _get_updates(self, data):
+        offset = int(data.get("offset") or 0)
+        timeout = float(data.get("timeout") or 0)
+        updates = []
+        try:
+            update = await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait()
+            updates.append(update)
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while not self.updates.empty() and len(updates) < 100:
+            updates.append(self.updates.get_nowait())
+        return [update for update in updates if update["update_id"] >= offset]
+
+    def _text_update(self, chat_id, text):
+        self.next_update_id += 1
+        self.next_message_id += 1
+        return {
+            "update_id": self.next_update_id,
+            "message": {
+                "message_id": self.next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "User", "last_name": str(chat_id)},
+                "text": text,
+            },
+        }
+
+    async def _deliver(self, update):
+        if self.webhook_url is None:
+            await self.updates.put(update)
+            return
+        if self._webhook_session is None:
+            self._webhook_session = ClientSession()
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret or ""}
+        # Like Telegram, retry deliveries the bot refuses under backpressure
+        while True:
+            async with self._webhook_session.post(self.webhook_url, json=update, headers=headers) as response:
+                if response.status == 200:
+                    return
+            await asyncio.sleep(1)
+
+    async def _chat_session(self, chat_id, messages, reply_timeout, latencies, first_replies, failures):
+        for index in range(messages):
+            future = asyncio.get_running_loop().create_future()
+            self.waiting[chat_id] = future
+            self.first_reply_at.pop(chat_id, None)
+            sent_at = time.monotonic()
+            await self._deliver(self._text_update(chat_id, f"Benchmark message {index} from chat {chat_id}"))
+            try:
+                done_at = await asyncio.wait_for(future, reply_timeout)
+            except asyncio.TimeoutError:
+                failures.append(chat_id)
+                self.waiting.pop(chat_id, None)
+                return
+            latencies.append(done_at - sent_at)
+            if chat_id in self.first_reply_at:
+                first_replies.append(self.first_reply_at[chat_id] - sent_at)
+
+    async def run_level(self, request):
+        params = await request.json()
+        latencies, first_replies, failures = [], [], []
+        calls_before = dict(self.calls)
+        started = time.monotonic()
+        await asyncio.gather(*[
+            self._chat_session(chat_id, params["messages"], params["reply_timeout"], latencies, first_replies, failures)
+            for chat_id in params["chat_ids"]
+        ])
+        calls = {method: count - calls_before.get(method, 0) for method, count in self.calls.items()}
+        return web.json_response({
+            "wall_seconds": time.monotonic() - started,
+            "latencies": latencies,
+            "first_replies": first_replies,
+            "failed_chats": len(failures),
+            "telegram_calls": {method: count for method, count in calls.items() if count},
+        })
+
+    async def ready(self, request):
+        await self.polling.wait()
+        return web.json_response({"ok": True})
+
+
+async def _serve_standins(options, ollama_ports, telegram_port, ready):
+    telegram = FakeTelegram(options["telegram_latency"])
+
+    apps = []
+    for ollama_port in ollama_ports:
+        ollama = FakeOllama(options["tokens"], options["token_rate"], options["first_token_latency"])
+        ollama_app = web.Application()
+        ollama_app.router.add_post("/api/chat", ollama.chat)
+        ollama_app.router.add_get("/api/tags", ollama.tags)
+        ollama_app.router.add_get("/api/ps", ollama.ps)
+        apps.append((ollama_app, ollama_port))
+    telegram_app = web.Application(client_max_size=16 * 1024 * 1024)
+    telegram_app.router.add_post("/bench/run", telegram.run_level)
+    telegram_app.router.add_get("/bench/ready", telegram.ready)
+    telegram_app.router.add_route("*", "/bot{token}/{method}", telegram.handle)
+
+    for app, port in (*apps, (telegram_app, telegram_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+    ready.set()
+    await asyncio.Event().wait()
+
+def standins_process(options, ollama_ports, telegram_port, ready):
+    asyncio.run(_serve_standins(options, ollama_ports, telegram_port, ready))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# ---------------------------------------------------------------------------
+# Bot side (this process)
+# ---------------------------------------------------------------------------
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class LoopLagMonitor:
+    """Measures how late a periodic sleep wakes up, i.e. how long the bot's event loop was blocked."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.monotonic() - started - self.interval))
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+        return self.samples
+
+def _ms(value):
+    return round(value * 1000, 2) if value is not None else None
+
+async def run_benchmark(options, ollama_ports, telegram_port):
+    # run.py reads its configuration from the environment at import time
+    os.environ.update({
+        "TOKEN": BOT_TOKEN,
+        "ADMIN_IDS": "1",
+        "USER_IDS": "1",
+        "OLLAMA_BASE_URL": "127.0.0.1",
+        "OLLAMA_PORT": str(ollama_ports[0]),
+        "OLLAMA_BACKENDS": ",".join(f"127.0.0.1:{port}" for port in ollama_ports),
+        "INITMODEL": "bench",
+        "LOG_LEVEL": options["log_level"],
+        "STREAM_RESPONSES": "1" if options["stream"] else "0",
+        "OLLAMA_MAX_CONCURRENCY": str(options["ollama_concurrency"]),
+        # Otherwise the connection pool, not the bot, caps concurrent generations
+        "OLLAMA_POOL_LIMIT": str(options["ollama_concurrency"]),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+    })
+    if options["webhook"]:
+        webhook_port = free_port()
+        os.environ.update({
+            "BOT_MODE": "webhook",
+            "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}",
+            "WEBHOOK_HOST": "127.0.0.1",
+            "WEBHOOK_PORT": str(webhook_port),
+            "WEBHOOK_WORKERS": str(options["webhook_workers"]),
+        })
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+    import run
+
+    logging.getLogger().setLevel(options["log_level"])
+
+    bot_task = asyncio.create_task(run.main())
+    control_url = f"http://127.0.0.1:{telegram_port}/bench"
+    results = []
+    next_user_id = FIRST_USER_ID
+    monitor = LoopLagMonitor()
+    async with ClientSession() as control:
+        async with control.get(f"{control_url}/ready") as response:
+            await response.read()
+
+        for chats in options["chats"]:
+            chat_ids = list(range(next_user_id, next_user_id + chats))
+            next_user_id += chats
+            for chat_id in chat_ids:
+                await run.db_manager.register_user(chat_id, f"User {chat_id}")
+
+            requests_before = {backend.name: backend.requests for backend in run.ollama_client.backends}
+            flushes_before = run.write_behind.stats["flushes"]
+            rss_before = rss_bytes()
+            active_before = len(run.ACTIVE_CHATS)
+            monitor.start()
+            async with control.post(f"{control_url}/run", json={
+                "chat_ids": chat_ids,
+                "messages": options["messages"],
+                "reply_timeout": options["reply_timeout"],
+            }, timeout=None) as response:
+                level = await response.json()
+            lag = monitor.stop()
+            rss_after = rss_bytes()
+            new_chats = len(run.ACTIVE_CHATS) - active_before
+
+            latencies = level["latencies"]
+            result = {
+                "chats": chats,
+                "messages_per_chat": options["messages"],
+                "replies": len(latencies),
+                "failed_chats": level["failed_chats"],
+                "wall_seconds": round(level["wall_seconds"], 3),
+                "throughput_replies_per_second": round(len(latencies) / level["wall_seconds"], 3) if level["wall_seconds"] else None,
+                "latency_ms": {
+                    "p50": _ms(percentile(latencies, 0.50)),
+                    "p95": _ms(percentile(latencies, 0.95)),
+                    "p99": _ms(percentile(latencies, 0.99)),
+                    "max": _ms(max(latencies) if latencies else None),
+                    "mean": _ms(statistics.fmean(latencies) if latencies else None),
+                },
+                "first_message_ms": {
+                    "p50": _ms(percentile(level["first_replies"], 0.50)),
+                    "p95": _ms(percentile(level["first_replies"], 0.95)),
+                },
+                "loop_lag_ms": {
+                    "p50": _ms(percentile(lag, 0.50)),
+                    "p99": _ms(percentile(lag, 0.99)),
+                    "max": _ms(max(lag) if lag else None),
+                },
+                "rss_mb": round(rss_after / 2**20, 1),
+                "rss_per_chat_kb": round((rss_after - rss_before) / new_chats / 1024, 1) if new_chats > 0 else None,
+                "active_chats": len(run.ACTIVE_CHATS),
+                "telegram_calls": level["telegram_calls"],
+                "db_write_batches": run.write_behind.stats["flushes"] - flushes_before,
+                "ollama_backend_requests": {
+                    backend.name: backend.requests - requests_before[backend.name]
+                    for backend in run.ollama_client.backends
+                },
+            }
+            results.append(result)
+            print(
+                f"chats={chats:>5} replies={result['replies']:>6} failed={result['failed_chats']:>4} "
+                f"rps={result['throughput_replies_per_second']} p50={result['latency_ms']['p50']}ms "
+                f"p95={result['latency_ms']['p95']}ms p99={result['latency_ms']['p99']}ms "
+                f"lag_p99={result['loop_lag_ms']['p99']}ms rss/chat={result['rss_per_chat_kb']}KB",
+                file=sys.stderr,
+            )
+
+    # The same shutdown as on SIGTERM
+    run.shutdown_event.set()
+    await asyncio.gather(bot_task, return_exceptions=True)
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", default="1,10,100,1000", help="comma separated concurrency levels")
+    parser.add_argument("--messages", type=int, default=3, help="messages each chat sends per level")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens in every fake reply")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="fake Ollama tokens per second per request (0 = as fast as possible)")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds added to every Bot API call")
+    parser.add_argument("--ollama-concurrency", type=int, default=1000, help="OLLAMA_MAX_CONCURRENCY and OLLAMA_POOL_LIMIT for the bot")
+    parser.add_argument("--ollama-backends", type=int, default=1, help="fake Ollama servers, all passed in OLLAMA_BACKENDS")
+    parser.add_argument("--reply-timeout", type=float, default=300.0, help="seconds a chat waits for a reply")
+    parser.add_argument("--stream", action="store_true", help="run with STREAM_RESPONSES=1")
+    parser.add_argument("--webhook", action="store_true", help="run with BOT_MODE=webhook instead of long polling")
+    parser.add_argument("--webhook-workers", type=int, default=1000, help="WEBHOOK_WORKERS in webhook mode")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+    return {
+        "chats": [int(value) for value in args.chats.split(",") if value],
+        "messages": args.messages,
+        "tokens": args.tokens,
+        "token_rate": args.token_rate,
+        "first_token_latency": args.first_token_latency,
+        "telegram_latency": args.telegram_latency,
+        "ollama_concurrency": args.ollama_concurrency,
+        "ollama_backends": args.ollama_backends,
+        "reply_timeout": args.reply_timeout,
+        "stream": args.stream,
+        "webhook": args.webhook,
+        "webhook_workers": args.webhook_workers,
+        "log_level": args.log_level,
+        "output": args.output,
+    }
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options["output"]:
+        options["output"] = os.path.abspath(options["output"])
+    ollama_ports, telegram_port = [free_port() for _ in range(max(1, options["ollama_backends"]))], free_port()
+    ready = multiprocessing.Event()
+    standins = multiprocessing.Process(
+        target=standins_process, args=(options, ollama_ports, telegram_port, ready), daemon=True
+    )
+    standins.start()
+    if not ready.wait(30):
+        raise RuntimeError("Stand-in servers did not start")
+
+    workdir = tempfile.mkdtemp(prefix="ollama-telegram-loadtest-")
+    os.chdir(workdir)  # users.db and the image store are created relative to the working directory
+    try:
+        results = asyncio.run(run_benchmark(options, ollama_ports, telegram_port))
+    finally:
+        standins.terminate()
+
+    report = {
+        "benchmark": "loadtest",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "options": {key: value for key, value in options.items() if key != "output"},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if options["output"]:
+        with open(options["output"], "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Microbenchmarks for the Telegram formatting path.
+
+convert_markdown_for_telegram() runs on the event loop for every response, so a slow or super-linear case stalls
+every chat. This harness times Markdown -> HTML conversion and 4096-character pagination separately over a corpus
+of typical and hostile LLM outputs, records allocations with tracemalloc and compares the results to a stored
+baseline.
+
+    python benchmarks/markdown_bench.py                   # compare with benchmarks/markdown_baseline.json
+    python benchmarks/markdown_bench.py --save-baseline   # record a new baseline on this machine
+
+The exit status is 1 when a case regresses by more than --threshold against the baseline or when a single
+conversion takes longer than --max-seconds (the guard against catastrophic backtracking).
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+from func.telegram_markdown import TelegramMarkdownRenderer, paginate_for_telegram
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "markdown_baseline.json")
+
+WORDS = (
+    "the model returns a streamed answer with tokens context prompt value function list result error "
+    "request cache latency python telegram message format table index query worker thread"
+).split()
+
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def _prose(rng, paragraphs):
+    parts = []
+    for _ in range(paragraphs):
+        sentences = []
+        for _ in range(rng.randint(2, 5)):
+            sentence = _sentence(rng, rng.randint(6, 16))
+            roll = rng.random()
+            if roll < 0.2:
+                sentence = sentence.replace(" ", " **", 1).replace(".", "**.", 1)
+            elif roll < 0.3:
+                sentence = f"Use `{rng.choice(WORDS)}()` here: {sentence}"
+            elif roll < 0.35:
+                sentence += " See [the docs](https://example.com/docs?q=a_b*c)."
+            sentences.append(sentence)
+        parts.append(" ".join(sentences))
+    return "\n\n".join(parts)
+
+def _code_block(rng, lines, language="python"):
+    body = []
+    for index in range(lines):
+        indent = "    " * (index % 4)
+        body.append(f"{indent}value_{index} = compute(*args, **kwargs)  # <{rng.choice(WORDS)}> & __init__")
+    return f"```{language}\n" + "\n".join(body) + "\n```"
+
+def _nested_list(rng, items, depth=4):
+    lines = []
+    for index in range(items):
+        level = index % depth
+        marker = "*" if level % 2 == 0 else "-"
+        lines.append(f"{'  ' * level}{marker} **Item {index}**: {_sentence(rng, 8)} _note_")
+    return "\n".join(lines)
+
+def _pad_to(text, size, rng):
+    while len(text) < size:
+        text += "\n\n" + _prose(rng, 3)
+    return text[:size]
+
+def build_corpus(seed=1234):
+    """Named inputs: typical answers, large answers and inputs built to trigger worst-case behaviour."""
+    rng = random.Random(seed)
+    corpus = {
+        "short_answer": _prose(rng, 1),
+        "typical_answer": _prose(rng, 6),
+        "long_code_block": "Here is the implementation:\n\n" + _code_block(rng, 400) + "\n\nDone.",
+        "many_code_blocks": "\n\n".join(_prose(rng, 1) + "\n\n" + _code_block(rng, 15) for _ in range(20)),
+        "nested_lists": "Overview:\n\n" + _nested_list(rng, 400),
+        "think_section": "<think>\n" + _prose(rng, 20) + "\n</think>\n\n" + _prose(rng, 5),
+        "empty_think": "<think>\n\n</think>\n\n" + _prose(rng, 5),
+        "answer_50kb": _pad_to(_prose(rng, 10) + "\n\n" + _code_block(rng, 60) + "\n\n" + _nested_list(rng, 60), 50_000, rng),
+        # Pathological inputs: long runs of unbalanced markers that make backtracking regexes
+        # such as (\*|_)(.*?)\1 rescan the rest of the text from every opening marker
+        "unbalanced_asterisks": "*" + " *a" * 16_000,
+        "unbalanced_underscores": "_x " * 16_000,
+        "unbalanced_mixed_markers": "".join(rng.choice(["*", "_", "**", "__", "~~", "||", "`", " a", " b"]) for _ in range(30_000)),
+        "unclosed_links": "[" * 20_000 + "(" * 5_000,
+        "unterminated_fence": "```python\n" + "x = 1\n" * 8_000,
+        "unclosed_think": "<think>" + _prose(rng, 60),
+        "long_single_word": "a" * 50_000,
+        "html_heavy": "<b>&amp;</b> <i>x</i> < > & " * 3_000,
+    }
+    return corpus
+
+def _time(func, min_time):
+    """Run func until min_time has elapsed, at least 3 times. Returns the per-call times in seconds."""
+    samples = []
+    # Like timeit, keep collector pauses caused by earlier garbage out of the measurement
+    gc_was_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        deadline = time.perf_counter() + min_time
+        while len(samples) < 3 or time.perf_counter() < deadline:
+            started = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - started)
+            if len(samples) >= 1000:
+                break
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return samples
+
+def _calibration_loop():
+    total = 0
+    for index in range(100_000):
+        total += index * index
+    return total
+
+def calibrate(min_time):
+    """Time of a fixed pure-Python loop, used to compare results taken on machines of different speed."""
+    return min(_time(_calibration_loop, min_time))
+
+def _allocations(func):
+    tracemalloc.start()
+    try:
+        func()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    return peak, blocks
+
+def convert(text, is_group=False):
+    renderer = TelegramMarkdownRenderer(is_group)
+    renderer.feed(text)
+    return renderer.render(final=True)
+
+def run_case(name, text, min_time):
+    # Calibrated next to the case itself, so CPU throttling or a noisy neighbour affects both alike
+    calibration = calibrate(min_time / 4)
+    html = convert(text)
+    pages = paginate_for_telegram(html)
+    convert_samples = _time(lambda: convert(text), min_time)
+    paginate_samples = _time(lambda: paginate_for_telegram(html), min_time)
+    convert_peak, convert_blocks = _allocations(lambda: convert(text))
+    paginate_peak, _ = _allocations(lambda: paginate_for_telegram(html))
+    calibration = min(calibration, calibrate(min_time / 4))
+    return {
+        "calibration_us": round(calibration * 1e6, 1),
+        "input_chars": len(text),
+        "html_chars": len(html),
+        "pages": len(pages),
+        "convert_us": {
+            "min": round(min(convert_samples) * 1e6, 1),
+            "median": round(statistics.median(convert_samples) * 1e6, 1),
+            "max": round(max(convert_samples) * 1e6, 1),
+        },
+        "paginate_us": {
+            "min": round(min(paginate_samples) * 1e6, 1),
+            "median": round(statistics.median(paginate_samples) * 1e6, 1),
+        },
+        "convert_peak_kb": round(convert_peak / 1024, 1),
+        "convert_live_blocks": convert_blocks,
+        "paginate_peak_kb": round(paginate_peak / 1024, 1),
+    }
+
+def compare(results, baseline, threshold, max_seconds):
+    """
+    List of human readable regressions.
+    Times are scaled by each case's calibration loop, so a slower or busier machine is not reported as a regression.
+    """
+    problems = []
+    for name, result in results.items():
+        if result["convert_us"]["max"] / 1e6 > max_seconds:
+            problems.append(f"{name}: conversion took {result['convert_us']['max'] / 1e6:.2f}s (limit {max_seconds}s)")
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        speed_ratio = result["calibration_us"] / previous["calibration_us"]
+        for metric in ("convert_us", "paginate_us"):
+            # The fastest run is the least noisy estimate of the code's cost
+            before, after = previous[metric]["min"] * speed_ratio, result[metric]["min"]
+            if before > 0 and after > before * (1 + threshold) and after - before > 50:
+                problems.append(f"{name}: {metric} {before:.0f} -> {after:.0f} (+{(after / before - 1) * 100:.0f}%)")
+        before, after = previous["convert_peak_kb"], result["convert_peak_kb"]
+        if before > 0 and after > before * (1 + threshold) and after - before > 64:
+            problems.append(f"{name}: convert_peak_kb {before:.0f} -> {after:.0f}")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    # Timings on shared machines jitter by tens of percent; the default only flags clear (2x) regressions
+    parser.add_argument("--threshold", type=float, default=1.0, help="allowed slowdown against the baseline (1.0 = 2x)")
+    parser.add_argument("--max-seconds", type=float, default=0.5, help="fail any case whose conversion takes longer")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds spent timing each operation per case")
+    parser.add_argument("--case", action="append", help="only run the named case (repeatable)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    corpus = build_corpus()
+    names = args.case or list(corpus)
+    results = {}
+    for name in names:
+        results[name] = run_case(name, corpus[name], args.min_time)
+        result = results[name]
+        print(
+            f"{name:<26} {result['input_chars']:>7} chars  convert {result['convert_us']['median']:>10.1f}us  "
+            f"paginate {result['paginate_us']['median']:>8.1f}us  pages {result['pages']:>3}  peak {result['convert_peak_kb']:>8.1f}KB",
+            file=sys.stderr,
+        )
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    problems = compare(results, baseline, args.threshold, args.max_seconds)
+
+    report = {
+        "benchmark": "markdown",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "results": results,
+        "regressions": problems,
+    }
+    text = json.dumps(report, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(json.dumps({**report, "regressions": []}, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    for problem in problems:
+        print(f"REGRESSION {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
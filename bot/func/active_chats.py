@@ -1,61 +1,353 @@
 import asyncio
+import contextlib
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from func.context_window import context_token_budget, count_tokens, trim_messages
+from func.metrics import chat_evictions, chat_hydrations
+
+ACTIVE_CHATS_SHARDS = 64
+# Chats unused for this many seconds are dropped from memory; their context stays in the database (0 = never)
+chat_idle_eviction = float(os.getenv("CHAT_IDLE_EVICTION", "1800"))
+# Estimated memory for chat contexts before the least recently used chats are dropped (0 = unlimited)
+active_chats_memory_budget = int(float(os.getenv("ACTIVE_CHATS_MEMORY_MB", "256")) * 2**20)
+
+# Rough per-object sizes for the memory estimate
+CHAT_OVERHEAD_BYTES = 600
+MESSAGE_OVERHEAD_BYTES = 400
+IMAGE_REF_BYTES = 120
+
+def make_message(role, content, images=None):
+    """A chat message in the form Ollama and the database expect. Roles are interned, so every message shares them."""
+    message = {"role": sys.intern(role), "content": content}
+    if images is not None:
+        message["images"] = images
+    return message
+
+def estimate_message_bytes(message):
+    return MESSAGE_OVERHEAD_BYTES + len(message.get("content") or "") + IMAGE_REF_BYTES * len(message.get("images") or [])
+
+class ChatState:
+    """The in-memory context of one chat."""
+    __slots__ = ("model", "messages", "stream", "temperature", "selected_prompt_id", "context_budget", "last_used", "size",
+                 "next_seq")
+    FIELDS = ("model", "messages", "stream", "temperature", "selected_prompt_id", "context_budget")
+
+    def __init__(self, model, messages=None, stream=True, temperature=None, selected_prompt_id=None,
+                 context_budget=context_token_budget):
+        self.model = model
+        self.messages = messages if messages is not None else []
+        self.stream = stream
+        self.temperature = temperature
+        self.selected_prompt_id = selected_prompt_id
+        self.context_budget = context_budget
+        self.last_used = time.monotonic()
+        self.size = 0
+        # Sequence numbers order the stored messages and are never reused, not even after the messages are trimmed
+        self.next_seq = 0
+        for message in self.messages:
+            if "seq" in message:
+                self.next_seq = max(self.next_seq, message["seq"] + 1)
+        for message in self.messages:
+            if "seq" not in message:
+                message["seq"] = self.next_seq
+                self.next_seq += 1
+
+    def add_message(self, role, content, images=None):
+        message = make_message(role, content, images)
+        message["seq"] = self.next_seq
+        self.next_seq += 1
+        self.messages.append(message)
+        return message
+
+    @classmethod
+    def from_dict(cls, data):
+        messages = data.get("messages") or []
+        for message in messages:
+            if isinstance(message.get("role"), str):
+                message["role"] = sys.intern(message["role"])
+        return cls(
+            data.get("model"),
+            messages,
+            data.get("stream", True),
+            data.get("temperature"),
+            data.get("selected_prompt_id"),
+            data.get("context_budget", context_token_budget),
+        )
+
+    def as_dict(self):
+        """Snapshot for callers outside ActiveChats. The message list is copied; the messages themselves are shared."""
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        data["messages"] = list(self.messages)
+        return data
+
+    def estimate_bytes(self):
+        return CHAT_OVERHEAD_BYTES + sum(estimate_message_bytes(message) for message in self.messages)
 
 class ActiveChats:
-    def __init__(self):
-        self._active_chats = {}
-        self._lock = asyncio.Lock()
+    """
+    Chat contexts by chat key. Reads return snapshots, and all changes go through the methods below.
+    The chats are spread over a fixed set of locks, so a busy chat only blocks the chats sharing its shard.
+    Methods that change every chat take all locks, always in shard order; evictions skip chats whose shard is busy.
+
+    Once bound to the database, a chat's context is loaded on its first use and dropped again, least recently
+    used first, when it has been idle for idle_seconds or the estimated memory exceeds memory_budget.
+    Contexts are saved before they are dropped.
+    """
+
+    def __init__(self, shards=ACTIVE_CHATS_SHARDS, idle_seconds=chat_idle_eviction, memory_budget=active_chats_memory_budget):
+        self._active_chats = OrderedDict()  # least recently used first
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+        self._db_manager = None
+        self.idle_seconds = idle_seconds
+        self.memory_budget = memory_budget
+        self.resident_bytes = 0
+        self._evicting = {}  # chat_key -> (ChatState, save task) while an evicted context is being saved
+
+    def bind(self, db_manager):
+        """Load chat contexts from db_manager on demand and save them there when they are evicted."""
+        self._db_manager = db_manager
+
+    def __len__(self):
+        return len(self._active_chats)
+
+    def _lock(self, chat_key):
+        return self._locks[hash(chat_key) % len(self._locks)]
+
+    @contextlib.asynccontextmanager
+    async def _all_locks(self):
+        async with contextlib.AsyncExitStack() as stack:
+            for lock in self._locks:
+                await stack.enter_async_context(lock)
+            yield
+
+    def _add(self, chat_key, chat, held=None):
+        chat.size = chat.estimate_bytes()
+        self._active_chats[chat_key] = chat
+        self.resident_bytes += chat.size
+        self._enforce_budget(held if held is not None else (self._lock(chat_key),))
+
+    def _remove(self, chat_key):
+        chat = self._active_chats.pop(chat_key, None)
+        if chat is not None:
+            self.resident_bytes -= chat.size
+        return chat
+
+    def _resize(self, chat_key, chat):
+        size = chat.estimate_bytes()
+        self.resident_bytes += size - chat.size
+        chat.size = size
+        self._enforce_budget((self._lock(chat_key),))
+
+    def _evictable(self, chat_key, held=()):
+        # Nothing runs in between, so a shard that is free now stays free until the eviction is done
+        lock = self._lock(chat_key)
+        return not lock.locked() or lock in held
+
+    async def _resident(self, chat_key, load=True):
+        """The chat's state, loaded from the database if needed. Call with the chat's shard lock held."""
+        chat = self._active_chats.get(chat_key)
+        if chat is None and load:
+            evicting = self._evicting.get(chat_key)
+            if evicting is not None:
+                # Used again while its eviction is being saved: keep the in-memory state
+                chat = evicting[0]
+            elif self._db_manager is not None:
+                data = await self._db_manager.load_active_chat(chat_key)
+                if data is not None:
+                    chat = ChatState.from_dict(data)
+                    chat_hydrations.inc()
+            if chat is not None:
+                self._add(chat_key, chat)
+        if chat is not None:
+            chat.last_used = time.monotonic()
+            self._active_chats.move_to_end(chat_key)
+        return chat
+
+    def _evict(self, chat_key, reason):
+        chat = self._remove(chat_key)
+        if chat is None:
+            return
+        chat_evictions.inc(reason=reason)
+        task = asyncio.create_task(self._save_evicted(chat_key, chat))
+        self._evicting[chat_key] = (chat, task)
+
+    async def _save_evicted(self, chat_key, chat):
+        try:
+            await self._db_manager.save_active_chat_context(chat_key, chat.as_dict())
+        except Exception as e:
+            logging.error(f"[ActiveChats] Saving evicted chat {chat_key} failed, keeping it in memory: {e}")
+            # Unless pop dropped it meanwhile. No lock here: pop waits for this save holding the shard lock,
+            # and re-adding does not await, so nothing else runs in between
+            if self._is_current_eviction(chat_key) and chat_key not in self._active_chats:
+                self._add(chat_key, chat, held=())
+        finally:
+            # A later eviction of the same chat may have replaced this entry
+            if self._is_current_eviction(chat_key):
+                del self._evicting[chat_key]
+
+    def _is_current_eviction(self, chat_key):
+        return self._evicting.get(chat_key, (None, None))[1] is asyncio.current_task()
+
+    def _enforce_budget(self, held):
+        """Evict least recently used chats until the estimate is within the budget. held: the locks the caller holds."""
+        # Without a database an evicted chat could not be loaded again
+        if self.memory_budget <= 0 or self._db_manager is None or self.resident_bytes <= self.memory_budget:
+            return
+        excess = self.resident_bytes - self.memory_budget
+        # Never evict the most recently used chat, it is the one being worked on
+        most_recent = next(reversed(self._active_chats))
+        victims = []
+        for chat_key, chat in self._active_chats.items():
+            if excess <= 0 or chat_key == most_recent:
+                break
+            if self._evictable(chat_key, held):
+                victims.append(chat_key)
+                excess -= chat.size
+        for chat_key in victims:
+            self._evict(chat_key, "memory")
+
+    async def evict_idle(self):
+        """Drop chats unused for idle_seconds. Returns the number of chats evicted."""
+        if self.idle_seconds <= 0 or self._db_manager is None:
+            return 0
+        cutoff = time.monotonic() - self.idle_seconds
+        victims = []
+        for chat_key, chat in self._active_chats.items():
+            if chat.last_used > cutoff:
+                break
+            # A chat in a busy shard is left for the next run
+            if self._evictable(chat_key):
+                victims.append(chat_key)
+        for chat_key in victims:
+            self._evict(chat_key, "idle")
+        evicted = len(victims)
+        if evicted:
+            logging.info(f"[ActiveChats] Evicted {evicted} idle chats, {len(self._active_chats)} in memory")
+        return evicted
+
+    async def wait_evictions(self):
+        """Wait until every evicted context has been saved (before closing the database)."""
+        tasks = [task for _, task in self._evicting.values()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     async def get(self, chat_key):
-        async with self._lock:
-            return self._active_chats.get(chat_key)
+        async with self._lock(chat_key):
+            chat = await self._resident(chat_key)
+            return chat.as_dict() if chat is not None else None
 
     async def set(self, chat_key, value):
-        async with self._lock:
-            self._active_chats[chat_key] = value
+        async with self._lock(chat_key):
+            self._remove(chat_key)
+            self._add(chat_key, value if isinstance(value, ChatState) else ChatState.from_dict(value))
 
     async def pop(self, chat_key):
-        async with self._lock:
-            return self._active_chats.pop(chat_key, None)
+        async with self._lock(chat_key):
+            chat = self._remove(chat_key)
+            evicting = self._evicting.pop(chat_key, None)
+            if evicting is not None:
+                # Let the pending save finish first, so it cannot bring back a context the caller deletes
+                await asyncio.gather(evicting[1], return_exceptions=True)
+                chat = chat or evicting[0]
+            return chat.as_dict() if chat is not None else None
 
     async def contains(self, chat_key):
-        async with self._lock:
-            return chat_key in self._active_chats
-        
-    async def get_all(self):
-        async with self._lock:
-            return self._active_chats.copy()
-        
-    async def set_all(self, new_chats):
-        async with self._lock:
-            self._active_chats = new_chats
-
-    async def update_message(self, chat_key, role, content):
-         async with self._lock:
-            if chat_key in self._active_chats:
-                self._active_chats[chat_key]["messages"].append({"role": role, "content": content})
+        async with self._lock(chat_key):
+            return await self._resident(chat_key) is not None
+
+    async def get_all(self, include_evicting=False):
+        """
+        Snapshots of the chats in memory. Evicted chats are only in the database, except those whose save is still
+        running, which include_evicting adds.
+        """
+        chats = {}
+        if include_evicting:
+            chats.update((chat_key, chat.as_dict()) for chat_key, (chat, _) in list(self._evicting.items()))
+        chats.update((chat_key, chat.as_dict()) for chat_key, chat in list(self._active_chats.items()))
+        return chats
+
+    async def snapshot(self, chat_keys):
+        """Snapshots of those chats in chat_keys that are in memory. Unlike get, evicted chats are not loaded."""
+        return {
+            chat_key: self._active_chats[chat_key].as_dict()
+            for chat_key in chat_keys if chat_key in self._active_chats
+        }
+
+    async def update_all(self, **fields):
+        """
+        Set the given ChatState fields (e.g. selected_prompt_id) on every chat in memory.
+        Returns the keys of the chats changed, so the caller can have them saved.
+        """
+        # Histories are per chat, only settings can be applied to every chat at once
+        invalid = (set(fields) - set(ChatState.FIELDS)) | (set(fields) & {"messages"})
+        if invalid:
+            raise ValueError(f"Cannot bulk update: {', '.join(sorted(invalid))}")
+        async with self._all_locks():
+            for chat in self._active_chats.values():
+                for name, value in fields.items():
+                    setattr(chat, name, value)
+            return list(self._active_chats)
+
+    async def _update(self, chat_key, name, value):
+        async with self._lock(chat_key):
+            chat = await self._resident(chat_key)
+            if chat is not None:
+                setattr(chat, name, value)
+
+    async def update_message(self, chat_key, role, content, images=None):
+        async with self._lock(chat_key):
+            chat = await self._resident(chat_key)
+            if chat is not None:
+                message = chat.add_message(role, content, images)
+                size = estimate_message_bytes(message)
+                chat.size += size
+                self.resident_bytes += size
+                self._enforce_budget((self._lock(chat_key),))
+
+    async def add_system_prompt(self, chat_key, content):
+        """Add a system message unless the chat already has one."""
+        async with self._lock(chat_key):
+            chat = await self._resident(chat_key)
+            if chat is not None and not any(message.get("role") == "system" for message in chat.messages):
+                chat.add_message("system", content)
+                self._resize(chat_key, chat)
 
     async def update_model(self, chat_key, model_name):
-        async with self._lock:
-            if chat_key in self._active_chats:
-                self._active_chats[chat_key]["model"] = model_name
+        await self._update(chat_key, "model", model_name)
 
     async def update_temperature(self, chat_key, temperature):
-        async with self._lock:
-            if chat_key in self._active_chats:
-                self._active_chats[chat_key]["temperature"] = temperature
+        await self._update(chat_key, "temperature", temperature)
 
     async def update_selected_prompt_id(self, chat_key, selected_prompt_id):
-        async with self._lock:
-            if chat_key in self._active_chats:
-                self._active_chats[chat_key]["selected_prompt_id"] = selected_prompt_id
+        await self._update(chat_key, "selected_prompt_id", selected_prompt_id)
+
+    async def update_context_budget(self, chat_key, context_budget):
+        await self._update(chat_key, "context_budget", context_budget)
+
+    async def trim_context(self, chat_key):
+        """Trim the chat history to its token budget. Returns (estimated tokens in use, budget)."""
+        async with self._lock(chat_key):
+            chat = await self._resident(chat_key)
+            if chat is None:
+                return 0, context_token_budget
+            chat.messages, used = trim_messages(chat.messages, chat.context_budget)
+            self._resize(chat_key, chat)
+            return used, chat.context_budget
+
+    async def context_usage(self, chat_key):
+        """Estimated tokens of the chat history and the chat's budget."""
+        async with self._lock(chat_key):
+            chat = await self._resident(chat_key)
+            if chat is None:
+                return 0, context_token_budget
+            return count_tokens(chat.messages), chat.context_budget
 
     async def initialize_chat(self, chat_key, modelname, default_temperature, selected_prompt_id):
-        async with self._lock:
-            if chat_key not in self._active_chats:
-                self._active_chats[chat_key] = {
-                    "model": modelname,
-                    "messages": [],
-                    "stream": True,
-                    "temperature": default_temperature,
-                    "selected_prompt_id": selected_prompt_id
-                }
\ No newline at end of file
+        async with self._lock(chat_key):
+            if await self._resident(chat_key) is None:
+                self._add(chat_key, ChatState(
+                    modelname, temperature=default_temperature, selected_prompt_id=selected_prompt_id
+                ))
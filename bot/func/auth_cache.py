@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+class AuthCache:
+    """
+    Shared in-memory copy of the allowed and admin user IDs used by perms_allowed / perms_admins.
+    Allowed IDs are loaded from the users table on first use and reloaded after any change to it.
+    """
+
+    def __init__(self, admin_ids):
+        self._admin_ids = frozenset(admin_ids)
+        self._allowed_ids = None  # None until loaded from the database
+        self._version = 0
+        self._db_manager = None
+        self._lock = asyncio.Lock()
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0}
+
+    def bind(self, db_manager):
+        """Attach the database the allowed IDs are read from and listen for user changes."""
+        self._db_manager = db_manager
+        db_manager.add_users_listener(self.invalidate)
+        self.invalidate()
+
+    def invalidate(self):
+        self._allowed_ids = None
+        # A reload still running against the database must not store its outdated IDs
+        self._version += 1
+
+    async def load(self):
+        async with self._lock:
+            # Read again if the users changed while the IDs were being read
+            while self._allowed_ids is None:
+                version = self._version
+                allowed_ids = frozenset(await self._db_manager.load_allowed_user_ids())
+                self.stats["reloads"] += 1
+                if version == self._version:
+                    self._allowed_ids = allowed_ids
+                    logging.debug(f"[AuthCache] Loaded {len(allowed_ids)} allowed user IDs")
+            return self._allowed_ids
+
+    def is_admin(self, user_id):
+        return user_id in self._admin_ids
+
+    async def is_allowed(self, user_id):
+        allowed_ids = self._allowed_ids
+        if allowed_ids is None:
+            self.stats["misses"] += 1
+            allowed_ids = await self.load()
+        else:
+            self.stats["hits"] += 1
+        return user_id in allowed_ids
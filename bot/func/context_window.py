@@ -0,0 +1,39 @@
+import os
+
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8192"))
+
+# Rough sizes used to estimate prompt tokens without a tokenizer
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 768
+
+def estimate_tokens(message):
+    """Estimated prompt tokens of one chat message. Computed once and cached on the message under "tokens"."""
+    tokens = message.get("tokens")
+    if tokens is None:
+        content = message.get("content") or ""
+        tokens = MESSAGE_OVERHEAD_TOKENS + (len(content) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+        tokens += IMAGE_TOKENS * len(message.get("images") or [])
+        message["tokens"] = tokens
+    return tokens
+
+def count_tokens(messages):
+    return sum(estimate_tokens(message) for message in messages)
+
+def trim_messages(messages, budget):
+    """
+    Drop the oldest messages until the estimate fits the budget.
+    System prompts and the most recent message are always kept. Returns the kept messages and their token count.
+    """
+    total = count_tokens(messages)
+    if budget <= 0 or total <= budget:
+        return messages, total
+
+    last_index = len(messages) - 1
+    kept = []
+    for index, message in enumerate(messages):
+        if total > budget and message.get("role") != "system" and index != last_index:
+            total -= message["tokens"]
+            continue
+        kept.append(message)
+    return kept, total
@@ -1,13 +1,26 @@
+import asyncio
 import sqlite3
 import json
 import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from func.db_queries import *
+from func.metrics import sqlite_operation_seconds
+from func.prompt_registry import prompt_hash
+
+db_read_pool_size = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+# "append" stores context messages as rows of active_chat_messages, "json" rewrites messages_json on every save
+context_storage = os.getenv("CONTEXT_STORAGE", "append")
 
 class DatabaseManager:
-    def __init__(self, db_name='users.db'):
+    def __init__(self, db_name='users.db', check_same_thread=True):
         self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name)
+        self.conn = sqlite3.connect(self.db_name, check_same_thread=check_same_thread)
         self.cursor = self.conn.cursor()
+        for pragma in connection_pragmas:
+            self.cursor.execute(pragma)
 
     def close_connection(self):
         self.conn.close()
@@ -19,6 +32,19 @@ class DatabaseManager:
         self.cursor.execute(create_system_prompts_table_query)
         self.cursor.execute(create_global_settings_table_query)
         self.cursor.execute(create_active_chat_contexts_table_query)
+        self.cursor.execute(create_active_chat_messages_table_query)
+        self.cursor.execute(select_user_storage_table_exists_query)
+        new_user_storage = self.cursor.fetchone() is None
+        self.cursor.execute(create_user_storage_table_query)
+        self.migrate_active_chat_context_columns()
+        self.migrate_system_prompt_hashes()
+        self.migrate_chats_chat_key()
+        for query in create_system_prompts_indexes_queries + create_chats_indexes_queries:
+            self.cursor.execute(query)
+        self.cursor.execute(drop_chats_user_id_index_query)
+        if new_user_storage:
+            # From here on the counts are kept up to date as turns are written and archived
+            self.cursor.execute(fill_user_storage_query)
 
         # Initialize global settings if not exist
         self.cursor.execute(select_count_global_settings_query)
@@ -27,27 +53,102 @@ class DatabaseManager:
             self.cursor.execute(insert_global_settings_query, (initial_model, None))
         self.conn.commit()
 
+        if context_storage == "append":
+            self.migrate_active_chat_messages()
+
     def register_user(self, user_id, user_name):
         self.cursor.execute(insert_or_replace_users_query, (user_id, user_name))
         self.conn.commit()
 
-    def save_chat_message(self, user_id, role, content):
+    def save_chat_message(self, user_id, role, content, chat_key=None):
         # Check if user exists, register if not
+        registered = False
         if not self._user_exists(user_id):
             # You might want to fetch the username if available and pass it here
             # For now, using user_id as username as a fallback
             self.register_user(user_id, str(user_id))
+            registered = True
 
-        self.cursor.execute(insert_chats_query, (user_id, role, content))
+        self.cursor.execute(insert_chats_query, (user_id, role, content, chat_key))
+        self.cursor.executemany(add_user_storage_live_query, self._storage_by_user([(user_id, role, content, chat_key)]))
         self.conn.commit()
+        return registered
+
+    @staticmethod
+    def _storage_by_user(chat_rows):
+        """(user_id, rows, bytes of content) of chat log rows, for add_user_storage_live_query."""
+        storage = {}
+        for user_id, _, content, _ in chat_rows:
+            rows, size = storage.get(user_id, (0, 0))
+            storage[user_id] = (rows + 1, size + len((content or "").encode("utf-8")))
+        return [(user_id, rows, size) for user_id, (rows, size) in storage.items()]
+
+    def get_chat_history(self, user_id, chat_key, before_id=None, after_id=None, limit=10):
+        """
+        One page of a user's stored turns in one chat, oldest first: the newest page, the page before before_id
+        or the page after after_id. Returns (rows, has_older, has_newer) with rows as (id, role, content, timestamp).
+        """
+        if after_id is not None:
+            self.cursor.execute(select_chat_history_after_query, (user_id, chat_key, after_id, limit + 1))
+            rows = self.cursor.fetchall()
+            has_newer, has_older = len(rows) > limit, True
+            rows = rows[:limit]
+        else:
+            if before_id is not None:
+                self.cursor.execute(select_chat_history_before_query, (user_id, chat_key, before_id, limit + 1))
+            else:
+                self.cursor.execute(select_chat_history_latest_query, (user_id, chat_key, limit + 1))
+            rows = self.cursor.fetchall()
+            has_older, has_newer = len(rows) > limit, before_id is not None
+            rows = rows[:limit][::-1]
+        return rows, has_older, has_newer
 
     def _user_exists(self, user_id):
         self.cursor.execute(select_user_exists_query, (user_id,))
         return self.cursor.fetchone() is not None
 
+    def migrate_active_chat_context_columns(self):
+        self.cursor.execute(select_active_chat_contexts_columns_query)
+        columns = [column[1] for column in self.cursor.fetchall()]
+        for column, query in add_active_chat_contexts_columns_queries.items():
+            if column not in columns:
+                self.cursor.execute(query)
+        self.conn.commit()
+
+    def migrate_system_prompt_hashes(self):
+        """Add the prompt_hash column to older databases and fill it in. Returns the number of prompts hashed."""
+        self.cursor.execute(select_system_prompts_columns_query)
+        if "prompt_hash" not in [column[1] for column in self.cursor.fetchall()]:
+            self.cursor.execute(add_system_prompts_hash_column_query)
+        self.cursor.execute(select_unhashed_system_prompts_query)
+        rows = self.cursor.fetchall()
+        self.cursor.executemany(update_system_prompt_hash_query, [(prompt_hash(prompt), prompt_id) for prompt_id, prompt in rows])
+        self.conn.commit()
+        return len(rows)
+
+    def migrate_chats_chat_key(self):
+        """Add the chat_key column to older databases. Returns the number of stored turns given a chat key."""
+        self.cursor.execute(select_chats_columns_query)
+        if "chat_key" in [column[1] for column in self.cursor.fetchall()]:
+            return 0
+        self.cursor.execute(add_chats_chat_key_column_query)
+        self.cursor.execute(update_chats_without_chat_key_query)
+        updated = self.cursor.rowcount
+        self.conn.commit()
+        return updated
+
     def add_system_prompt(self, user_id, prompt, is_global):
-        self.cursor.execute(insert_system_prompts_query2, (user_id, prompt, is_global))
+        self.cursor.execute(insert_system_prompts_query2, (user_id, prompt, is_global, prompt_hash(prompt)))
         self.conn.commit()
+        return self.cursor.lastrowid
+
+    def get_system_prompt(self, prompt_id):
+        self.cursor.execute(select_system_prompt_by_id_query, (prompt_id,))
+        return self.cursor.fetchone()
+
+    def find_system_prompts(self, prompt_hash_value):
+        self.cursor.execute(select_system_prompts_by_hash_query, (prompt_hash_value,))
+        return self.cursor.fetchall()
 
     def get_system_prompts(self, user_id=None, is_global=None):
         query = select_system_prompts_query
@@ -100,35 +201,405 @@ class DatabaseManager:
         self.cursor.execute(update_global_settings_query, (modelname, selected_prompt_id, default_temperature))
         self.conn.commit()
 
-    async def load_active_chats(self):
-        self.cursor.execute(select_active_chat_contexts_query)
+    @staticmethod
+    def _chat_from_row(row):
+        _, db_modelname, db_selected_prompt_id, messages_json, stream, temperature, context_budget = row
+        chat = {
+            "model": db_modelname,
+            "messages": json.loads(messages_json) if messages_json else [],
+            "stream": bool(stream),
+            "selected_prompt_id": int(db_selected_prompt_id) if db_selected_prompt_id is not None else None
+        }
+        # Left out when never stored, so the chat falls back to the defaults
+        if temperature is not None:
+            chat["temperature"] = temperature
+        if context_budget is not None:
+            chat["context_budget"] = context_budget
+        return chat
+
+    @staticmethod
+    def _message_from_row(seq, role, content, images_json):
+        message = {"role": role, "content": content, "seq": seq}
+        if images_json is not None:
+            message["images"] = json.loads(images_json)
+        return message
+
+    def load_active_chat(self, chat_key):
+        """The stored context of one chat, or None."""
+        self.cursor.execute(select_active_chat_context_by_key_query, (chat_key,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        chat = self._chat_from_row(row)
+        if row[3] is None:
+            self.cursor.execute(select_active_chat_messages_by_key_query, (chat_key,))
+            chat["messages"] = [self._message_from_row(*message_row) for message_row in self.cursor.fetchall()]
+        return chat
+
+    def get_active_chat_image_refs(self):
+        """Every image reference held by a stored chat context."""
+        refs = set()
+        self.cursor.execute(select_active_chat_images_query)
+        for (images_json,) in self.cursor:
+            refs.update(json.loads(images_json))
+        self.cursor.execute(select_active_chat_messages_json_query)
+        for (messages_json,) in self.cursor:
+            for message in json.loads(messages_json):
+                refs.update(message.get("images") or [])
+        return refs
+
+    @staticmethod
+    def _message_row(chat_key, seq, message):
+        images_json = json.dumps(message["images"]) if "images" in message else None
+        return (chat_key, seq, message.get("role"), message.get("content"), images_json)
+
+    def migrate_active_chat_messages(self):
+        """Move histories still stored in messages_json into active_chat_messages. Returns the number of chats moved."""
+        self.cursor.execute(select_legacy_active_chat_messages_query)
         rows = self.cursor.fetchall()
-        loaded_chats = {}
-        for row in rows:
-            chat_key, db_modelname, db_selected_prompt_id, messages_json, stream = row
-            messages = json.loads(messages_json) if messages_json else []
-            loaded_chats[chat_key] = {
-                "model": db_modelname,
-                "messages": messages,
-                "stream": bool(stream),
-                "selected_prompt_id": int(db_selected_prompt_id) if db_selected_prompt_id is not None else None
-            }
-        return loaded_chats
-
-    async def save_active_chats(self, active_chats):
-        self.cursor.execute(delete_active_chat_contexts_query)
+        for chat_key, messages_json in rows:
+            messages = json.loads(messages_json)
+            self.cursor.execute(delete_active_chat_messages_by_key_query, (chat_key,))
+            self.cursor.executemany(insert_active_chat_message_query,
+                      [self._message_row(chat_key, seq, message) for seq, message in enumerate(messages)])
+            self.cursor.execute(clear_active_chat_messages_json_query, (chat_key,))
+        self.conn.commit()
+        return len(rows)
+
+    def append_active_chats(self, entries):
+        """
+        Append-only save of chat contexts in one transaction.
+        Each entry is (chat_key, chat_context, messages, first_kept_seq): messages with a higher seq than any
+        stored row are inserted, and non-system rows below first_kept_seq (trimmed from the context) are deleted.
+        """
+        try:
+            self._append_active_chats(entries)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _append_active_chats(self, entries):
+        for chat_key, chat_context, messages, first_kept_seq in entries:
+            self.cursor.execute(replace_active_chat_contexts_query, self._context_row(chat_key, chat_context, None))
+            if first_kept_seq is not None:
+                self.cursor.execute(delete_trimmed_active_chat_messages_query, (chat_key, first_kept_seq))
+            # What is stored is decided here, inside the transaction: a batch that failed and is sent again
+            # inserts the same messages again
+            self.cursor.execute(select_max_active_chat_message_seq_query, (chat_key,))
+            stored_seq = self.cursor.fetchone()[0]
+            new_messages = [message for message in messages if stored_seq is None or message["seq"] > stored_seq]
+            if new_messages:
+                self.cursor.executemany(insert_active_chat_message_query,
+                          [self._message_row(chat_key, message["seq"], message) for message in new_messages])
+
+    @staticmethod
+    def _context_row(chat_key, chat_context, messages_json):
+        return (chat_key, chat_context["model"], chat_context.get("selected_prompt_id"), messages_json, chat_context["stream"],
+                chat_context.get("temperature"), chat_context.get("context_budget"))
+
+    def _save_active_chats(self, active_chats):
+        # Only chats held in memory are passed in, the rows of evicted chats are left as they are
         for chat_key, chat_data in active_chats.items():
             messages_json = json.dumps(chat_data["messages"]) if chat_data.get("messages") else None
-            self.cursor.execute(insert_active_chat_contexts_query,
-                      (chat_key, chat_data["model"], chat_data.get("selected_prompt_id"), messages_json, chat_data["stream"]))
-        self.conn.commit()
+            self.cursor.execute(replace_active_chat_contexts_query, self._context_row(chat_key, chat_data, messages_json))
+
+    def write_batch(self, chat_rows, settings=None, append_entries=(), contexts=None):
+        """
+        Store queued changes in one transaction: chat log rows (user_id, role, content, chat_key), the global settings
+        (modelname, selected_prompt_id, default_temperature) and chat contexts, as append entries or whole contexts.
+        Returns the ids of users registered because they had no row yet.
+        """
+        registered = []
+        try:
+            for user_id in dict.fromkeys(row[0] for row in chat_rows):
+                if not self._user_exists(user_id):
+                    # Same fallback as save_chat_message: the user ID doubles as the name
+                    self.cursor.execute(insert_or_replace_users_query, (user_id, str(user_id)))
+                    registered.append(user_id)
+            self.cursor.executemany(insert_chats_query, chat_rows)
+            self.cursor.executemany(add_user_storage_live_query, self._storage_by_user(chat_rows))
+            if settings is not None:
+                self.cursor.execute(update_global_settings_query, settings)
+            self._append_active_chats(append_entries)
+            self._save_active_chats(contexts or {})
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return registered
 
     def save_active_chat_context(self, chat_key, chat_context):
         messages_json = json.dumps(chat_context["messages"]) if chat_context.get("messages") else None
-        self.cursor.execute(replace_active_chat_contexts_query,
-                  (chat_key, chat_context["model"], chat_context.get("selected_prompt_id"), messages_json, chat_context["stream"]))
+        self.cursor.execute(replace_active_chat_contexts_query, self._context_row(chat_key, chat_context, messages_json))
         self.conn.commit()
 
     def delete_active_chat_context(self, chat_key):
         self.cursor.execute(delete_active_chat_context_by_key_query, (chat_key,))
-        self.conn.commit()
\ No newline at end of file
+        self.cursor.execute(delete_active_chat_messages_by_key_query, (chat_key,))
+        self.conn.commit()
+
+    def archive_chats(self, cutoff, limit, archive_dir, compress=False):
+        """
+        Move up to limit chats rows older than cutoff (a "YYYY-MM-DD HH:MM:SS" UTC timestamp) into monthly archive
+        databases in archive_dir. Returns the number of rows moved.
+        """
+        self.cursor.execute(select_expired_chats_query, (cutoff, limit))
+        rows = self.cursor.fetchall()
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(str(row[4])[:7], []).append(row)
+        os.makedirs(archive_dir, exist_ok=True)
+        for month, month_rows in by_month.items():
+            archive_rows = []
+            archived = {}
+            for chat_id, user_id, role, content, timestamp, chat_key in month_rows:
+                stored = zlib.compress((content or "").encode("utf-8")) if compress else content
+                archive_rows.append((chat_id, user_id, role, stored, int(compress), timestamp, chat_key))
+                size = len((content or "").encode("utf-8"))
+                user_rows, user_bytes, user_live_bytes = archived.get(user_id, (0, 0, 0))
+                archived[user_id] = (user_rows + 1, user_bytes + (len(stored) if compress else size), user_live_bytes + size)
+            # ATTACH is not allowed inside a transaction
+            self.conn.commit()
+            self.cursor.execute(attach_archive_query, (os.path.join(archive_dir, f"chats-{month}.db"),))
+            try:
+                self.cursor.execute(create_archive_chats_table_query)
+                self.cursor.execute(drop_archive_chats_user_id_index_query)
+                self.cursor.execute(create_archive_chats_index_query)
+                # Commit the copy before deleting: with WAL, a transaction over attached databases is not atomic
+                # across files. Rows copied twice are ignored, so a batch interrupted here is simply redone
+                self.cursor.executemany(insert_archive_chats_query, archive_rows)
+                self.conn.commit()
+                self.cursor.executemany(delete_chats_by_id_query, [(row[0],) for row in month_rows])
+                self.cursor.executemany(
+                    upsert_user_storage_archived_query,
+                    [(user_id, user_rows, user_bytes, live_bytes) for user_id, (user_rows, user_bytes, live_bytes) in archived.items()],
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.cursor.execute(detach_archive_query)
+        return len(rows)
+
+    def get_auto_vacuum(self):
+        """The auto_vacuum mode: 0 NONE, 1 FULL, 2 INCREMENTAL."""
+        self.cursor.execute(select_auto_vacuum_query)
+        return self.cursor.fetchone()[0]
+
+    def enable_incremental_vacuum(self, max_bytes=None):
+        """
+        Switch the database to auto_vacuum=INCREMENTAL. This rewrites the whole file with a VACUUM, and every other
+        write waits for it, so a database larger than max_bytes is left alone. Returns True if it was switched.
+        """
+        if self.get_auto_vacuum() == 2:
+            return False
+        if max_bytes is not None and self.get_database_size()[0] > max_bytes:
+            return False
+        self.conn.commit()
+        self.cursor.execute(set_auto_vacuum_incremental_query)
+        self.cursor.execute(vacuum_query)
+        return True
+
+    def incremental_vacuum(self, pages):
+        """Return up to pages free pages to the filesystem. Returns (pages freed, free pages left)."""
+        self.cursor.execute(select_freelist_count_query)
+        before = self.cursor.fetchone()[0]
+        self.cursor.execute(incremental_vacuum_query.format(pages=int(pages)))
+        # Each step of the statement frees one page, so the result has to be consumed
+        self.cursor.fetchall()
+        self.conn.commit()
+        self.cursor.execute(select_freelist_count_query)
+        after = self.cursor.fetchone()[0]
+        return before - after, after
+
+    def get_database_size(self):
+        """(bytes used by the database file, bytes of it on the freelist)."""
+        self.cursor.execute(select_page_size_query)
+        page_size = self.cursor.fetchone()[0]
+        self.cursor.execute(select_page_count_query)
+        page_count = self.cursor.fetchone()[0]
+        self.cursor.execute(select_freelist_count_query)
+        freelist_count = self.cursor.fetchone()[0]
+        return page_count * page_size, freelist_count * page_size
+
+    def get_user_storage(self, limit=10):
+        """(user_id, name, live_rows, live_bytes, archived_rows, archived_bytes), biggest users first."""
+        self.cursor.execute(select_user_storage_query, (limit,))
+        return self.cursor.fetchall()
+
+
+class AsyncDatabaseManager:
+    """
+    Async facade over DatabaseManager that keeps SQLite off the event loop.
+    All writes are serialized through one dedicated writer thread, reads are served by a small pool of connections.
+    """
+
+    def __init__(self, db_name='users.db', read_pool_size=db_read_pool_size):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._managers = []
+        self._managers_lock = threading.Lock()
+        self._users_listeners = []
+        self._prompts_listeners = []
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer", initializer=self._init_thread)
+        self._readers = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="db-reader", initializer=self._init_thread)
+
+    def _init_thread(self):
+        manager = DatabaseManager(self.db_name, check_same_thread=False)
+        self._local.manager = manager
+        with self._managers_lock:
+            self._managers.append(manager)
+
+    def _call(self, method_name, *args, **kwargs):
+        return getattr(self._local.manager, method_name)(*args, **kwargs)
+
+    async def _run(self, executor, method_name, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started_at = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, lambda: self._call(method_name, *args, **kwargs))
+        finally:
+            sqlite_operation_seconds.observe(time.perf_counter() - started_at, operation=method_name)
+
+    def add_users_listener(self, callback):
+        """Register a callback run whenever the users table changes (e.g. to invalidate the auth cache)."""
+        self._users_listeners.append(callback)
+
+    def _notify_users_changed(self):
+        for callback in self._users_listeners:
+            callback()
+
+    def add_prompts_listener(self, callback):
+        """Register a callback run whenever a system prompt is added or deleted (e.g. to invalidate the prompt registry)."""
+        self._prompts_listeners.append(callback)
+
+    def _notify_prompts_changed(self):
+        for callback in self._prompts_listeners:
+            callback()
+
+    @staticmethod
+    def _snapshot(chat_context):
+        # The event loop keeps appending to the live messages list while the writer thread serializes it
+        return {**chat_context, "messages": list(chat_context.get("messages") or [])}
+
+    def _append_entry(self, chat_key, chat_context):
+        # Every message has its sequence number from ChatState; the writer thread compares them with the stored rows
+        messages = list(chat_context.get("messages") or [])
+        first_kept_seq = next((message["seq"] for message in messages if message.get("role") != "system"), None)
+        metadata = {key: chat_context.get(key) for key in ("model", "selected_prompt_id", "stream", "temperature", "context_budget")}
+        return (chat_key, metadata, messages, first_kept_seq)
+
+    async def _write(self, method_name, *args, **kwargs):
+        return await self._run(self._writer, method_name, *args, **kwargs)
+
+    async def _read(self, method_name, *args, **kwargs):
+        return await self._run(self._readers, method_name, *args, **kwargs)
+
+    async def initialize_database(self):
+        return await self._write("initialize_database")
+
+    async def register_user(self, user_id, user_name):
+        result = await self._write("register_user", user_id, user_name)
+        self._notify_users_changed()
+        return result
+
+    async def save_chat_message(self, user_id, role, content, chat_key=None):
+        registered = await self._write("save_chat_message", user_id, role, content, chat_key)
+        if registered:
+            self._notify_users_changed()
+        return registered
+
+    async def get_chat_history(self, user_id, chat_key, before_id=None, after_id=None, limit=10):
+        return await self._read("get_chat_history", user_id, chat_key, before_id=before_id, after_id=after_id, limit=limit)
+
+    async def add_system_prompt(self, user_id, prompt, is_global):
+        prompt_id = await self._write("add_system_prompt", user_id, prompt, is_global)
+        self._notify_prompts_changed()
+        return prompt_id
+
+    async def get_system_prompts(self, user_id=None, is_global=None):
+        return await self._read("get_system_prompts", user_id=user_id, is_global=is_global)
+
+    async def get_system_prompt(self, prompt_id):
+        return await self._read("get_system_prompt", prompt_id)
+
+    async def find_system_prompts(self, prompt_hash_value):
+        return await self._read("find_system_prompts", prompt_hash_value)
+
+    async def delete_system_prompt(self, prompt_id):
+        result = await self._write("delete_system_prompt", prompt_id)
+        self._notify_prompts_changed()
+        return result
+
+    async def load_allowed_user_ids(self):
+        return await self._read("load_allowed_user_ids")
+
+    async def get_all_users(self):
+        return await self._read("get_all_users")
+
+    async def remove_user(self, user_id):
+        removed = await self._write("remove_user", user_id)
+        if removed:
+            self._notify_users_changed()
+        return removed
+
+    async def load_global_settings(self):
+        return await self._read("load_global_settings")
+
+    async def save_global_settings(self, modelname, selected_prompt_id, default_temperature):
+        return await self._write("save_global_settings", modelname, selected_prompt_id, default_temperature)
+
+    async def load_active_chat(self, chat_key):
+        return await self._read("load_active_chat", chat_key)
+
+    async def get_active_chat_image_refs(self):
+        return await self._read("get_active_chat_image_refs")
+
+    async def save_active_chat_context(self, chat_key, chat_context):
+        if context_storage == "append":
+            return await self._write("append_active_chats", [self._append_entry(chat_key, chat_context)])
+        return await self._write("save_active_chat_context", chat_key, self._snapshot(chat_context))
+
+    async def delete_active_chat_context(self, chat_key):
+        return await self._write("delete_active_chat_context", chat_key)
+
+    async def write_batch(self, chat_rows, settings=None, contexts=None):
+        """Write chat log rows, settings and chat contexts (chat_key -> context) in one transaction."""
+        contexts = contexts or {}
+        if context_storage == "append":
+            entries = [self._append_entry(chat_key, chat_context) for chat_key, chat_context in contexts.items()]
+            registered = await self._write("write_batch", chat_rows, settings, append_entries=entries)
+        else:
+            snapshot = {chat_key: self._snapshot(chat_context) for chat_key, chat_context in contexts.items()}
+            registered = await self._write("write_batch", chat_rows, settings, contexts=snapshot)
+        if registered:
+            self._notify_users_changed()
+        return registered
+
+    async def archive_chats(self, cutoff, limit, archive_dir, compress=False):
+        return await self._write("archive_chats", cutoff, limit, archive_dir, compress)
+
+    async def get_auto_vacuum(self):
+        return await self._read("get_auto_vacuum")
+
+    async def enable_incremental_vacuum(self, max_bytes=None):
+        return await self._write("enable_incremental_vacuum", max_bytes)
+
+    async def incremental_vacuum(self, pages):
+        return await self._write("incremental_vacuum", pages)
+
+    async def get_database_size(self):
+        return await self._read("get_database_size")
+
+    async def get_user_storage(self, limit=10):
+        return await self._read("get_user_storage", limit)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._managers_lock:
+            for manager in self._managers:
+                manager.close_connection()
+            self._managers.clear()
@@ -2,6 +2,17 @@ init_db_query = '''
 PRAGMA foreign_keys = ON;
 '''
 
+# Applied to every connection. WAL lets the reader pool run alongside the writer thread,
+# synchronous=NORMAL only fsyncs at checkpoints instead of on every commit.
+connection_pragmas = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+]
+
 create_users_table_query = '''
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY,
@@ -16,6 +27,7 @@ CREATE TABLE IF NOT EXISTS chats (
     role TEXT,
     content TEXT,
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    chat_key TEXT,
     FOREIGN KEY (user_id) REFERENCES users(id)
 )
 '''
@@ -46,10 +58,31 @@ CREATE TABLE IF NOT EXISTS active_chat_contexts (
     modelname TEXT,
     selected_prompt_id INTEGER,
     messages_json TEXT,
-    stream BOOLEAN
+    stream BOOLEAN,
+    temperature REAL,
+    context_budget INTEGER
 )
 '''
 
+# Per-chat settings added after the table was first released, so chats evicted from memory keep them
+select_active_chat_contexts_columns_query = "PRAGMA table_info(active_chat_contexts)"
+add_active_chat_contexts_columns_queries = {
+    "temperature": "ALTER TABLE active_chat_contexts ADD COLUMN temperature REAL",
+    "context_budget": "ALTER TABLE active_chat_contexts ADD COLUMN context_budget INTEGER",
+}
+
+# Append-only storage of active chat messages, one row per message in conversation order
+create_active_chat_messages_table_query = '''
+CREATE TABLE IF NOT EXISTS active_chat_messages (
+    chat_key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT,
+    content TEXT,
+    images_json TEXT,
+    PRIMARY KEY (chat_key, seq)
+) WITHOUT ROWID
+'''
+
 select_count_global_settings_query = '''
 SELECT COUNT(*)
 FROM global_settings
@@ -70,8 +103,9 @@ insert_chats_query = '''
 INSERT INTO chats (
     user_id,
     role,
-    content
-) VALUES (?, ?, ?)
+    content,
+    chat_key
+) VALUES (?, ?, ?, ?)
 '''
 
 replace_active_chat_contexts_query = '''
@@ -80,8 +114,10 @@ REPLACE INTO active_chat_contexts (
     modelname,
     selected_prompt_id,
     messages_json,
-    stream
-) VALUES (?, ?, ?, ?, ?)
+    stream,
+    temperature,
+    context_budget
+) VALUES (?, ?, ?, ?, ?, ?, ?)
 '''
 
 select_global_settings_limit_1_query = '''
@@ -120,10 +156,15 @@ SELECT
     modelname,
     selected_prompt_id,
     messages_json,
-    stream
+    stream,
+    temperature,
+    context_budget
 FROM active_chat_contexts
 '''
 
+select_active_chat_context_by_key_query = select_active_chat_contexts_query + '''WHERE chat_key = ?
+'''
+
 delete_active_chat_contexts_query = '''
 DELETE FROM active_chat_contexts
 '''
@@ -134,8 +175,10 @@ INSERT INTO active_chat_contexts (
     modelname,
     selected_prompt_id,
     messages_json,
-    stream
-) VALUES (?, ?, ?, ?, ?)
+    stream,
+    temperature,
+    context_budget
+) VALUES (?, ?, ?, ?, ?, ?, ?)
 '''
 
 delete_active_chat_context_by_key_query = '''
@@ -143,12 +186,211 @@ DELETE FROM active_chat_contexts
 WHERE chat_key = ?
 '''
 
+insert_active_chat_message_query = '''
+INSERT OR REPLACE INTO active_chat_messages (
+    chat_key,
+    seq,
+    role,
+    content,
+    images_json
+) VALUES (?, ?, ?, ?, ?)
+'''
+
+select_active_chat_messages_by_key_query = '''
+SELECT
+    seq,
+    role,
+    content,
+    images_json
+FROM active_chat_messages
+WHERE chat_key = ?
+ORDER BY seq
+'''
+
+# Image references of every stored context, for the image store's garbage collection
+select_active_chat_images_query = '''
+SELECT images_json
+FROM active_chat_messages
+WHERE images_json IS NOT NULL
+AND images_json != '[]'
+'''
+
+select_active_chat_messages_json_query = '''
+SELECT messages_json
+FROM active_chat_contexts
+WHERE messages_json IS NOT NULL
+'''
+
+select_max_active_chat_message_seq_query = "SELECT MAX(seq) FROM active_chat_messages WHERE chat_key = ?"
+
+delete_trimmed_active_chat_messages_query = '''
+DELETE FROM active_chat_messages
+WHERE chat_key = ?
+AND seq < ?
+AND role != 'system'
+'''
+
+delete_active_chat_messages_by_key_query = '''
+DELETE FROM active_chat_messages
+WHERE chat_key = ?
+'''
+
+select_legacy_active_chat_messages_query = '''
+SELECT
+    chat_key,
+    messages_json
+FROM active_chat_contexts
+WHERE messages_json IS NOT NULL
+'''
+
+clear_active_chat_messages_json_query = '''
+UPDATE active_chat_contexts
+SET messages_json = NULL
+WHERE chat_key = ?
+'''
+
+# /history pages through chats by (user_id, id); retention jobs select rows by timestamp
+create_chats_indexes_queries = [
+    "CREATE INDEX IF NOT EXISTS idx_chats_user_chat ON chats (user_id, chat_key, id)",
+    "CREATE INDEX IF NOT EXISTS idx_chats_timestamp ON chats (timestamp)",
+]
+
+# History pages seek on (user_id, chat_key, id), the older (user_id, id) index only slowed down inserts
+drop_chats_user_id_index_query = "DROP INDEX IF EXISTS idx_chats_user_id"
+
+# Keyset pagination: each page starts after the last id of the previous one, so no OFFSET scan
+select_chat_history_latest_query = "SELECT id, role, content, timestamp FROM chats WHERE user_id = ? AND chat_key = ? ORDER BY id DESC LIMIT ?"
+select_chat_history_before_query = "SELECT id, role, content, timestamp FROM chats WHERE user_id = ? AND chat_key = ? AND id < ? ORDER BY id DESC LIMIT ?"
+select_chat_history_after_query = "SELECT id, role, content, timestamp FROM chats WHERE user_id = ? AND chat_key = ? AND id > ? ORDER BY id ASC LIMIT ?"
+
+# Turns stored before chats had a chat_key are attributed to the user's private chat
+select_chats_columns_query = "PRAGMA table_info(chats)"
+add_chats_chat_key_column_query = "ALTER TABLE chats ADD COLUMN chat_key TEXT"
+update_chats_without_chat_key_query = "UPDATE chats SET chat_key = 'private_' || user_id WHERE chat_key IS NULL"
+
+select_system_prompts_columns_query = "PRAGMA table_info(system_prompts)"
+add_system_prompts_hash_column_query = "ALTER TABLE system_prompts ADD COLUMN prompt_hash TEXT"
+select_unhashed_system_prompts_query = "SELECT id, prompt FROM system_prompts WHERE prompt_hash IS NULL"
+update_system_prompt_hash_query = "UPDATE system_prompts SET prompt_hash = ? WHERE id = ?"
+
+# Prompt lists are filtered by owner and scope, the prompt registry looks prompts up by text through the hash
+create_system_prompts_indexes_queries = [
+    "CREATE INDEX IF NOT EXISTS idx_system_prompts_user_global ON system_prompts (user_id, is_global)",
+    "CREATE INDEX IF NOT EXISTS idx_system_prompts_hash ON system_prompts (prompt_hash)",
+]
+
 select_user_exists_query = "SELECT 1 FROM users WHERE id = ?"
-insert_system_prompts_query2 = "INSERT INTO system_prompts (user_id, prompt, is_global) VALUES (?, ?, ?)"
+insert_system_prompts_query2 = "INSERT INTO system_prompts (user_id, prompt, is_global, prompt_hash) VALUES (?, ?, ?, ?)"
+select_system_prompt_by_id_query = "SELECT id, user_id, prompt, is_global, timestamp FROM system_prompts WHERE id = ?"
+select_system_prompts_by_hash_query = "SELECT id, user_id, prompt, is_global, timestamp FROM system_prompts WHERE prompt_hash = ? ORDER BY id"
 select_system_prompts_query = "SELECT id, user_id, prompt, is_global, timestamp FROM system_prompts WHERE 1=1"
 select_system_prompts_user_filter = " AND (user_id = ? OR user_id IS NULL)"
 select_system_prompts_global_filter = " AND is_global = ?"
 delete_system_prompt_query = "DELETE FROM system_prompts WHERE id = ?"
 select_user_ids_query = "SELECT id FROM users"
 select_all_users_query = "SELECT id, name FROM users"
-delete_user_query = "DELETE FROM users WHERE id = ?" 
\ No newline at end of file
+delete_user_query = "DELETE FROM users WHERE id = ?" 
+
+# Stored sizes per user, counted as turns are written and archived
+create_user_storage_table_query = '''
+CREATE TABLE IF NOT EXISTS user_storage (
+    user_id INTEGER PRIMARY KEY,
+    live_rows INTEGER NOT NULL DEFAULT 0,
+    live_bytes INTEGER NOT NULL DEFAULT 0,
+    archived_rows INTEGER NOT NULL DEFAULT 0,
+    archived_bytes INTEGER NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+select_user_storage_table_exists_query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_storage'"
+
+# One-time count of the turns stored before the table existed
+fill_user_storage_query = '''
+INSERT INTO user_storage (user_id, live_rows, live_bytes, updated_at)
+SELECT user_id, COUNT(*), COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0), CURRENT_TIMESTAMP
+FROM chats
+WHERE true
+GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE SET
+    live_rows = excluded.live_rows,
+    live_bytes = excluded.live_bytes,
+    updated_at = excluded.updated_at
+'''
+
+add_user_storage_live_query = '''
+INSERT INTO user_storage (user_id, live_rows, live_bytes, updated_at)
+VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+ON CONFLICT (user_id) DO UPDATE SET
+    live_rows = live_rows + excluded.live_rows,
+    live_bytes = live_bytes + excluded.live_bytes,
+    updated_at = excluded.updated_at
+'''
+
+upsert_user_storage_archived_query = '''
+INSERT INTO user_storage (user_id, archived_rows, archived_bytes, updated_at)
+VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+ON CONFLICT (user_id) DO UPDATE SET
+    archived_rows = archived_rows + excluded.archived_rows,
+    archived_bytes = archived_bytes + excluded.archived_bytes,
+    live_rows = MAX(live_rows - excluded.archived_rows, 0),
+    live_bytes = MAX(live_bytes - ?, 0),
+    updated_at = excluded.updated_at
+'''
+
+select_user_storage_query = '''
+SELECT
+    user_storage.user_id,
+    users.name,
+    live_rows,
+    live_bytes,
+    archived_rows,
+    archived_bytes
+FROM user_storage
+LEFT JOIN users ON users.id = user_storage.user_id
+ORDER BY live_bytes + archived_bytes DESC
+LIMIT ?
+'''
+
+select_expired_chats_query = '''
+SELECT id, user_id, role, content, timestamp, chat_key
+FROM chats
+WHERE timestamp < ?
+ORDER BY timestamp
+LIMIT ?
+'''
+
+delete_chats_by_id_query = "DELETE FROM chats WHERE id = ?"
+
+attach_archive_query = "ATTACH DATABASE ? AS archive"
+detach_archive_query = "DETACH DATABASE archive"
+
+# One archive file per month of chat timestamps. Rows keep their id, so a batch that is archived twice
+# (e.g. after a crash between the archive and the main commit) is not duplicated
+create_archive_chats_table_query = '''
+CREATE TABLE IF NOT EXISTS archive.chats (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    role TEXT,
+    content BLOB,
+    compressed INTEGER NOT NULL DEFAULT 0,
+    timestamp DATETIME,
+    chat_key TEXT
+)
+'''
+
+create_archive_chats_index_query = "CREATE INDEX IF NOT EXISTS archive.idx_chats_user_chat ON chats (user_id, chat_key, id)"
+drop_archive_chats_user_id_index_query = "DROP INDEX IF EXISTS archive.idx_chats_user_id"
+
+insert_archive_chats_query = '''
+INSERT OR IGNORE INTO archive.chats (id, user_id, role, content, compressed, timestamp, chat_key)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+select_auto_vacuum_query = "PRAGMA auto_vacuum"
+set_auto_vacuum_incremental_query = "PRAGMA auto_vacuum = INCREMENTAL"
+vacuum_query = "VACUUM"
+incremental_vacuum_query = "PRAGMA incremental_vacuum({pages})"
+select_freelist_count_query = "PRAGMA freelist_count"
+select_page_count_query = "PRAGMA page_count"
+select_page_size_query = "PRAGMA page_size"
@@ -0,0 +1,50 @@
+import html
+import os
+from aiogram import types
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+# Stored turns shown per /history page
+history_page_size = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+ROLE_ICONS = {"user": "👤", "assistant": "🤖", "system": "⚙️"}
+
+def _shorten(text, limit):
+    text = text or ""
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+def history_keyboard(user_id, rows, has_older, has_newer):
+    """Older/Newer buttons. The callback data carries the owner and the id the next page starts from."""
+    buttons = []
+    if has_older:
+        buttons.append(types.InlineKeyboardButton(text="◀️ Older", callback_data=f"history_older_{user_id}_{rows[0][0]}"))
+    if has_newer:
+        buttons.append(types.InlineKeyboardButton(text="Newer ▶️", callback_data=f"history_newer_{user_id}_{rows[-1][0]}"))
+    if not buttons:
+        return None
+    builder = InlineKeyboardBuilder()
+    builder.row(*buttons)
+    return builder.as_markup()
+
+def render_history_page(rows, header=""):
+    """
+    HTML text of one page of (id, role, content, timestamp) rows that fits in a single Telegram message.
+    Returns the text and the rows it shows: when even shortened turns do not fit, the oldest rows are left out.
+    """
+    while True:
+        # Long turns are shortened so a full page stays within the message limit
+        limit = max(80, (TELEGRAM_MESSAGE_LIMIT - len(header) - 200) // max(1, len(rows)) - 60)
+        while True:
+            lines = [header] if header else []
+            for _, role, content, timestamp in rows:
+                icon = ROLE_ICONS.get(role, "💬")
+                lines.append(f"{icon} <i>{html.escape(str(timestamp)[:16])}</i>\n{html.escape(_shorten(content, limit))}")
+            text = "\n\n".join(lines)
+            # Escaping can grow the text; shorten further until the page fits
+            if len(text) <= TELEGRAM_MESSAGE_LIMIT or limit <= 20:
+                break
+            limit //= 2
+        # Cutting the HTML could split a tag or an entity, so show fewer turns instead
+        if len(text) <= TELEGRAM_MESSAGE_LIMIT or len(rows) <= 1:
+            return text, rows
+        rows = rows[1:]
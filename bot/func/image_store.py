@@ -0,0 +1,189 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+image_store_dir = os.getenv("IMAGE_STORE_DIR", "images")
+image_cache_size = int(os.getenv("IMAGE_CACHE_SIZE", "16"))
+image_gc_interval = int(os.getenv("IMAGE_GC_INTERVAL", "3600"))
+# Blobs younger than this are never collected, they may belong to a message that is still being added
+image_gc_grace = int(os.getenv("IMAGE_GC_GRACE", "600"))
+
+REF_PREFIX = "sha256:"
+
+def is_image_ref(value):
+    """Chat messages saved before the blob store hold base64 data instead of a reference."""
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+class ImageStore:
+    """
+    Content-addressed on-disk store for chat images.
+    Blobs are named by the SHA-256 of their bytes, so the same image is written once however often it is sent.
+    Telegram file_unique_id aliases let forwarded photos be recognised without downloading them again.
+    Messages keep only "sha256:<hex>" references; base64 is produced when a request payload is built.
+    """
+
+    def __init__(self, root=image_store_dir, cache_size=image_cache_size):
+        self.root = root
+        self.cache_size = cache_size
+        self._encoded = OrderedDict()  # digest -> base64, most recently used last
+        self._aliases = {}  # file_unique_id -> digest
+        self.stats = {"stored": 0, "deduplicated": 0, "cache_hits": 0, "cache_misses": 0, "collected": 0}
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    def _alias_path(self, file_unique_id):
+        return os.path.join(self.root, "aliases", file_unique_id)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _touch_blob(self, digest):
+        """Mark the blob as just used, so garbage collection leaves it alone for the grace period."""
+        try:
+            os.utime(self._blob_path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _write_blob(self, digest, data):
+        path = self._blob_path(digest)
+        if self._touch_blob(digest):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def _write_alias(self, file_unique_id, digest):
+        path = self._alias_path(file_unique_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(digest)
+
+    def _read_alias(self, file_unique_id):
+        try:
+            with open(self._alias_path(file_unique_id)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _read_blob(self, digest):
+        with open(self._blob_path(digest), "rb") as f:
+            return f.read()
+
+    async def find(self, file_unique_id):
+        """Reference of an already stored Telegram file, or None."""
+        if not file_unique_id:
+            return None
+        digest = self._aliases.get(file_unique_id)
+        if digest is None:
+            digest = await self._run(self._read_alias, file_unique_id)
+            if digest is None:
+                return None
+        # The blob may have been collected since; otherwise it counts as used again from now on
+        if not await self._run(self._touch_blob, digest):
+            self._aliases.pop(file_unique_id, None)
+            return None
+        self._aliases[file_unique_id] = digest
+        self.stats["deduplicated"] += 1
+        return REF_PREFIX + digest
+
+    async def put(self, data, file_unique_id=None):
+        """Store image bytes and return their reference."""
+        digest = hashlib.sha256(data).hexdigest()
+        if await self._run(self._write_blob, digest, data):
+            self.stats["stored"] += 1
+        else:
+            self.stats["deduplicated"] += 1
+        if file_unique_id:
+            self._aliases[file_unique_id] = digest
+            await self._run(self._write_alias, file_unique_id, digest)
+        return REF_PREFIX + digest
+
+    async def encode(self, ref):
+        """Base64 of a stored image, served from the LRU of recent encodings when possible."""
+        digest = ref[len(REF_PREFIX):]
+        encoded = self._encoded.get(digest)
+        if encoded is not None:
+            self._encoded.move_to_end(digest)
+            self.stats["cache_hits"] += 1
+            return encoded
+        self.stats["cache_misses"] += 1
+        data = await self._run(self._read_blob, digest)
+        encoded = base64.b64encode(data).decode("utf-8")
+        self._encoded[digest] = encoded
+        if len(self._encoded) > self.cache_size:
+            self._encoded.popitem(last=False)
+        return encoded
+
+    async def resolve_messages(self, messages):
+        """
+        Copy of the chat messages in the form Ollama expects: image references replaced by base64
+        and bookkeeping keys (seq, tokens) left out.
+        """
+        resolved = []
+        for message in messages:
+            item = {"role": message.get("role"), "content": message.get("content")}
+            images = message.get("images")
+            if images:
+                encoded = []
+                for image in images:
+                    if not is_image_ref(image):
+                        encoded.append(image)
+                        continue
+                    try:
+                        encoded.append(await self.encode(image))
+                    except FileNotFoundError:
+                        logging.warning(f"[ImageStore] Missing blob {image}, sending the message without it")
+                item["images"] = encoded
+            resolved.append(item)
+        return resolved
+
+    def _collect(self, referenced, grace):
+        blobs_dir = os.path.join(self.root, "blobs")
+        removed = []
+        cutoff = time.time() - grace
+        for dirpath, _, filenames in os.walk(blobs_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name in referenced or os.path.getmtime(path) > cutoff:
+                    continue
+                os.remove(path)
+                removed.append(name)
+        aliases_dir = os.path.join(self.root, "aliases")
+        if removed and os.path.isdir(aliases_dir):
+            removed_set = set(removed)
+            for name in os.listdir(aliases_dir):
+                path = os.path.join(aliases_dir, name)
+                with open(path) as f:
+                    if f.read().strip() in removed_set:
+                        os.remove(path)
+        return removed
+
+    async def collect_garbage(self, chats, grace=image_gc_grace, extra_refs=()):
+        """
+        Delete blobs no chat message refers to. chats is a mapping of chat_key to chat context,
+        extra_refs are further image references to keep (e.g. those of contexts only stored in the database).
+        """
+        referenced = {image[len(REF_PREFIX):] for image in extra_refs if is_image_ref(image)}
+        for chat in chats.values():
+            for message in chat.get("messages") or []:
+                for image in message.get("images") or []:
+                    if is_image_ref(image):
+                        referenced.add(image[len(REF_PREFIX):])
+        removed = await self._run(self._collect, referenced, grace)
+        for digest in removed:
+            self._encoded.pop(digest, None)
+        if removed:
+            removed_set = set(removed)
+            self._aliases = {key: digest for key, digest in self._aliases.items() if digest not in removed_set}
+            self.stats["collected"] += len(removed)
+            logging.info(f"[ImageStore] Removed {len(removed)} unreferenced image blobs")
+        return len(removed)
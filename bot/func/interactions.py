@@ -1,6 +1,8 @@
 # >> interactions
+import asyncio
 import logging
 import os
+import time
 import aiohttp
 import json
 from aiogram import types
@@ -8,8 +10,10 @@ from aiohttp import ClientTimeout
 from asyncio import Lock
 from functools import wraps
 from dotenv import load_dotenv
-import re  # Add this import at the top if not already present
-from func.db_manager import DatabaseManager # Import DatabaseManager
+from func.auth_cache import AuthCache
+from func.ndjson import iter_ndjson
+from func.ollama_backends import OllamaBackend, select_backend
+from func.telegram_markdown import convert_markdown_for_telegram
 
 load_dotenv()
 token = os.getenv("TOKEN")
@@ -21,147 +25,343 @@ log_level_str = os.getenv("LOG_LEVEL", "INFO")
 allow_all_users_in_groups = bool(int(os.getenv("ALLOW_ALL_USERS_IN_GROUPS", "0")))
 log_levels = list(logging._levelToName.values())
 timeout = os.getenv("TIMEOUT", "3000")
+ollama_pool_limit = int(os.getenv("OLLAMA_POOL_LIMIT", "8"))
+ollama_keepalive_timeout = float(os.getenv("OLLAMA_KEEPALIVE_TIMEOUT", "60"))
+ollama_dns_cache_ttl = int(os.getenv("OLLAMA_DNS_CACHE_TTL", "300"))
+model_cache_ttl = float(os.getenv("MODEL_CACHE_TTL", "60"))
+# Comma separated host:port list; when unset the single OLLAMA_BASE_URL:OLLAMA_PORT backend is used
+ollama_backends = [address.strip() for address in os.getenv("OLLAMA_BACKENDS", "").split(",") if address.strip()]
+ollama_health_interval = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "15"))
+# Sent as keep_alive with every /api/chat request: a duration such as "30m", seconds, or -1 to keep models loaded
+ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
 if log_level_str not in log_levels:
     log_level = logging.DEBUG
 else:
     log_level = logging.getLevelName(log_level_str)
 logging.basicConfig(level=log_level)
 
+# Shared by perms_allowed / perms_admins; bound to the database in run.py
+auth_cache = AuthCache(admin_ids)
+
 class OllamaAPIClient:
-    def __init__(self, base_url, port):
+    def __init__(self, base_url, port, backends=None):
         self.base_url = base_url
         self.port = port
+        addresses = backends or ollama_backends or [f"{base_url}:{port}"]
+        self.backends = [OllamaBackend(address) for address in addresses]
+        self._health_task = None
+        self.last_request_at = {}  # model -> monotonic time of the last generation or preload
+        self._session = None
+        # hits = request served on a kept-alive connection, misses = new TCP connection opened
+        self.pool_stats = {"hits": 0, "misses": 0}
+        # Snapshot of /api/tags (name, size, details such as families), refreshed after model_cache_ttl
+        self._models = None
+        self._models_by_name = {}
+        self._models_fetched_at = 0.0
+        self._models_refresh = None
+        self._models_version = 0  # bumped by invalidate_models() so a refresh started before it is not trusted
+        self.model_cache_stats = {"hits": 0, "misses": 0, "refreshes": 0}
+
+    async def start(self):
+        """Open the shared session. Called once at bot startup."""
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit_per_host=ollama_pool_limit,
+            keepalive_timeout=ollama_keepalive_timeout,
+            ttl_dns_cache=ollama_dns_cache_ttl,
+            use_dns_cache=True,
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+        self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+        logging.info(
+            f"Ollama session opened (limit_per_host={ollama_pool_limit}, keepalive={ollama_keepalive_timeout}s, dns_ttl={ollama_dns_cache_ttl}s)"
+        )
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        """Close the shared session. Called from main() on shutdown."""
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logging.info(f"Ollama session closed. Pool stats: {self.pool_stats}")
+        self._session = None
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+    async def check_backend(self, backend):
+        """Poll /api/ps: marks the backend healthy or not and records which models it has loaded."""
+        session = await self._get_session()
+        try:
+            async with session.get(f"{backend.url}/api/ps", timeout=ClientTimeout(total=5)) as response:
+                if response.status != 200:
+                    raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+                data = await response.json()
+            backend.mark_healthy([model.get("name") or model.get("model") for model in data.get("models", [])])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if backend.healthy:
+                logging.warning(f"[Ollama] Backend {backend.name} failed its health check: {e}")
+            backend.mark_unhealthy(e)
+
+    async def check_backends(self):
+        await asyncio.gather(*[self.check_backend(backend) for backend in self.backends])
+
+    async def _health_loop(self):
+        while True:
+            await self.check_backends()
+            await asyncio.sleep(ollama_health_interval)
+
+    @staticmethod
+    def keep_alive():
+        try:
+            return int(ollama_keep_alive)
+        except ValueError:
+            return ollama_keep_alive
+
+    async def preload(self, modelname):
+        """
+        Load modelname on the backend generations for it are routed to, without generating anything.
+        Returns the seconds the load took (near zero when it was already resident).
+        """
+        session = await self._get_session()
+        backend = select_backend(self.backends, modelname)
+        # An empty message list makes Ollama load the model and return
+        ollama_payload = {"model": modelname, "messages": [], "stream": False, "keep_alive": self.keep_alive()}
+        started_at = time.monotonic()
+        self.last_request_at[modelname] = started_at
+        async with session.post(f"{backend.url}/api/chat", json=ollama_payload, timeout=ClientTimeout(total=int(timeout))) as response:
+            if response.status != 200:
+                raise RuntimeError(f"{backend.name}: {response.status} {await response.text()}")
+            await response.read()
+        backend.loaded_models.add(modelname)
+        return time.monotonic() - started_at
+
+    def backend_stats(self):
+        return [backend.stats() for backend in self.backends]
+
+    async def _on_connection_reused(self, session, trace_config_ctx, params):
+        self.pool_stats["hits"] += 1
+
+    async def _on_connection_created(self, session, trace_config_ctx, params):
+        self.pool_stats["misses"] += 1
 
     async def manage_model(self, action: str, model_name: str):
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{self.base_url}:{self.port}/api/{action}"
-            
-            if action == "pull":
-                # Use the exact payload structure from the curl example
-                data = json.dumps({"name": model_name})
-                headers = {
-                    'Content-Type': 'application/json'
-                }
-                logging.info(f"Pulling model: {model_name}")
+        session = await self._get_session()
+
+        if action == "pull":
+            last_progress = None
+            async for progress in self.pull_progress(model_name):
+                last_progress = progress
+            return last_progress
+        elif action == "delete":
+            data = json.dumps({"name": model_name})
+            headers = {
+                'Content-Type': 'application/json'
+            }
+            # Models are kept in sync across backends; the first failure (if any) is reported
+            result = None
+            try:
+                for backend in self.backends:
+                    async with session.delete(f"{backend.url}/api/delete", data=data, headers=headers) as response:
+                        if result is None or response.status != 200:
+                            result = response
+                        backend.loaded_models.discard(model_name)
+            finally:
+                self.invalidate_models()
+            return result
+        else:
+            logging.error(f"Unsupported model management action: {action}")
+            return None
+
+    async def pull_progress(self, model_name: str):
+        """
+        Pull a model, yielding Ollama's progress objects (status, digest, total, completed) as they stream in.
+        Raises RuntimeError when Ollama reports an error. Closing the generator aborts the download.
+        """
+        session = await self._get_session()
+        # Use the exact payload structure from the curl example
+        data = json.dumps({"name": model_name})
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        logging.info(f"Pulling model: {model_name}")
+        logging.info(f"Request Payload: {data}")
+
+        try:
+            # Every backend gets the model so any of them can serve it; with several, progress names the backend
+            for backend in self.backends:
+                url = f"{backend.url}/api/pull"
                 logging.info(f"Request URL: {url}")
-                logging.info(f"Request Payload: {data}")
-                
-                async with session.post(url, data=data, headers=headers) as response:
+                async with session.post(url, data=data, headers=headers, timeout=ClientTimeout(total=None)) as response:
                     logging.info(f"Pull model response status: {response.status}")
-                    response_text = await response.text()
-                    logging.info(f"Pull model response text: {response_text}")
-                    return response
-            elif action == "delete":
-                data = json.dumps({"name": model_name})
-                headers = {
-                    'Content-Type': 'application/json'
-                }
-                async with session.delete(url, data=data, headers=headers) as response:
-                    return response
-            else:
-                logging.error(f"Unsupported model management action: {action}")
-                return None
+                    if response.status != 200:
+                        raise RuntimeError(f"{backend.name}: {response.status} {await response.text()}")
+                    last_status = None
+                    async for progress in iter_ndjson(response):
+                        if "error" in progress:
+                            raise RuntimeError(f"{backend.name}: {progress['error']}" if len(self.backends) > 1 else progress["error"])
+                        if progress.get("status") != last_status:
+                            last_status = progress.get("status")
+                            logging.info(f"Pull model progress: {last_status}")
+                        if len(self.backends) > 1:
+                            progress = {**progress, "backend": backend.name}
+                        yield progress
+                    logging.info(f"Pull model final status: {last_status}")
+        finally:
+            self.invalidate_models()
+
+    def invalidate_models(self):
+        """Forget the model catalogue; the next model_list() fetches /api/tags again."""
+        self._models_fetched_at = 0.0
+        self._models_version += 1
+
+    async def _fetch_backend_models(self, session, backend):
+        try:
+            async with session.get(f"{backend.url}/api/tags") as response:
+                if response.status != 200:
+                    logging.error(f"Model list failed on {backend.name}: {response.status}")
+                    return None
+                data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # A slow backend is skipped like an unreachable one, the others still answer
+            logging.error(f"Model list failed on {backend.name}: {e!r}")
+            return None
+        models = data["models"]
+        backend.installed_models = {model["name"] for model in models}
+        return models
+
+    async def _fetch_models(self):
+        version = self._models_version
+        session = await self._get_session()
+        results = await asyncio.gather(*[self._fetch_backend_models(session, backend) for backend in self.backends])
+        if all(result is None for result in results):
+            # Keep serving the previous snapshot rather than an empty keyboard
+            return self._models or []
+        # One catalogue entry per model name, whichever backends have it
+        models_by_name = {}
+        for backend_models in results:
+            for model in backend_models or []:
+                models_by_name.setdefault(model["name"], model)
+        models = list(models_by_name.values())
+        self._models = models
+        self._models_by_name = models_by_name
+        if version == self._models_version:
+            self._models_fetched_at = time.monotonic()
+        self.model_cache_stats["refreshes"] += 1
+        return models
 
     async def model_list(self):
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{self.base_url}:{self.port}/api/tags"
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data["models"]
-                else:
-                    return []
-                
+        """Installed models from the cached catalogue, refreshed from /api/tags when older than model_cache_ttl."""
+        if self._models is not None and time.monotonic() - self._models_fetched_at < model_cache_ttl:
+            self.model_cache_stats["hits"] += 1
+            return self._models
+        self.model_cache_stats["misses"] += 1
+        # Callers that arrive during a refresh wait for it instead of starting their own
+        if self._models_refresh is None:
+            self._models_refresh = asyncio.ensure_future(self._fetch_models())
+            self._models_refresh.add_done_callback(self._refresh_done)
+        return await asyncio.shield(self._models_refresh)
+
+    def _refresh_done(self, task):
+        self._models_refresh = None
+
+    async def get_model(self, model_name):
+        """Catalogue entry of an installed model, or None."""
+        await self.model_list()
+        return self._models_by_name.get(model_name)
+
     async def generate(self, payload: dict, modelname: str, prompt: str, temperature: float = 0.7):
         client_timeout = ClientTimeout(total=int(timeout))
-        async with aiohttp.ClientSession(timeout=client_timeout) as session:
-            url = f"http://{self.base_url}:{self.port}/api/chat"
-
-            # Prepare the payload according to Ollama API specification
-            ollama_payload = {
-                "model": modelname,
-                "messages": payload.get("messages", []),
-                "stream": payload.get("stream", True),
-                "options": {"temperature": temperature}  # Add temperature to options
-            }
+        session = await self._get_session()
+        backend = select_backend(self.backends, modelname)
+        url = f"{backend.url}/api/chat"
 
-            try:
-                logging.info(f"Sending request to Ollama API: {url}")
-                logging.info(f"Payload: {json.dumps(ollama_payload, indent=2)}")
+        # Prepare the payload according to Ollama API specification
+        ollama_payload = {
+            "model": modelname,
+            "messages": payload.get("messages", []),
+            "stream": payload.get("stream", True),
+            "options": {"temperature": temperature},  # Add temperature to options
+            "keep_alive": self.keep_alive(),
+        }
+        self.last_request_at[modelname] = time.monotonic()
 
-                async with session.post(url, json=ollama_payload) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logging.error(f"API Error: {response.status} - {error_text}")
-                        raise aiohttp.ClientResponseError(
-                            request_info=response.request_info,
-                            history=response.history,
-                            status=response.status,
-                            message=f"API Error: {error_text}"
-                        )
-
-                    buffer = b""
-                    async for chunk in response.content.iter_any():
-                        buffer += chunk
-                        while b"\n" in buffer:
-                            line, buffer = buffer.split(b"\n", 1)
-                            line = line.strip()
-                            if line:
-                                try:
-                                    yield json.loads(line)
-                                except json.JSONDecodeError as e:
-                                    logging.error(f"JSON Decode Error: {e}")
-                                    logging.error(f"Problematic line: {line}")
-
-            except aiohttp.ClientError as e:
-                logging.error(f"Client Error during request: {e}")
-                raise
+        backend.begin_request(modelname)
+        try:
+            logging.info(f"Sending request to Ollama API: {url}")
+            # Summarize instead of dumping the payload, which holds the whole history and base64 images
+            image_count = sum(len(m.get("images") or []) for m in ollama_payload["messages"])
+            logging.info(f"Payload: model={modelname}, messages={len(ollama_payload['messages'])}, images={image_count}")
+            logging.debug(f"Last message: {ollama_payload['messages'][-1].get('content') if ollama_payload['messages'] else None}")
+
+            async with session.post(url, json=ollama_payload, timeout=client_timeout) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    logging.error(f"API Error: {response.status} - {error_text}")
+                    raise aiohttp.ClientResponseError(
+                        request_info=response.request_info,
+                        history=response.history,
+                        status=response.status,
+                        message=f"API Error: {error_text}"
+                    )
+
+                async for response_data in iter_ndjson(response):
+                    yield response_data
+
+        except aiohttp.ClientError as e:
+            logging.error(f"Client Error during request: {e}")
+            backend.record_error(e, connection_failed=isinstance(e, aiohttp.ClientConnectionError))
+            raise
+        finally:
+            backend.end_request()
 
 def perms_allowed(func):
     @wraps(func)
     async def wrapper(message: types.Message = None, query: types.CallbackQuery = None):
         user_id = message.from_user.id if message else query.from_user.id
         user_full_name = f"{message.from_user.first_name} {message.from_user.last_name}({message.from_user.id})" if message else f"{query.from_user.first_name} {query.from_user.last_name}({query.from_user.id})"
-        db_manager = DatabaseManager() # Instantiate DatabaseManager
-        try:
-            allowed_ids = db_manager.load_allowed_user_ids() # Use DatabaseManager method
-            admin_ids = list(map(int, os.getenv("ADMIN_IDS", "").split(","))) # admin_ids still loaded from env
-            if user_id in admin_ids:
-                logging.info(f"[PERMS_ALLOWED] {user_full_name} is allowed because they are an admin.")
-                if message:
-                    return await func(message)
-                elif query:
-                    return await func(query=query)
-            elif user_id in allowed_ids:
-                logging.info(f"[PERMS_ALLOWED] {user_full_name} is allowed because they are in allowed_ids.")
-                if message:
-                    return await func(message)
-                elif query:
-                    return await func(query=query)
-            else:
-                if message:
-                    if message and message.chat.type in ["supergroup", "group"]:
-                        if allow_all_users_in_groups:
-                            logging.info(f"[PERMS_ALLOWED] {user_full_name} is allowed in group '{message.chat.title}'({message.chat.id}) because ALLOW_ALL_USERS_IN_GROUPS is True.")
-                            return await func(message)
-                        else:
-                            logging.info(f"[PERMS_ALLOWED] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). ALLOW_ALL_USERS_IN_GROUPS is False and user is not in allowed_ids/admin_ids.")
-                            await message.answer("Access Denied")
-                            return
+        if auth_cache.is_admin(user_id):
+            logging.info(f"[PERMS_ALLOWED] {user_full_name} is allowed because they are an admin.")
+            if message:
+                return await func(message)
+            elif query:
+                return await func(query=query)
+        elif await auth_cache.is_allowed(user_id):
+            logging.info(f"[PERMS_ALLOWED] {user_full_name} is allowed because they are in allowed_ids.")
+            if message:
+                return await func(message)
+            elif query:
+                return await func(query=query)
+        else:
+            if message:
+                if message and message.chat.type in ["supergroup", "group"]:
+                    if allow_all_users_in_groups:
+                        logging.info(f"[PERMS_ALLOWED] {user_full_name} is allowed in group '{message.chat.title}'({message.chat.id}) because ALLOW_ALL_USERS_IN_GROUPS is True.")
+                        return await func(message)
                     else:
-                        logging.info(f"[PERMS_ALLOWED] {user_full_name} is denied in private chat. User is not in allowed_ids/admin_ids.")
+                        logging.info(f"[PERMS_ALLOWED] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). ALLOW_ALL_USERS_IN_GROUPS is False and user is not in allowed_ids/admin_ids.")
                         await message.answer("Access Denied")
                         return
-                elif query:
-                    if message and message.chat.type in ["supergroup", "group"]:
-                        logging.info(f"[PERMS_ALLOWED-QUERY] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). Queries are not allowed in groups.") # Queries are generally not expected in groups, so explicitly deny
-                        return # Do not answer, just ignore. Or maybe answer "Queries not allowed in groups" if needed.
-                    else:
-                        logging.info(f"[PERMS_ALLOWED-QUERY] {user_full_name} is denied in private chat query. User is not in allowed_ids/admin_ids.")
-                        await query.answer("Access Denied")
-                        return
-        finally:
-            db_manager.close_connection() # Close connection in finally block
+                else:
+                    logging.info(f"[PERMS_ALLOWED] {user_full_name} is denied in private chat. User is not in allowed_ids/admin_ids.")
+                    await message.answer("Access Denied")
+                    return
+            elif query:
+                if message and message.chat.type in ["supergroup", "group"]:
+                    logging.info(f"[PERMS_ALLOWED-QUERY] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). Queries are not allowed in groups.") # Queries are generally not expected in groups, so explicitly deny
+                    return # Do not answer, just ignore. Or maybe answer "Queries not allowed in groups" if needed.
+                else:
+                    logging.info(f"[PERMS_ALLOWED-QUERY] {user_full_name} is denied in private chat query. User is not in allowed_ids/admin_ids.")
+                    await query.answer("Access Denied")
+                    return
 
     return wrapper
 
@@ -171,38 +371,33 @@ def perms_admins(func):
     async def wrapper(message: types.Message = None, query: types.CallbackQuery = None):
         user_id = message.from_user.id if message else query.from_user.id
         user_full_name = f"{message.from_user.first_name} {message.from_user.last_name}({message.from_user.id})" if message else f"{query.from_user.first_name} {query.from_user.last_name}({query.from_user.id})"
-        db_manager = DatabaseManager() # Instantiate DatabaseManager
-        try:
-            admin_ids = list(map(int, os.getenv("ADMIN_IDS", "").split(","))) # admin_ids still loaded from env
-            if user_id in admin_ids:
-                logging.info(f"[PERMS_ADMINS] {user_full_name} is allowed because they are an admin.")
-                if message:
-                    return await func(message)
-                elif query:
-                    return await func(query=query)
-            else:
-                if message:
-                    if message and message.chat.type in ["supergroup", "group"]:
-                        logging.info(f"[PERMS_ADMINS] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). Admin permissions are not applicable in groups.") # Admin commands usually not relevant in groups
-                        return # Or maybe send "Admin commands not in groups"
-                    else:
-                        logging.info(f"[PERMS_ADMINS] {user_full_name} is denied in private chat. User is not in admin_ids.")
-                        await message.answer("Access Denied")
-                        logging.info(
-                            f"[MSG] {message.from_user.first_name} {message.from_user.last_name}({message.from_user.id}) is not allowed to use this bot."
-                        )
-                elif query:
-                    if message and message.chat.type in ["supergroup", "group"]:
-                        logging.info(f"[PERMS_ADMINS-QUERY] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). Admin queries are not applicable in groups.") # Admin commands usually not relevant in groups
-                        return # Or maybe send "Admin commands not in groups"
-                    else:
-                        logging.info(f"[PERMS_ADMINS-QUERY] {user_full_name} is denied in private chat query. User is not in admin_ids.")
-                        await query.answer("Access Denied")
-                        logging.info(
-                            f"[QUERY] {message.from_user.first_name} {message.from_user.last_name}({message.from_user.id}) is not allowed to use this bot."
-                        )
-        finally:
-            db_manager.close_connection() # Close connection in finally block
+        if auth_cache.is_admin(user_id):
+            logging.info(f"[PERMS_ADMINS] {user_full_name} is allowed because they are an admin.")
+            if message:
+                return await func(message)
+            elif query:
+                return await func(query=query)
+        else:
+            if message:
+                if message and message.chat.type in ["supergroup", "group"]:
+                    logging.info(f"[PERMS_ADMINS] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). Admin permissions are not applicable in groups.") # Admin commands usually not relevant in groups
+                    return # Or maybe send "Admin commands not in groups"
+                else:
+                    logging.info(f"[PERMS_ADMINS] {user_full_name} is denied in private chat. User is not in admin_ids.")
+                    await message.answer("Access Denied")
+                    logging.info(
+                        f"[MSG] {message.from_user.first_name} {message.from_user.last_name}({message.from_user.id}) is not allowed to use this bot."
+                    )
+            elif query:
+                if message and message.chat.type in ["supergroup", "group"]:
+                    logging.info(f"[PERMS_ADMINS-QUERY] {user_full_name} is denied in group '{message.chat.title}'({message.chat.id}). Admin queries are not applicable in groups.") # Admin commands usually not relevant in groups
+                    return # Or maybe send "Admin commands not in groups"
+                else:
+                    logging.info(f"[PERMS_ADMINS-QUERY] {user_full_name} is denied in private chat query. User is not in admin_ids.")
+                    await query.answer("Access Denied")
+                    logging.info(
+                        f"[QUERY] {message.from_user.first_name} {message.from_user.last_name}({message.from_user.id}) is not allowed to use this bot."
+                    )
 
     return wrapper
 
@@ -214,89 +409,3 @@ class contextLock:
 
     async def __aexit__(self, exc_type, exc_value, exc_traceback):
         self.lock.release()
-
-def convert_markdown_for_telegram(text, is_group=False):
-    """
-    Convert markdown text for Telegram into equivalent HTML formatting while escaping HTML special characters.
-    Converts non-empty <think> tags to monospace format, removes empty ones.
-    """
-
-    logging.debug(f"Converting markdown for Telegram: {text}")
-    
-    # First escape HTML special characters except those already in HTML tags
-    parts = re.split(r'(<[^>]*>)', text)
-    for i in range(0, len(parts), 2):  # Only escape non-tag parts
-        parts[i] = parts[i].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-    text = ''.join(parts)
-
-    # Remove "Marvin: " from the beginning of the text
-    text = re.sub(r'^Marvin: ', '', text)
-
-    # Remove the first set of matched double quotes, if present
-    text = re.sub(r'^"(.*?)"', r'\1', text, count=1)
-
-    # Remove entire <think> some text </think> block if in a group chat
-    if is_group:
-        text = re.sub(r'<think>(.*?)</think>', '', text, flags=re.DOTALL)
-        
-    # Remove empty think tags and convert non-empty ones to monospace
-    text = re.sub(r'<think>\s*</think>\s*', '', text)  # Remove empty think tags
-    text = re.sub(r'<think>(.*?)</think>',
-                 lambda m: f'<code>{m.group(1).strip().replace("<", "&lt;").replace(">", "&gt;")}</code >' if m.group(1).strip() else '',
-                 text, flags=re.DOTALL)
-
-    # Handle code blocks first to prevent other formatting inside them
-    def escape_code(match):
-        code = match.group(1) if len(match.groups()) == 1 else match.group(2)
-        # **Ensure HTML escaping within code blocks is robust**
-        code = code.replace('<', '&lt;').replace('>', '&gt;')
-        return f'<pre><code>{code}</code></pre>'
-
-    # Code blocks with language specification ```language
-    text = re.sub(r'```(\w+)\n(.*?)```', escape_code, text, flags=re.DOTALL)
-    # Regular code blocks ```
-    text = re.sub(r'```(.*?)```', escape_code, text, flags=re.DOTALL)
-    # Inline code `text`
-    text = re.sub(r'`(.*?)`', lambda m: f'<code>{m.group(1).replace("<", "&lt;").replace(">", "&gt;")}</code >', text)
-
-    # Other formatting
-    text = re.sub(r'(\*\*|__)(.*?)\1', lambda m: f'<b>{m.group(2)}</b>', text)
-    text = re.sub(r'(\*|_)(.*?)\1', lambda m: f'<i>{m.group(2)}</i>', text)
-    text = re.sub(r'~~(.*?)~~', lambda m: f'<s>{m.group(1)}</s>', text)
-    text = re.sub(r'__(.*?)__', lambda m: f'<u>{m.group(1)}</u>', text)
-    text = re.sub(r'\[(.*?)\]\((.*?)\)', lambda m: f'<a href="{m.group(2)}">{m.group(1)}</a>', text)
-    text = re.sub(r'\|\|(.*?)\|\|', lambda m: f'<tg-spoiler>{m.group(1)}</tg-spoiler>', text)
-    text = re.sub(r'^\s*[-*+]\s+(.+)$', r'• \1', text, flags=re.MULTILINE)
-    text = re.sub(r'^\s*>\s+(.+)$', r'<blockquote>\1</blockquote>', text, flags=re.MULTILINE)
-
-    # Clean up multiple blank lines
-    text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)
-    # Ensure no trailing blank lines
-    text = text.strip()
-
-    # Implement pagination here
-    MAX_MESSAGE_LENGTH = 4096
-    pages = []
-    current_page = ""
-    block_elements = re.split(r'(</p>|</div>|<pre>|</blockquote>|<ul>|<ol>)', text, flags=re.IGNORECASE) # Split by common block-level elements
-
-    for block in block_elements:
-        if not block:
-            continue
-
-        if len(current_page) + len(block) <= MAX_MESSAGE_LENGTH:
-            current_page += block
-        else:
-            pages.append(current_page)
-            current_page = block
-            while len(current_page) > MAX_MESSAGE_LENGTH: # Handle very long blocks by further splitting
-                split_point = current_page[:MAX_MESSAGE_LENGTH].rfind(' ') # Find last space to split at word boundary
-                if split_point == -1:
-                    split_point = MAX_MESSAGE_LENGTH # If no space, force split
-                pages.append(current_page[:split_point])
-                current_page = current_page[split_point:]
-
-    if current_page: # Add the last page
-        pages.append(current_page)
-
-    return pages
@@ -0,0 +1,195 @@
+import logging
+import os
+import time
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+# /metrics is only served when METRICS_PORT is set
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
+metrics_host = os.getenv("METRICS_HOST", "0.0.0.0")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+GENERATION_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+
+REGISTRY = []
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [*zip(labelnames, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+class Metric:
+    """A metric family in the Prometheus text exposition format. Label values are passed as keyword arguments."""
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Read the value from function() at scrape time (unlabelled gauges only)."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield self.name, (), (), self._function()
+            return
+        yield from super().samples()
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        bucket_counts = series[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                bucket_counts[index] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for key, (bucket_counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", key, (("le", _format_value(bound)),), cumulative
+            yield f"{self.name}_sum", key, (), total
+            yield f"{self.name}_count", key, (), count
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+time_to_first_token = Histogram(
+    "ollama_time_to_first_token_seconds", "Seconds from starting a generation to its first token.",
+    ("model", "chat_type"), GENERATION_BUCKETS,
+)
+time_to_first_visible_token = Histogram(
+    "telegram_time_to_first_visible_token_seconds",
+    "Seconds from receiving a message to posting the first streamed part of the reply.",
+    ("chat_type",), GENERATION_BUCKETS,
+)
+generation_seconds = Histogram(
+    "ollama_generation_seconds", "Duration of a generation as reported by Ollama, without the time spent loading the model.",
+    ("model", "chat_type"), GENERATION_BUCKETS,
+)
+model_load_seconds = Histogram(
+    "ollama_model_load_seconds", "Time Ollama spent loading the model, by what triggered it (chat type, warmup, switch or refresh).",
+    ("model", "source"), GENERATION_BUCKETS,
+)
+tokens_per_second = Histogram(
+    "ollama_tokens_per_second", "Generation speed, eval_count / eval_duration.",
+    ("model", "chat_type"), TOKENS_PER_SECOND_BUCKETS,
+)
+prompt_tokens = Counter("ollama_prompt_tokens_total", "Prompt tokens evaluated (prompt_eval_count).", ("model", "chat_type"))
+completion_tokens = Counter("ollama_completion_tokens_total", "Tokens generated (eval_count).", ("model", "chat_type"))
+telegram_request_seconds = Histogram(
+    "telegram_request_seconds", "Latency of Telegram Bot API calls.", ("method",),
+)
+sqlite_operation_seconds = Histogram(
+    "sqlite_operation_seconds", "Latency of database operations, including the wait for a worker thread.", ("operation",),
+)
+active_chat_count = Gauge("bot_active_chats", "Chats with a context in memory.")
+active_chat_bytes = Gauge("bot_active_chat_bytes", "Estimated bytes of the chat contexts in memory.")
+chat_hydrations = Counter("bot_chat_hydrations_total", "Chat contexts loaded from the database on first use.")
+chat_evictions = Counter("bot_chat_evictions_total", "Chat contexts dropped from memory, by reason (idle or memory).", ("reason",))
+chats_archived = Counter("bot_chats_archived_total", "Stored chat turns moved to the archive databases.")
+vacuumed_pages = Counter("bot_sqlite_vacuumed_pages_total", "Free database pages returned to the filesystem by incremental vacuum.")
+write_behind_pending = Gauge("bot_write_behind_pending", "Chat log rows, chat contexts and settings changes waiting to be written.")
+write_behind_flushes = Counter("bot_write_behind_flushes_total", "Transactions written by the write-behind queue.")
+write_behind_records = Counter("bot_write_behind_records_total", "Changes written by the write-behind queue.")
+in_flight_generations = Gauge("bot_in_flight_generations", "Generations currently running against Ollama.")
+queued_generations = Gauge("bot_queued_generations", "Generations waiting for the scheduler.")
+
+def chat_type_label(chat_type):
+    return "private" if chat_type == "private" else "group"
+
+def observe_generation(response_data, model, chat_type):
+    """Record the statistics Ollama returns with the final ("done") chunk of /api/chat."""
+    labels = {"model": model, "chat_type": chat_type_label(chat_type)}
+    load_duration = response_data.get("load_duration") or 0
+    if response_data.get("total_duration"):
+        generation_seconds.observe((response_data["total_duration"] - load_duration) / 1e9, **labels)
+    if load_duration:
+        model_load_seconds.observe(load_duration / 1e9, model=model, source=labels["chat_type"])
+    eval_count = response_data.get("eval_count")
+    if eval_count:
+        completion_tokens.inc(eval_count, **labels)
+        if response_data.get("eval_duration"):
+            tokens_per_second.observe(eval_count / (response_data["eval_duration"] / 1e9), **labels)
+    if response_data.get("prompt_eval_count"):
+        prompt_tokens.inc(response_data["prompt_eval_count"], **labels)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware timing every Bot API call by method."""
+
+    async def __call__(self, make_request, bot, method):
+        started_at = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started_at, method=type(method).__name__)
+
+async def _metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server(port=metrics_port, host=metrics_host):
+    """Serve /metrics on the running event loop. Returns the runner to clean up, or None when disabled."""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics served on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,151 @@
+import asyncio
+import html
+import logging
+import os
+import secrets
+import time
+from aiogram import types
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+# Seconds between edits of a pull's status message
+pull_status_interval = float(os.getenv("PULL_STATUS_INTERVAL", "3.0"))
+
+class PullJob:
+    """One running model download and the status messages that follow it."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        # Model names such as hf.co/<org>/<repo>:<quant> do not fit in the 64 bytes of a button's callback data,
+        # so the Cancel button names the job by this short random ID instead
+        self.job_id = secrets.token_urlsafe(6)
+        self.task = None
+        self.status_messages = []  # (chat_id, message_id)
+        self.user_ids = set()  # users who started or followed the pull; they and admins may cancel it
+        self.status = "starting"
+        self.backend = None  # set when pulling to several Ollama backends
+        self.completed = 0
+        self.total = 0
+        self.rate = 0.0  # bytes per second
+        self._rate_sample = None  # (monotonic time, completed bytes)
+
+    def record(self, progress):
+        status = progress.get("status", self.status)
+        backend = progress.get("backend", self.backend)
+        if status != self.status or backend != self.backend:
+            # Each layer is a new download, measure its rate from its own start
+            self._rate_sample = None
+        self.status = status
+        self.backend = backend
+        if progress.get("total"):
+            now = time.monotonic()
+            self.total = progress["total"]
+            self.completed = progress.get("completed", 0)
+            if self._rate_sample is None:
+                self._rate_sample = (now, self.completed)
+            elif now > self._rate_sample[0]:
+                sample_time, sample_completed = self._rate_sample
+                self.rate = (self.completed - sample_completed) / (now - sample_time)
+
+    def describe(self):
+        text = f"⬇️ Pulling <code>{html.escape(self.model_name)}</code>"
+        if self.backend:
+            text += f" on <code>{html.escape(self.backend)}</code>"
+        text += f"\n{html.escape(self.status)}"
+        if self.total and self.status.startswith("pulling"):
+            percent = self.completed * 100 / self.total
+            text += f"\n{percent:.1f}% of {self.total / 1e6:.0f} MB, {self.rate / 1e6:.1f} MB/s"
+        return text
+
+
+class ModelPullManager:
+    """
+    Runs /api/pull downloads as background jobs and reports their progress in Telegram.
+    Pulls of a model that is already downloading join the running job instead of starting another.
+    """
+
+    def __init__(self, bot, ollama_client, status_interval=pull_status_interval):
+        self.bot = bot
+        self.ollama_client = ollama_client
+        self.status_interval = status_interval
+        self.jobs = {}  # model_name -> PullJob
+
+    @staticmethod
+    def cancel_keyboard(job):
+        builder = InlineKeyboardBuilder()
+        builder.row(types.InlineKeyboardButton(text="Cancel", callback_data=f"cancelpull_{job.job_id}"))
+        return builder.as_markup()
+
+    def find(self, job_id):
+        """The running job with this ID, or None."""
+        return next((job for job in self.jobs.values() if job.job_id == job_id), None)
+
+    async def start(self, model_name, message):
+        """Start pulling model_name, or follow the pull already running, with a status message in message's chat."""
+        job = self.jobs.get(model_name)
+        new_job = job is None
+        if new_job:
+            job = self.jobs[model_name] = PullJob(model_name)
+        job.user_ids.add(message.from_user.id)
+        try:
+            status_message = await message.answer(
+                job.describe(), parse_mode=ParseMode.HTML, reply_markup=self.cancel_keyboard(job)
+            )
+        except Exception:
+            if new_job:
+                self.jobs.pop(model_name, None)
+            raise
+        job.status_messages.append((status_message.chat.id, status_message.message_id))
+        # Started only once the status message exists, so a pull that fails at once still reports it
+        if new_job:
+            job.task = asyncio.create_task(self._run(job))
+        return job
+
+    def may_cancel(self, job_id, user_id):
+        """Whether user_id started or followed the running pull with this job ID."""
+        job = self.find(job_id)
+        return job is not None and user_id in job.user_ids
+
+    def cancel(self, job_id):
+        """Abort a running pull. Returns False if there is none."""
+        job = self.find(job_id)
+        if job is None or job.task is None:
+            return False
+        job.task.cancel()
+        return True
+
+    async def _run(self, job):
+        next_update_at = time.monotonic() + self.status_interval
+        try:
+            async for progress in self.ollama_client.pull_progress(job.model_name):
+                job.record(progress)
+                if time.monotonic() >= next_update_at:
+                    await self._update(job, job.describe(), keep_cancel=True)
+                    next_update_at = time.monotonic() + self.status_interval
+            final_text = f"✅ Model <code>{html.escape(job.model_name)}</code> pulled."
+        except asyncio.CancelledError:
+            final_text = f"🚫 Pull of <code>{html.escape(job.model_name)}</code> cancelled."
+        except Exception as e:
+            logging.error(f"[Pull] {job.model_name} failed: {e}")
+            final_text = f"❌ Failed to pull <code>{html.escape(job.model_name)}</code>: {html.escape(str(e))}"
+        finally:
+            self.jobs.pop(job.model_name, None)
+        logging.info(f"[Pull] {job.model_name}: {final_text}")
+        await self._update(job, final_text, keep_cancel=False)
+
+    async def _update(self, job, text, keep_cancel):
+        reply_markup = self.cancel_keyboard(job) if keep_cancel else None
+        for chat_id, message_id in job.status_messages:
+            try:
+                await self.bot.edit_message_text(
+                    text=text,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=reply_markup,
+                )
+            except TelegramRetryAfter as e:
+                logging.warning(f"[Pull] Status update rate limited, next one in {e.retry_after}s")
+            except TelegramBadRequest as e:
+                logging.debug(f"[Pull] Status update skipped: {e}")
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from func.interactions import ollama_keep_alive
+from func.metrics import model_load_seconds
+
+DURATION_UNITS = {"ns": 1e-9, "us": 1e-6, "µs": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600}
+DURATION_PART = re.compile(r"(\d+(?:\.\d*)?|\.\d+)(ns|us|µs|ms|s|m|h)")
+
+def keep_alive_seconds(keep_alive):
+    """
+    Seconds Ollama keeps a model loaded for a keep_alive value: plain seconds or a Go duration such as "1h30m".
+    None when it never unloads (negative) or the value cannot be read.
+    """
+    value = str(keep_alive).strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        sign = -1 if value.startswith("-") else 1
+        body = value.lstrip("+-")
+        parts = DURATION_PART.findall(body)
+        if not parts or "".join(number + unit for number, unit in parts) != body:
+            return None
+        seconds = sign * sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+    return seconds if seconds >= 0 else None
+
+def default_refresh_interval(keep_alive=ollama_keep_alive):
+    seconds = keep_alive_seconds(keep_alive)
+    if seconds is None:
+        # The model is never unloaded (or the value is unknown), the refresh only reloads it after an Ollama restart
+        return 600.0
+    # Refresh halfway through keep_alive; with keep_alive 0 every model is unloaded right away and nothing helps
+    return seconds / 2
+
+# Seconds without any request for the selected model after which it is preloaded again, so Ollama's
+# keep_alive timer restarts before the model is unloaded (0 disables the refresh). Half of OLLAMA_KEEP_ALIVE by default
+model_refresh_interval = float(os.getenv("MODEL_REFRESH_INTERVAL") or default_refresh_interval())
+
+class ModelResidency:
+    """
+    Keeps the selected model loaded in Ollama: preloads it at startup and when it is switched, and reloads it
+    when it has been idle for refresh_interval seconds. get_model returns the currently selected model name.
+    """
+
+    def __init__(self, ollama_client, get_model, refresh_interval=model_refresh_interval):
+        self.ollama_client = ollama_client
+        self.get_model = get_model
+        self.refresh_interval = refresh_interval
+        keep_alive = keep_alive_seconds(ollama_keep_alive)
+        if refresh_interval > 0 and keep_alive and refresh_interval >= keep_alive:
+            logging.warning(
+                f"[Residency] MODEL_REFRESH_INTERVAL ({refresh_interval:g}s) is not shorter than OLLAMA_KEEP_ALIVE "
+                f"({ollama_keep_alive}), the model is unloaded before it is refreshed"
+            )
+        self.last_load = {}  # model -> seconds its last preload took
+        self._tasks = set()
+        self._refresh_task = None
+
+    async def warm(self, modelname, source="warmup"):
+        if not modelname:
+            return None
+        try:
+            seconds = await self.ollama_client.preload(modelname)
+        except Exception as e:
+            logging.warning(f"[Residency] Could not preload {modelname}: {e}")
+            return None
+        self.last_load[modelname] = seconds
+        model_load_seconds.observe(seconds, model=modelname, source=source)
+        logging.info(f"[Residency] {modelname} ready after {seconds:.2f}s ({source})")
+        return seconds
+
+    def schedule_warm(self, modelname, source="warmup"):
+        """Preload in the background; the caller does not wait for the model to load."""
+        task = asyncio.create_task(self.warm(modelname, source))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _refresh_loop(self):
+        while True:
+            modelname = self.get_model()
+            last_request_at = self.ollama_client.last_request_at.get(modelname, 0)
+            idle = time.monotonic() - last_request_at
+            if not modelname:
+                await asyncio.sleep(self.refresh_interval)
+            elif idle >= self.refresh_interval:
+                await self.warm(modelname, "refresh")
+            else:
+                await asyncio.sleep(self.refresh_interval - idle)
+
+    def start(self):
+        self.schedule_warm(self.get_model())
+        if self.refresh_interval > 0 and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self):
+        for task in (*self._tasks, self._refresh_task):
+            if task is not None:
+                task.cancel()
+        self._refresh_task = None
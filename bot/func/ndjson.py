@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _decode_errors = (orjson.JSONDecodeError, ValueError)
+except ImportError:  # orjson is optional, the standard library parser is used without it
+    orjson = None
+    _loads = json.loads
+    _decode_errors = (json.JSONDecodeError, ValueError)
+
+ndjson_max_line_bytes = int(os.getenv("NDJSON_MAX_LINE_BYTES", str(16 * 1024 * 1024)))
+
+class NDJSONDecoder:
+    """
+    Incremental newline-delimited JSON decoder for Ollama streams (/api/chat, /api/pull).
+    Chunks are appended to one bytearray and lines are located by offset, so the unread tail is never copied per line.
+    A line longer than max_line_bytes is discarded up to its newline instead of growing the buffer without bound.
+    """
+
+    def __init__(self, max_line_bytes=ndjson_max_line_bytes):
+        self.max_line_bytes = max_line_bytes
+        self._buffer = bytearray()
+        self._offset = 0  # start of the first unparsed line
+        self._scan_from = 0  # newlines before this position have been looked for already
+        self._discarding = False
+        self.discarded_lines = 0
+
+    def feed(self, chunk):
+        """Add a chunk of bytes and return the objects of every line it completes."""
+        buffer = self._buffer
+        buffer += chunk
+        objects = []
+        while True:
+            newline = buffer.find(b"\n", self._scan_from)
+            if newline == -1:
+                break
+            if self._discarding:
+                self._discarding = False
+            else:
+                self._parse(buffer, self._offset, newline, objects)
+            self._offset = self._scan_from = newline + 1
+
+        pending = len(buffer) - self._offset
+        if pending > self.max_line_bytes:
+            if not self._discarding:
+                logging.error(f"NDJSON line exceeds {self.max_line_bytes} bytes, discarding it")
+                self.discarded_lines += 1
+                self._discarding = True
+            self._offset = len(buffer)
+        self._scan_from = len(buffer)
+
+        # Drop consumed bytes once they make up most of the buffer, which keeps compaction amortized linear
+        if self._offset and self._offset * 2 >= len(buffer):
+            del buffer[:self._offset]
+            self._scan_from -= self._offset
+            self._offset = 0
+        return objects
+
+    def flush(self):
+        """Parse a final line that was not terminated by a newline."""
+        objects = []
+        if not self._discarding:
+            self._parse(self._buffer, self._offset, len(self._buffer), objects)
+        self._buffer.clear()
+        self._offset = self._scan_from = 0
+        self._discarding = False
+        return objects
+
+    def _parse(self, buffer, start, end, objects):
+        line = buffer[start:end]
+        if not line or line.isspace():
+            return
+        try:
+            objects.append(_loads(line))
+        except _decode_errors as e:
+            logging.error(f"JSON Decode Error: {e}")
+            logging.error(f"Problematic line: {line[:200]}")
+
+
+async def iter_ndjson(response, decoder=None):
+    """Yield the JSON objects of a streamed aiohttp response body as they arrive."""
+    decoder = decoder or NDJSONDecoder()
+    async for chunk in response.content.iter_any():
+        for obj in decoder.feed(chunk):
+            yield obj
+    for obj in decoder.flush():
+        yield obj
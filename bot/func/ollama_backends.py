@@ -0,0 +1,93 @@
+import os
+import time
+from func.metrics import Counter, Gauge
+
+# How many more running generations a backend with the model loaded may have than one that would first have to load it
+ollama_backend_spill = int(os.getenv("OLLAMA_BACKEND_SPILL", "4"))
+
+ollama_backend_requests = Counter("ollama_backend_requests_total", "Generations routed to each Ollama backend.", ("backend",))
+ollama_backend_errors = Counter("ollama_backend_errors_total", "Failed generations per Ollama backend.", ("backend",))
+ollama_backend_in_flight = Gauge("ollama_backend_in_flight", "Generations currently running on each Ollama backend.", ("backend",))
+ollama_backend_healthy = Gauge("ollama_backend_healthy", "1 if the backend passed its last health check.", ("backend",))
+
+class OllamaBackend:
+    """One Ollama server: its address, health, resident models and the generations currently running on it."""
+
+    def __init__(self, address):
+        self.name = address.split("://", 1)[-1].rstrip("/")
+        self.url = address.rstrip("/") if "://" in address else f"http://{self.name}"
+        # Assumed healthy until the first check says otherwise, so requests are not refused at startup
+        self.healthy = True
+        self.loaded_models = set()  # from /api/ps
+        self.installed_models = None  # from /api/tags; None until the catalogue was fetched
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+        self.checked_at = None
+        ollama_backend_healthy.set(1, backend=self.name)
+        ollama_backend_in_flight.set(0, backend=self.name)
+
+    def mark_healthy(self, loaded_models):
+        self.healthy = True
+        self.loaded_models = {model for model in loaded_models if model}
+        self.checked_at = time.monotonic()
+        ollama_backend_healthy.set(1, backend=self.name)
+
+    def mark_unhealthy(self, error):
+        self.healthy = False
+        self.loaded_models = set()
+        self.last_error = str(error)
+        self.checked_at = time.monotonic()
+        ollama_backend_healthy.set(0, backend=self.name)
+
+    def begin_request(self, model):
+        self.in_flight += 1
+        self.requests += 1
+        # Ollama loads the model to serve the request, so later requests for it should follow
+        self.loaded_models.add(model)
+        ollama_backend_requests.inc(backend=self.name)
+        ollama_backend_in_flight.set(self.in_flight, backend=self.name)
+
+    def end_request(self):
+        self.in_flight -= 1
+        ollama_backend_in_flight.set(self.in_flight, backend=self.name)
+
+    def record_error(self, error, connection_failed=False):
+        self.errors += 1
+        self.last_error = str(error)
+        ollama_backend_errors.inc(backend=self.name)
+        if connection_failed:
+            # Out of rotation until the next health check succeeds
+            self.mark_unhealthy(error)
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "loaded_models": sorted(self.loaded_models),
+            "last_error": self.last_error,
+        }
+
+def select_backend(backends, model, spill=ollama_backend_spill):
+    """
+    Least-loaded healthy backend that already has model resident. When there is none, or all of them are at least
+    spill generations busier than the alternative, the least-loaded healthy backend that has the model installed
+    (otherwise any healthy one) is used. When every backend is down the least-loaded is tried anyway.
+    """
+    candidates = [backend for backend in backends if backend.healthy] or backends
+    load = lambda backend: (backend.in_flight, backend.errors)
+    installed = [
+        backend for backend in candidates
+        if backend.installed_models is None or model in backend.installed_models
+    ]
+    fallback = min(installed or candidates, key=load)
+    resident = [backend for backend in candidates if model in backend.loaded_models]
+    if resident:
+        best = min(resident, key=load)
+        if best.in_flight - fallback.in_flight < spill:
+            return best
+    return fallback
@@ -0,0 +1,72 @@
+import hashlib
+import logging
+
+def prompt_hash(prompt):
+    """Key of a prompt's text, stored in system_prompts.prompt_hash."""
+    return hashlib.sha256((prompt or "").encode("utf-8")).hexdigest()
+
+class PromptRegistry:
+    """
+    In-memory cache of system prompts by ID and by text hash, in front of the system_prompts table.
+    Rows have the shape returned by get_system_prompts: (id, user_id, prompt, is_global, timestamp).
+    Lookups that found nothing are cached too; adding or deleting a prompt clears everything.
+    """
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_hash = {}
+        self._db_manager = None
+        self._version = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def bind(self, db_manager):
+        """Attach the database prompts are read from and listen for prompt changes."""
+        self._db_manager = db_manager
+        db_manager.add_prompts_listener(self.invalidate)
+        self.invalidate()
+
+    def invalidate(self):
+        self._by_id = {}
+        self._by_hash = {}
+        # Lookups still running against the database must not repopulate the cleared cache
+        self._version += 1
+        self.stats["invalidations"] += 1
+
+    async def get(self, prompt_id):
+        """The prompt row with this ID, or None."""
+        if prompt_id is None:
+            return None
+        if prompt_id in self._by_id:
+            self.stats["hits"] += 1
+            return self._by_id[prompt_id]
+        self.stats["misses"] += 1
+        version = self._version
+        row = await self._db_manager.get_system_prompt(prompt_id)
+        if version == self._version:
+            self._by_id[prompt_id] = row
+        return row
+
+    async def get_for_user(self, prompt_id, user_id):
+        """The prompt row if user_id may use it (their own prompts and those without an owner), else None."""
+        row = await self.get(prompt_id)
+        if row is None or row[1] not in (None, user_id):
+            return None
+        return row
+
+    async def find_by_text(self, prompt):
+        """The oldest prompt row with exactly this text, or None."""
+        key = prompt_hash(prompt)
+        if key in self._by_hash:
+            self.stats["hits"] += 1
+            return self._by_hash[key]
+        self.stats["misses"] += 1
+        version = self._version
+        # Hash collisions are not expected, comparing the text keeps the lookup exact anyway
+        rows = [row for row in await self._db_manager.find_system_prompts(key) if row[2] == prompt]
+        row = rows[0] if rows else None
+        if version == self._version:
+            self._by_hash[key] = row
+            if row is not None:
+                self._by_id[row[0]] = row
+        logging.debug(f"[PromptRegistry] Text lookup {key[:12]}: {'found ' + str(row[0]) if row else 'not found'}")
+        return row
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from func.metrics import chats_archived, vacuumed_pages
+
+# Stored turns older than this many days are moved out of users.db into the archive databases (0 keeps them forever)
+chat_retention_days = float(os.getenv("CHAT_RETENTION_DAYS", "0"))
+# Directory of the monthly archive databases (chats-YYYY-MM.db)
+archive_dir = os.getenv("ARCHIVE_DIR", "archive")
+# zlib-compress the archived message text
+archive_compress = os.getenv("ARCHIVE_COMPRESS", "0") == "1"
+# Seconds between retention runs
+retention_interval = float(os.getenv("RETENTION_INTERVAL", "3600"))
+# Rows moved per write, so other writes never wait long for the writer thread
+retention_batch = int(os.getenv("RETENTION_BATCH", "1000"))
+# Free pages returned to the filesystem per incremental vacuum step, and the pause between steps
+vacuum_step_pages = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+vacuum_step_pause = float(os.getenv("VACUUM_STEP_PAUSE", "0.5"))
+# Largest database (MB) switched to incremental vacuum on startup; the switch rewrites the file and blocks all writes
+# meanwhile, so larger ones are switched by an admin with /storage vacuum
+vacuum_convert_max_mb = float(os.getenv("VACUUM_CONVERT_MAX_MB", "64"))
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def archive_files(directory=archive_dir):
+    """(file name, size in bytes) of the archive databases, oldest month first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        (entry.name, entry.stat().st_size)
+        for entry in os.scandir(directory)
+        if entry.is_file() and entry.name.startswith("chats-") and entry.name.endswith(".db")
+    )
+
+class ChatRetention:
+    """
+    Periodically moves old chat turns into the archive databases and gives the freed space back in small
+    incremental vacuum steps. Does nothing while retention is off.
+    Every step is a short job on the database writer thread, with a pause in between, so the bot keeps
+    serving messages while a large backlog is worked through.
+    """
+
+    def __init__(self, db_manager, retention_days=chat_retention_days, interval=retention_interval):
+        self.db_manager = db_manager
+        self.retention_days = retention_days
+        self.interval = interval
+        self.last_run = None  # stats of the last run
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.retention_days > 0
+
+    def cutoff(self):
+        # The same format and time zone as CURRENT_TIMESTAMP in the chats table
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+        return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+    async def archive(self):
+        """Move every expired turn in batches. Returns the number of rows moved."""
+        cutoff = self.cutoff()
+        moved = 0
+        while True:
+            count = await self.db_manager.archive_chats(cutoff, retention_batch, archive_dir, archive_compress)
+            moved += count
+            chats_archived.inc(count)
+            if count < retention_batch:
+                return moved
+            await asyncio.sleep(vacuum_step_pause)
+
+    async def vacuum(self):
+        """Return the free pages to the filesystem step by step. Returns the number of pages freed."""
+        freed = 0
+        while True:
+            step, left = await self.db_manager.incremental_vacuum(vacuum_step_pages)
+            freed += step
+            vacuumed_pages.inc(step)
+            # Nothing freed means auto_vacuum is not INCREMENTAL (yet), further steps would not help either
+            if not left or not step:
+                return freed
+            await asyncio.sleep(vacuum_step_pause)
+
+    async def run_once(self):
+        moved = await self.archive()
+        freed = await self.vacuum()
+        self.last_run = {"at": datetime.now(timezone.utc), "archived": moved, "vacuumed_pages": freed}
+        logging.info(f"[Retention] Archived {moved} turns, vacuumed {freed} pages")
+        return self.last_run
+
+    async def _loop(self):
+        if await self.db_manager.enable_incremental_vacuum(max_bytes=vacuum_convert_max_mb * 1024 * 1024):
+            logging.info("[Retention] Database switched to incremental vacuum")
+        elif await self.db_manager.get_auto_vacuum() != 2:
+            logging.warning(
+                f"[Retention] Database is larger than {vacuum_convert_max_mb:g} MB and was not switched to incremental "
+                "vacuum, archived space is not given back until an admin runs /storage vacuum"
+            )
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"[Retention] Run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
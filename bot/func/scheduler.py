@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+ollama_max_concurrency = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+# Seconds a group message waits for follow-ups before its generation is queued
+group_coalesce_window = float(os.getenv("GROUP_COALESCE_WINDOW", "2.0"))
+
+class GenerationScheduler:
+    """
+    Admission control in front of Ollama generations.
+    At most max_concurrency jobs run at once and each chat_key has at most one in flight.
+    Jobs wait in a FIFO per chat, and chats with waiting jobs take turns (round-robin), so one busy
+    group cannot starve everyone else.
+    """
+
+    def __init__(self, max_concurrency=ollama_max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self._queues = {}  # chat_key -> deque of (job, future, enqueued_at)
+        self._ready = deque()  # chats with waiting jobs and nothing in flight, in serving order
+        self._in_flight = set()
+        self.stats = {"submitted": 0, "completed": 0, "queued": 0, "total_wait": 0.0, "last_wait": 0.0, "max_wait": 0.0}
+
+    @property
+    def queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def metrics(self):
+        waited = self.stats["queued"]
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "waiting_chats": len(self._queues),
+            "average_wait": self.stats["total_wait"] / waited if waited else 0.0,
+            **self.stats,
+        }
+
+    def position(self, chat_key, index):
+        """1-based place in the round-robin order of the job at index in the chat's queue."""
+        ahead = index
+        # Chats ahead of this one in the ring get one more turn before each of its turns than chats behind it
+        before = True
+        for other in self._ready:
+            if other == chat_key:
+                before = False
+                continue
+            ahead += min(len(self._queues[other]), index + (1 if before else 0))
+        # Chats with a job in flight rejoin the ring at the end
+        for other, queue in self._queues.items():
+            if other != chat_key and other in self._in_flight:
+                ahead += min(len(queue), index)
+        return ahead + 1
+
+    async def submit(self, chat_key, job, on_queued=None):
+        """
+        Run job() (a coroutine function) when the chat's turn comes and return its result.
+        on_queued(position) is awaited when the job cannot start right away.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_key, deque())
+        queue.append((job, future, time.monotonic()))
+        self.stats["submitted"] += 1
+        if len(queue) == 1 and chat_key not in self._in_flight:
+            self._ready.append(chat_key)
+        self._dispatch()
+
+        # The new job is the last of its queue, so it is still waiting exactly when the queue is
+        if on_queued is not None and self._queues.get(chat_key) is queue:
+            position = self.position(chat_key, len(queue) - 1)
+            try:
+                await on_queued(position)
+            except Exception as e:
+                logging.warning(f"[Scheduler] Queue notification failed for {chat_key}: {e}")
+        return await future
+
+    def _dispatch(self):
+        while self._ready and len(self._in_flight) < self.max_concurrency:
+            chat_key = self._ready.popleft()
+            queue = self._queues.get(chat_key)
+            while queue and queue[0][1].cancelled():
+                queue.popleft()
+            if not queue:
+                self._queues.pop(chat_key, None)
+                continue
+            job, future, enqueued_at = queue.popleft()
+            if not queue:
+                del self._queues[chat_key]
+            self._in_flight.add(chat_key)
+            asyncio.create_task(self._run(chat_key, job, future, enqueued_at))
+
+    async def _run(self, chat_key, job, future, enqueued_at):
+        waited = time.monotonic() - enqueued_at
+        self.stats["last_wait"] = waited
+        if waited > 0.01:
+            self.stats["queued"] += 1
+            self.stats["total_wait"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+            logging.info(f"[Scheduler] {chat_key} waited {waited:.2f}s, {self.queue_depth} jobs still queued")
+        try:
+            result = await job()
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.stats["completed"] += 1
+            self._in_flight.discard(chat_key)
+            if chat_key in self._queues:
+                self._ready.append(chat_key)
+            self._dispatch()
+
+
+class MessageCoalescer:
+    """
+    Folds bursts of group messages into one generation.
+    The first message of a burst waits window seconds and is then scheduled; every message that arrives
+    before that generation starts joins the burst instead of triggering a generation of its own.
+    """
+
+    def __init__(self, window=group_coalesce_window):
+        self.window = window
+        self._bursts = {}  # chat_key -> items of the burst that has not started yet
+        self.stats = {"bursts": 0, "coalesced_messages": 0, "saved_generations": 0}
+
+    async def add(self, chat_key, item, schedule):
+        """
+        Add item to the chat's open burst, or open a new one and await schedule(take).
+        take() closes the burst and returns its items; call it when the generation starts.
+        """
+        burst = self._bursts.get(chat_key)
+        if burst is not None:
+            burst.append(item)
+            self.stats["coalesced_messages"] += 1
+            self.stats["saved_generations"] += 1
+            return
+        burst = self._bursts[chat_key] = [item]
+        self.stats["bursts"] += 1
+
+        def take():
+            if self._bursts.get(chat_key) is burst:
+                del self._bursts[chat_key]
+            if len(burst) > 1:
+                logging.info(f"[Coalesce] {chat_key}: answering {len(burst)} messages with one generation")
+            return list(burst)
+
+        try:
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            await schedule(take)
+        finally:
+            # Never leave a burst open if scheduling failed before the generation started
+            if self._bursts.get(chat_key) is burst:
+                del self._bursts[chat_key]
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import os
+import time
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from func.metrics import chat_type_label, time_to_first_visible_token
+from func.telegram_markdown import MAX_MESSAGE_LENGTH, TelegramMarkdownRenderer, paginate_for_telegram
+
+# Telegram allows roughly one edit per second in a private chat and 20 messages per minute in a group
+stream_edit_interval_private = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+stream_edit_interval_group = float(os.getenv("STREAM_EDIT_INTERVAL_GROUP", "3.0"))
+
+class StreamingReply:
+    """
+    Progressively delivers a generation into one Telegram message.
+    A placeholder is posted with the first tokens, then edited at a throttled rate; finish() writes the formatted pages.
+    """
+
+    def __init__(self, bot, message, started_at, hide_thinking=False):
+        self.bot = bot
+        self.chat_id = message.chat.id
+        self.chat_type = chat_type_label(message.chat.type)
+        self.reply_to_message_id = message.message_id
+        self.started_at = started_at
+        self._renderer = TelegramMarkdownRenderer(is_group=hide_thinking)
+        self._fed = 0
+        self.edit_interval = stream_edit_interval_private if message.chat.type == "private" else stream_edit_interval_group
+        self.message_id = None
+        self._last_text = ""
+        self._next_edit_at = 0.0
+
+    def _visible_text(self, text):
+        # Only the part of the response that arrived since the last call is fed, the renderer keeps the rest
+        self._renderer.feed(text[self._fed:])
+        self._fed = len(text)
+        html = self._renderer.render()
+        if len(html) > MAX_MESSAGE_LENGTH:
+            # Keep the newest tokens in view; finish() spreads the full text over several messages
+            html = paginate_for_telegram(html)[-1]
+        return html
+
+    async def update(self, text):
+        """Show the partial response, posting the placeholder on first call and editing no faster than edit_interval."""
+        now = time.monotonic()
+        if now < self._next_edit_at:
+            return
+        visible = self._visible_text(text)
+        if not visible or visible == self._last_text:
+            return
+        try:
+            if self.message_id is None:
+                sent = await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=visible,
+                    parse_mode=ParseMode.HTML,
+                    reply_to_message_id=self.reply_to_message_id,
+                )
+                self.message_id = sent.message_id
+                ttfvt = time.monotonic() - self.started_at
+                time_to_first_visible_token.observe(ttfvt, chat_type=self.chat_type)
+                logging.info(f"[Stream] Time to first visible token: {ttfvt:.2f}s in chat {self.chat_id}")
+            else:
+                await self.bot.edit_message_text(
+                    text=visible,
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    parse_mode=ParseMode.HTML,
+                )
+            self._last_text = visible
+            self._next_edit_at = time.monotonic() + self.edit_interval
+        except TelegramRetryAfter as e:
+            logging.warning(f"[Stream] Edit rate limited in chat {self.chat_id}, retrying after {e.retry_after}s")
+            self._next_edit_at = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            logging.debug(f"[Stream] Edit skipped in chat {self.chat_id}: {e}")
+
+    async def finish(self, pages):
+        """Replace the placeholder with the first formatted page and send any remaining pages as new messages."""
+        if self.message_id is None:
+            for page_text in pages:
+                await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=page_text,
+                    parse_mode=ParseMode.HTML,
+                    reply_to_message_id=self.reply_to_message_id,
+                )
+            return
+        first_page, remaining_pages = pages[0], pages[1:]
+        try:
+            await self._final_edit(first_page)
+        except TelegramRetryAfter as e:
+            # The final edit carries the formatted text, so wait out the rate limit instead of dropping it
+            await asyncio.sleep(e.retry_after)
+            await self._final_edit(first_page)
+        for page_text in remaining_pages:
+            await self.bot.send_message(
+                chat_id=self.chat_id,
+                text=page_text,
+                parse_mode=ParseMode.HTML,
+                reply_to_message_id=self.reply_to_message_id,
+            )
+
+    async def _final_edit(self, text):
+        try:
+            await self.bot.edit_message_text(
+                text=text,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                parse_mode=ParseMode.HTML,
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
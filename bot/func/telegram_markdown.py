@@ -0,0 +1,411 @@
+import logging
+import re
+
+MAX_MESSAGE_LENGTH = 4096
+
+_html_special = re.compile(r'<[^>]*>|[&<>]')
+_html_escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+_block_elements = re.compile(r'(</p>|</div>|<pre>|</blockquote>|<ul>|<ol>)', re.IGNORECASE)
+
+_THINK_OPEN = "<think>"
+_THINK_CLOSE = "</think>"
+_FENCE = "```"
+_WHITESPACE = " \t\n\r\f\v"
+_BULLET_MARKERS = "-*+"
+
+# Delimiter pairs of the inline constructs: opener -> (closer, opening tag, closing tag)
+_INLINE_PAIRS = {
+    "**": ("**", "<b>", "</b>"),
+    "__": ("__", "<b>", "</b>"),
+    "*": ("*", "<i>", "</i>"),
+    "_": ("_", "<i>", "</i>"),
+    "~~": ("~~", "<s>", "</s>"),
+    "||": ("||", "<tg-spoiler>", "</tg-spoiler>"),
+}
+_inline_start = re.compile(r'[*_~\[|<]')
+_non_whitespace = re.compile(r'\S')
+_CODE_PLACEHOLDER = "\ue000"
+
+
+def _escape_html(text):
+    """Escape &, < and > outside of anything that already looks like an HTML tag."""
+    return _html_special.sub(lambda m: _html_escapes.get(m.group(0), m.group(0)), text)
+
+
+def _escape_code(code):
+    return code.replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _strip_prefixes(text):
+    """Remove a leading "Marvin: " and the first pair of double quotes on the first line."""
+    if text.startswith("Marvin: "):
+        text = text[8:]
+    if text.startswith('"'):
+        line_end = text.find('\n')
+        closing = text.find('"', 1, len(text) if line_end == -1 else line_end)
+        if closing != -1:
+            text = text[1:closing] + text[closing + 1:]
+    return text
+
+
+class _Finder:
+    """
+    Bounded str.find that remembers its last answer per needle.
+    Repeated searches never rescan the same span, so unbalanced markers keep the scan linear.
+    """
+
+    def __init__(self, text, end):
+        self.text = text
+        self.end = end
+        self._last = {}
+
+    def find(self, needle, start):
+        last = self._last.get(needle)
+        if last is not None:
+            last_start, last_pos = last
+            if last_start <= start and (last_pos == -1 or start <= last_pos):
+                return last_pos
+        pos = self.text.find(needle, start, self.end)
+        self._last[needle] = (start, pos)
+        return pos
+
+    def find_single(self, ch, start):
+        """Like find(ch, start), but skips ch that is part of a doubled delimiter such as __ or **."""
+        key = (ch,)
+        last = self._last.get(key)
+        if last is not None:
+            last_start, last_pos = last
+            if last_start <= start and (last_pos == -1 or start <= last_pos):
+                return last_pos
+        text = self.text
+        pos = text.find(ch, start, self.end)
+        while pos != -1 and (text[pos - 1:pos] == ch or text[pos + 1:pos + 2] == ch):
+            pos = text.find(ch, pos + 1, self.end)
+        self._last[key] = (start, pos)
+        return pos
+
+
+def _render_inline(text, start, end):
+    """Render bold, italic, strikethrough, links and spoilers inside text[start:end] (a single line)."""
+    match = _inline_start.search(text, start, end)
+    if match is None:
+        return text[start:end]
+    out = []
+    finder = _Finder(text, end)
+    plain_start = start
+    while match is not None:
+        i = match.start()
+        ch = text[i]
+
+        rendered = None
+        if ch == '[':
+            middle = finder.find('](', i + 1)
+            if middle != -1:
+                closing = finder.find(')', middle + 2)
+                if closing != -1:
+                    url = text[middle + 2:closing]
+                    rendered = f'<a href="{url}">{_render_inline(text, i + 1, middle)}</a>'
+                    next_i = closing + 1
+        elif ch == '<':
+            # Tags that survived escaping are passed through untouched
+            closing = finder.find('>', i + 1)
+            if closing != -1:
+                match = _inline_start.search(text, closing + 1, end)
+                continue
+        else:
+            pair = text[i:i + 2]
+            openers = (pair, ch) if pair in _INLINE_PAIRS else (ch,)
+            for opener in openers:
+                if opener not in _INLINE_PAIRS:
+                    continue
+                closer, open_tag, close_tag = _INLINE_PAIRS[opener]
+                content_start = i + len(opener)
+                if len(opener) == 1:
+                    # __ and ** bind first, as in the previous converter, so foo_bar __init__ keeps its bold
+                    closing = finder.find_single(closer, content_start)
+                else:
+                    closing = finder.find(closer, content_start)
+                if closing != -1:
+                    rendered = f'{open_tag}{_render_inline(text, content_start, closing)}{close_tag}'
+                    next_i = closing + len(closer)
+                    break
+
+        if rendered is None:
+            match = _inline_start.search(text, i + 1, end)
+            continue
+        out.append(text[plain_start:i])
+        out.append(rendered)
+        plain_start = next_i
+        match = _inline_start.search(text, next_i, end)
+    out.append(text[plain_start:end])
+    return ''.join(out)
+
+
+def _render_line(text, start, end):
+    """Render one line. Inline code binds tightest, so code spans are cut out before the other constructs."""
+    tick = text.find('`', start, end)
+    if tick == -1 or text.find(_CODE_PLACEHOLDER, start, end) != -1:
+        return _render_inline(text, start, end)
+    parts = []
+    code_spans = []
+    i = start
+    while tick != -1:
+        closing = text.find('`', tick + 1, end)
+        if closing == -1:
+            break
+        parts.append(text[i:tick])
+        parts.append(_CODE_PLACEHOLDER)
+        code_spans.append(f'<code>{_escape_code(text[tick + 1:closing])}</code >')
+        i = closing + 1
+        tick = text.find('`', i, end)
+    parts.append(text[i:end])
+    line = ''.join(parts)
+    pieces = _render_inline(line, 0, len(line)).split(_CODE_PLACEHOLDER)
+    out = [pieces[0]]
+    for code, piece in zip(code_spans, pieces[1:]):
+        out.append(code)
+        out.append(piece)
+    return ''.join(out)
+
+
+def _skip_whitespace(text, i, end):
+    match = _non_whitespace.search(text, i, end)
+    return end if match is None else match.start()
+
+
+def _match_bullet(text, i, end, block_follows=False):
+    """
+    Match a list marker at a line start (swallowing preceding blank lines). Returns the end position or -1.
+    With block_follows, a marker at the end of the span takes the code or think block after it as its content.
+    """
+    marker = _skip_whitespace(text, i, end)
+    if marker >= end or text[marker] not in _BULLET_MARKERS:
+        return -1
+    content = _skip_whitespace(text, marker + 1, end)
+    if content == marker + 1:
+        return -1
+    if content >= end:
+        return end if block_follows else -1
+    return content
+
+
+def _render_text(text, start, end, at_line_start, block_follows=False):
+    """
+    Render a span of text that holds no code blocks: bullets, blank-line collapsing and inline formatting.
+    block_follows tells that a rendered code or think block comes right after the span.
+    """
+    out = []
+    i = start
+    while i < end:
+        if at_line_start or (i > start and text[i - 1] == '\n'):
+            at_line_start = False
+            bullet_end = _match_bullet(text, i, end, block_follows)
+            if bullet_end != -1:
+                out.append('• ')
+                i = bullet_end
+                continue
+        if text[i] == '\n':
+            # Three or more line breaks (with any whitespace between) collapse to one blank line,
+            # unless a list follows, in which case the bullet swallows the blank lines instead.
+            run_end = _skip_whitespace(text, i, end)
+            last_newline = text.rfind('\n', i, run_end)
+            if text.count('\n', i, run_end) >= 3 and _match_bullet(text, last_newline + 1, end, block_follows) == -1:
+                out.append('\n\n')
+                i = last_newline + 1
+            else:
+                out.append('\n')
+                i += 1
+            continue
+        line_end = text.find('\n', i, end)
+        if line_end == -1:
+            line_end = end
+        out.append(_render_line(text, i, line_end))
+        i = line_end
+    return ''.join(out)
+
+
+def _render(text, is_group, final):
+    """
+    Render already escaped text in one left-to-right scan.
+    When final is False, an unterminated code block or <think> section at the end is rendered as if it were closed.
+    """
+    out = []
+    text_parts = []
+    at_line_start = True
+    i = 0
+    n = len(text)
+    finder = _Finder(text, n)
+
+    def flush_text(block_follows=False):
+        nonlocal at_line_start
+        if text_parts:
+            joined = ''.join(text_parts)
+            out.append(_render_text(joined, 0, len(joined), at_line_start, block_follows))
+            text_parts.clear()
+        at_line_start = False
+
+    while i < n:
+        think = finder.find(_THINK_OPEN, i)
+        fence = finder.find(_FENCE, i)
+        if think == -1 and fence == -1:
+            text_parts.append(text[i:])
+            break
+
+        if think != -1 and (fence == -1 or think < fence):
+            content_start = think + len(_THINK_OPEN)
+            closing = finder.find(_THINK_CLOSE, content_start)
+            if closing == -1 and final:
+                # An unterminated <think> is left as it is
+                text_parts.append(text[i:content_start])
+                i = content_start
+                continue
+            block_end = n if closing == -1 else closing + len(_THINK_CLOSE)
+            content = text[content_start:closing if closing != -1 else n]
+            text_parts.append(text[i:think])
+            if is_group:
+                i = block_end
+            elif content.strip():
+                flush_text(block_follows=True)
+                out.append(f'<code>{_escape_code(content.strip())}</code >')
+                i = block_end
+            else:
+                # Empty think sections disappear together with the whitespace after them
+                i = _skip_whitespace(text, block_end, n)
+            continue
+
+        content_start = fence + len(_FENCE)
+        lang_end = content_start
+        while lang_end < n and (text[lang_end].isalnum() or text[lang_end] == '_'):
+            lang_end += 1
+        if lang_end > content_start and lang_end < n and text[lang_end] == '\n':
+            content_start = lang_end + 1
+        closing = finder.find(_FENCE, content_start)
+        if closing == -1 and final:
+            # An unterminated fence is left as it is
+            text_parts.append(text[i:fence + len(_FENCE)])
+            i = fence + len(_FENCE)
+            continue
+        text_parts.append(text[i:fence])
+        flush_text(block_follows=True)
+        code = text[content_start:closing if closing != -1 else n]
+        out.append(f'<pre><code>{_escape_code(code)}</code></pre>')
+        i = n if closing == -1 else closing + len(_FENCE)
+
+    flush_text()
+    return ''.join(out)
+
+
+class TelegramMarkdownRenderer:
+    """
+    Incremental Markdown -> Telegram HTML renderer.
+    Text is appended with feed(); everything up to the last paragraph break that closes all open constructs is
+    rendered once and kept, so each render() only re-renders the new tail.
+    """
+
+    def __init__(self, is_group=False):
+        self.is_group = is_group
+        self._chunks = []
+        self._source = ""
+        self._committed_source = 0
+        self._committed_html = []
+
+    def feed(self, text):
+        if text:
+            self._chunks.append(text)
+
+    def _pull_chunks(self):
+        if self._chunks:
+            self._source += ''.join(self._chunks)
+            self._chunks.clear()
+
+    def _render_segment(self, start, end, final):
+        segment = _escape_html(self._source[start:end])
+        if start == 0:
+            segment = _strip_prefixes(segment)
+        return _render(segment, self.is_group, final)
+
+    def _find_commit_point(self):
+        """Last paragraph break in the pending source after which no code block, think section or tag is open."""
+        source = self._source
+        start = self._committed_source
+        search_end = len(source)
+        while True:
+            brk = source.rfind('\n\n', start, search_end)
+            if brk == -1:
+                return -1
+            cut = brk + 2
+            search_end = brk
+            if cut >= len(source) or source[cut] in _WHITESPACE or source[cut] in _BULLET_MARKERS:
+                continue
+            if _THINK_OPEN.startswith(source[cut:cut + len(_THINK_OPEN)]):
+                # The think section may be removed, joining the blank lines around it
+                continue
+            last = brk
+            while last > start and source[last - 1] in _WHITESPACE:
+                last -= 1
+            before = source[max(start, last - len(_THINK_CLOSE)):last]
+            if before[-1:] in tuple(_BULLET_MARKERS):
+                # A bare list marker takes the next paragraph as its content
+                continue
+            if before.endswith(_THINK_CLOSE):
+                # An empty think section swallows the whitespace after it
+                continue
+            if source.count(_FENCE, start, cut) % 2:
+                continue
+            if source.count(_THINK_OPEN, start, cut) != source.count(_THINK_CLOSE, start, cut):
+                continue
+            last_open = source.rfind('<', start, cut)
+            if last_open != -1 and source.find('>', last_open, cut) == -1:
+                continue
+            return cut
+
+    def render(self, final=False):
+        """Return the HTML for everything fed so far."""
+        self._pull_chunks()
+        cut = self._find_commit_point()
+        if cut != -1:
+            self._committed_html.append(self._render_segment(self._committed_source, cut, True))
+            self._committed_source = cut
+        tail = self._render_segment(self._committed_source, len(self._source), final)
+        return (''.join(self._committed_html) + tail).strip()
+
+
+def paginate_for_telegram(text):
+    """Split rendered HTML into pages that fit in one Telegram message, preferring block boundaries."""
+    pages = []
+    current_page = ""
+    block_elements = _block_elements.split(text) # Split by common block-level elements
+
+    for block in block_elements:
+        if not block:
+            continue
+
+        if len(current_page) + len(block) <= MAX_MESSAGE_LENGTH:
+            current_page += block
+        else:
+            pages.append(current_page)
+            current_page = block
+            while len(current_page) > MAX_MESSAGE_LENGTH: # Handle very long blocks by further splitting
+                split_point = current_page[:MAX_MESSAGE_LENGTH].rfind(' ') # Find last space to split at word boundary
+                if split_point == -1:
+                    split_point = MAX_MESSAGE_LENGTH # If no space, force split
+                pages.append(current_page[:split_point])
+                current_page = current_page[split_point:]
+
+    if current_page: # Add the last page
+        pages.append(current_page)
+
+    return pages
+
+
+def convert_markdown_for_telegram(text, is_group=False):
+    """
+    Convert markdown text for Telegram into equivalent HTML formatting while escaping HTML special characters.
+    Converts non-empty <think> tags to monospace format, removes empty ones.
+    """
+
+    logging.debug("Converting markdown for Telegram: %s", text)
+
+    renderer = TelegramMarkdownRenderer(is_group)
+    renderer.feed(text)
+    return paginate_for_telegram(renderer.render(final=True))
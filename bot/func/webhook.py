@@ -0,0 +1,107 @@
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+from aiogram import types
+from aiohttp import web
+from func.metrics import Counter, Gauge
+
+# BOT_MODE=webhook makes Telegram push updates to WEBHOOK_URL + WEBHOOK_PATH instead of the bot polling for them
+bot_mode = os.getenv("BOT_MODE", "polling").lower()
+webhook_url = os.getenv("WEBHOOK_URL", "")
+webhook_path = os.getenv("WEBHOOK_PATH", "/webhook")
+webhook_host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+webhook_port = int(os.getenv("WEBHOOK_PORT", "8080"))
+webhook_secret = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+webhook_queue_size = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+webhook_workers = int(os.getenv("WEBHOOK_WORKERS", "32"))
+# Seconds a delivery may wait for room in a full queue before Telegram is asked to retry it later
+webhook_intake_timeout = float(os.getenv("WEBHOOK_INTAKE_TIMEOUT", "5"))
+# Discard the updates Telegram queued while the bot was down instead of answering them after a restart
+webhook_drop_pending = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"
+
+webhook_updates = Counter("webhook_updates_total", "Webhook deliveries by outcome.", ("result",))
+webhook_queue_depth = Gauge("webhook_queue_depth", "Updates received by the webhook and not yet handled.")
+
+class WebhookServer:
+    """
+    Receives updates over HTTPS from Telegram and feeds them to the dispatcher.
+    Deliveries are acknowledged once queued; a fixed pool of workers handles them. Handlers only queue
+    generations and return, so the workers are never held up by Ollama. When the queue stays full,
+    deliveries are answered with 503 so Telegram backs off and retries instead of the bot buffering without bound.
+    """
+
+    def __init__(self, bot, dp, secret=webhook_secret, queue_size=webhook_queue_size, workers=webhook_workers,
+                 intake_timeout=webhook_intake_timeout):
+        self.bot = bot
+        self.dp = dp
+        self.secret = secret
+        self.workers = max(1, workers)
+        self.intake_timeout = intake_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._worker_tasks = []
+        self._runner = None
+        webhook_queue_depth.set_function(self.queue.qsize)
+
+    async def handle(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            webhook_updates.inc(result="unauthorized")
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError as e:
+            logging.warning(f"[Webhook] Invalid update: {e}")
+            webhook_updates.inc(result="invalid")
+            return web.Response(status=400)
+        try:
+            await asyncio.wait_for(self.queue.put(update), self.intake_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"[Webhook] Intake queue full ({self.queue.maxsize}), asking Telegram to retry update {update.update_id}")
+            webhook_updates.inc(result="backpressure")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        webhook_updates.inc(result="accepted")
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logging.error(f"[Webhook] Update {update.update_id} failed: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, url=webhook_url, path=webhook_path, host=webhook_host, port=webhook_port):
+        """Start the workers and the HTTP server, then register url + path with Telegram."""
+        if not url:
+            raise ValueError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        await self.bot.set_webhook(
+            url=url.rstrip("/") + path,
+            secret_token=self.secret,
+            allowed_updates=self.dp.resolve_used_update_types(),
+            drop_pending_updates=webhook_drop_pending,
+        )
+        logging.info(f"Webhook listening on {host}:{port}{path} ({self.workers} workers, queue {self.queue.maxsize})")
+
+    async def stop(self, drain_timeout=10):
+        """Stop accepting updates, give queued ones drain_timeout seconds to finish, then stop the workers."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"[Webhook] {self.queue.qsize()} queued updates dropped on shutdown")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+from func.metrics import write_behind_flushes, write_behind_pending, write_behind_records
+
+# Longest time a change waits in memory before it is written; this is what a crash can lose (0 writes at once)
+write_behind_interval = float(os.getenv("WRITE_BEHIND_INTERVAL_MS", "250")) / 1000
+# Queued changes that trigger a write before the interval is over
+write_behind_max_records = int(os.getenv("WRITE_BEHIND_MAX_RECORDS", "100"))
+# Seconds a SIGINT/SIGTERM shutdown waits for the queued changes to be written
+shutdown_drain_timeout = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "10"))
+
+class WriteBehind:
+    """
+    Collects chat log rows, changed chat contexts and global settings changes in memory and writes them
+    together, in one transaction, every interval seconds or once max_records changes are queued.
+    A chat changed several times in between is written once, from its latest state.
+    get_settings returns the (modelname, selected_prompt_id, default_temperature) to store.
+    """
+
+    def __init__(self, db_manager, active_chats, get_settings, interval=write_behind_interval,
+                 max_records=write_behind_max_records):
+        self.db_manager = db_manager
+        self.active_chats = active_chats
+        self.get_settings = get_settings
+        self.interval = interval
+        self.max_records = max_records
+        self._chat_rows = []
+        self._dirty_chats = set()
+        self._settings_dirty = False
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.stats = {"flushes": 0, "records": 0, "failures": 0}
+        write_behind_pending.set_function(lambda: self.pending)
+
+    @property
+    def pending(self):
+        return len(self._chat_rows) + len(self._dirty_chats) + int(self._settings_dirty)
+
+    def _queued(self):
+        if self.interval <= 0 or self.pending >= self.max_records:
+            self._wakeup.set()
+
+    def log_message(self, user_id, role, content, chat_key=None):
+        """Queue a row for the chats table."""
+        self._chat_rows.append((user_id, role, content, chat_key))
+        self._queued()
+
+    def mark_chat(self, chat_key):
+        """Queue a save of the chat's context, taken from ActiveChats when it is written."""
+        self._dirty_chats.add(chat_key)
+        self._queued()
+
+    def discard_chat(self, chat_key):
+        """Forget a queued save, e.g. when the chat is reset."""
+        self._dirty_chats.discard(chat_key)
+
+    def mark_settings(self):
+        self._settings_dirty = True
+        self._queued()
+
+    async def flush(self):
+        """Write everything queued so far. Returns the number of changes written."""
+        async with self._flush_lock:
+            chat_rows, self._chat_rows = self._chat_rows, []
+            chat_keys, self._dirty_chats = self._dirty_chats, set()
+            settings = self.get_settings() if self._settings_dirty else None
+            self._settings_dirty = False
+            if not chat_rows and not chat_keys and settings is None:
+                return 0
+            # Evicted chats were saved when they were dropped from memory, and reset chats are gone
+            contexts = await self.active_chats.snapshot(chat_keys)
+            try:
+                await self.db_manager.write_batch(chat_rows, settings, contexts)
+            except Exception:
+                # Keep the changes for the next attempt, in their original order
+                self._chat_rows[:0] = chat_rows
+                self._dirty_chats |= chat_keys
+                self._settings_dirty = self._settings_dirty or settings is not None
+                self.stats["failures"] += 1
+                raise
+            records = len(chat_rows) + len(contexts) + int(settings is not None)
+            self.stats["flushes"] += 1
+            self.stats["records"] += records
+            write_behind_flushes.inc()
+            write_behind_records.inc(records)
+            return records
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval if self.interval > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"[WriteBehind] Writing {self.pending} queued changes failed, retrying: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def drain(self, timeout=shutdown_drain_timeout):
+        """
+        Stop the periodic writes and write everything still queued, plus the contexts of all chats in memory.
+        Gives up after timeout seconds; returns the number of changes that could not be written.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._dirty_chats.update(await self.active_chats.get_all())
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"[WriteBehind] Shutdown drain timed out after {timeout}s, {self.pending} changes not written")
+        except Exception as e:
+            logging.error(f"[WriteBehind] Shutdown drain failed, {self.pending} changes not written: {e}")
+        else:
+            logging.info("[WriteBehind] All queued changes written")
+        return self.pending
@@ -1,28 +1,50 @@
 import asyncio
 import traceback
+import html
 import io
-import base64
 import sys
 import logging
 import os
 import signal
 import random
+import time
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 from aiogram.filters.command import Command, CommandStart
 from aiogram.types import Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from func.interactions import *
 from func.db_queries import *
 from func.interactions import OllamaAPIClient
-from func.db_manager import DatabaseManager # Import DatabaseManager
+from func.db_manager import AsyncDatabaseManager
 from func.active_chats import ActiveChats
+from func.prompt_registry import PromptRegistry
+from func.history import history_keyboard, history_page_size, render_history_page
+from func.streaming import StreamingReply
+from func.image_store import ImageStore, image_gc_interval
+from func.scheduler import GenerationScheduler, MessageCoalescer
+from func.model_pulls import ModelPullManager
+from func.model_residency import ModelResidency
+from func.retention import ChatRetention, archive_files, format_size
+from func.write_behind import WriteBehind
+from func.metrics import (
+    TelegramMetricsMiddleware, active_chat_bytes, active_chat_count, chat_type_label, in_flight_generations, observe_generation,
+    queued_generations, start_metrics_server, time_to_first_token,
+)
+from func.webhook import WebhookServer, bot_mode
 
 # Disable watchdog debug logging
 logging.getLogger('watchdog').setLevel(logging.WARNING)
 
-bot = Bot(token=token)
+# A local Bot API server (or a stand-in for tests) can replace api.telegram.org
+telegram_api_url = os.getenv("TELEGRAM_API_URL")
+if telegram_api_url:
+    bot = Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_api_url)))
+else:
+    bot = Bot(token=token)
 dp = Dispatcher()
 start_kb = InlineKeyboardBuilder()
 settings_kb = InlineKeyboardBuilder()
@@ -52,6 +74,8 @@ commands = [
     types.BotCommand(command="addglobalprompt", description="Add a global prompt"),
     types.BotCommand(command="addprivateprompt", description="Add a private prompt"),
     types.BotCommand(command="temp", description="Set Temperature"),
+    types.BotCommand(command="context", description="Set context size in tokens"),
+    types.BotCommand(command="storage", description="Show database storage (admins)"),
 ]
 
 ACTIVE_CHATS = ActiveChats()
@@ -65,6 +89,7 @@ CHAT_TYPE_SUPERGROUP = "supergroup"
 timeout = os.getenv("TIMEOUT", "3000")
 global DEFAULT_TEMPERATURE
 DEFAULT_TEMPERATURE = float(os.getenv("DEFAULT_TEMPERATURE", "0.7"))
+STREAM_RESPONSES = bool(int(os.getenv("STREAM_RESPONSES", "0")))
 if log_level_str not in log_levels:
     log_level = logging.DEBUG
 else:
@@ -73,23 +98,69 @@ else:
 # Initialize Ollama API Client
 ollama_client = OllamaAPIClient(ollama_base_url, ollama_port)
 
-# Initialize Database Manager
-db_manager = DatabaseManager() # Instantiate DatabaseManager
+# Model downloads started with /pullmodel
+model_pulls = ModelPullManager(bot, ollama_client)
+model_residency = ModelResidency(ollama_client, lambda: modelname)
+
+# Limits concurrent generations and serves chats round-robin
+generation_scheduler = GenerationScheduler()
+# Answers a burst of group messages with one generation
+message_coalescer = MessageCoalescer()
+# Generations run as background tasks, so update handlers return right away and never hold up other updates
+generation_tasks = set()
+
+# Scraped from /metrics when METRICS_PORT is set
+bot.session.middleware(TelegramMetricsMiddleware())
+active_chat_count.set_function(lambda: len(ACTIVE_CHATS))
+in_flight_generations.set_function(lambda: generation_scheduler.in_flight)
+queued_generations.set_function(lambda: generation_scheduler.queue_depth)
+
+# On-disk store for chat images, messages only keep references
+image_store = ImageStore()
+
+# Initialize Database Manager (SQLite runs on its own threads, handlers await the results)
+db_manager = AsyncDatabaseManager()
+auth_cache.bind(db_manager)
+# Chat contexts are loaded on first use and evicted when idle or over the memory budget
+ACTIVE_CHATS.bind(db_manager)
+active_chat_bytes.set_function(lambda: ACTIVE_CHATS.resident_bytes)
+# System prompts by ID and by text, cleared whenever a prompt is added or deleted
+prompt_registry = PromptRegistry()
+prompt_registry.bind(db_manager)
+# Moves old chat turns into the archive databases and gives the freed space back
+chat_retention = ChatRetention(db_manager)
+# Chat log rows, chat contexts and settings are written in batches; main() drains the queue on shutdown
+write_behind = WriteBehind(db_manager, ACTIVE_CHATS, lambda: (modelname, selected_prompt_id, DEFAULT_TEMPERATURE))
+# Set by SIGINT/SIGTERM
+shutdown_event = asyncio.Event()
+# Seconds a shutdown gives running handlers and generations to finish before they are cancelled
+shutdown_handler_timeout = float(os.getenv("SHUTDOWN_HANDLER_TIMEOUT", "5"))
+# Update handlers still running, so a shutdown can let them finish before the queued changes are written
+handler_tasks = set()
+
+@dp.update.outer_middleware()
+async def track_handler_task(handler, event, data):
+    task = asyncio.current_task()
+    handler_tasks.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        handler_tasks.discard(task)
 
-def init_db():
-    db_manager.initialize_database() # Use DatabaseManager method
+async def init_db():
+    await db_manager.initialize_database()
 
-def register_user(user_id, user_name):
-    db_manager.register_user(user_id, user_name) # Use DatabaseManager method
+async def register_user(user_id, user_name):
+    await db_manager.register_user(user_id, user_name)
 
-def save_chat_message(user_id, role, content):
-    db_manager.save_chat_message(user_id, role, content) # Use DatabaseManager method
+async def save_chat_message(user_id, role, content, chat_key):
+    write_behind.log_message(user_id, role, content, chat_key)
 
 @dp.callback_query(lambda query: query.data == "register")
 async def register_callback_handler(query: types.CallbackQuery):
     user_id = query.from_user.id
     user_name = query.from_user.full_name
-    register_user(user_id, user_name)
+    await register_user(user_id, user_name)
     await query.answer("You have been registered successfully!")
 
 async def get_bot_info():
@@ -111,9 +182,13 @@ async def command_start_handler(message: Message) -> None:
 
 @dp.message(Command("reset"))
 async def command_reset_handler(message: Message) -> None:
-    if message.from_user.id in allowed_ids:
-        if await ACTIVE_CHATS.contains(message.from_user.id):
-            await ACTIVE_CHATS.pop(message.from_user.id)
+    if await auth_cache.is_allowed(message.from_user.id):
+        chat_key = get_chat_key(message)
+        if await ACTIVE_CHATS.contains(chat_key):
+            await ACTIVE_CHATS.pop(chat_key)
+            write_behind.discard_chat(chat_key)
+            # Also drop the stored messages so the history does not come back on restart
+            await delete_active_chat_context_from_db(chat_key)
             logging.info(f"Chat has been reset for {message.from_user.first_name}")
             await bot.send_message(
                 chat_id=message.chat.id,
@@ -122,17 +197,22 @@ async def command_reset_handler(message: Message) -> None:
 
 @dp.message(Command("history"))
 async def command_get_context_handler(message: Message) -> None:
-    if message.from_user.id in allowed_ids:
+    if await auth_cache.is_allowed(message.from_user.id):
+        user_id = message.from_user.id
+        # Only the turns of this chat, so a private history is never shown in a group
         chat_key = get_chat_key(message)
-        if await ACTIVE_CHATS.contains(chat_key):
-            messages = (await ACTIVE_CHATS.get(chat_key))["messages"]
-            context = ""
-            for msg in messages:
-                context += f"*{msg['role'].capitalize()}*: {msg['content']}\n"
+        rows, has_older, has_newer = await db_manager.get_chat_history(user_id, chat_key, limit=history_page_size)
+        if rows:
+            header = "<b>History</b>"
+            if await ACTIVE_CHATS.contains(chat_key):
+                used_tokens, context_budget = await ACTIVE_CHATS.context_usage(chat_key)
+                header += f"\n<b>Context</b>: ~{used_tokens}/{context_budget} tokens"
+            text, shown_rows = render_history_page(rows, header)
             await bot.send_message(
                 chat_id=message.chat.id,
-                text=context,
-                parse_mode=ParseMode.MARKDOWN,
+                text=text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=history_keyboard(user_id, shown_rows, has_older or len(shown_rows) < len(rows), has_newer),
             )
         else:
             await bot.send_message(
@@ -140,11 +220,37 @@ async def command_get_context_handler(message: Message) -> None:
                 text="No chat history available for this user",
             )
 
+@dp.callback_query(lambda query: query.data.startswith("history_"))
+async def history_page_callback_handler(query: types.CallbackQuery):
+    _, direction, user_id, row_id = query.data.split("_")
+    user_id, row_id = int(user_id), int(row_id)
+    # In groups anyone can press the buttons, but only the owner may page through the history
+    if query.from_user.id != user_id:
+        await query.answer("This is someone else's history")
+        return
+    # The buttons are on the bot's message, so the chat key is built from the chat rather than the sender
+    chat_key = f"private_{user_id}" if query.message.chat.type == "private" else f"group_{query.message.chat.id}"
+    if direction == "older":
+        page = await db_manager.get_chat_history(user_id, chat_key, before_id=row_id, limit=history_page_size)
+    else:
+        page = await db_manager.get_chat_history(user_id, chat_key, after_id=row_id, limit=history_page_size)
+    rows, has_older, has_newer = page
+    if not rows:
+        await query.answer("No more messages")
+        return
+    text, shown_rows = render_history_page(rows, "<b>History</b>")
+    await query.message.edit_text(
+        text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=history_keyboard(user_id, shown_rows, has_older or len(shown_rows) < len(rows), has_newer),
+    )
+    await query.answer()
+
 @dp.message(Command("addglobalprompt"))
 async def add_global_prompt_handler(message: Message):
     prompt_text = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else None  # Get the prompt text from the command arguments
     if prompt_text:
-        db_manager.add_system_prompt(message.from_user.id, prompt_text, True) # Use DatabaseManager method
+        await db_manager.add_system_prompt(message.from_user.id, prompt_text, True)
         await message.answer("Global prompt added successfully.")
     else:
         await message.answer("Please provide a prompt text to add.")
@@ -153,7 +259,7 @@ async def add_global_prompt_handler(message: Message):
 async def add_private_prompt_handler(message: Message):
     prompt_text = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else None  # Get the prompt text from the command arguments
     if prompt_text:
-        db_manager.add_system_prompt(message.from_user.id, prompt_text, False) # Use DatabaseManager method
+        await db_manager.add_system_prompt(message.from_user.id, prompt_text, False)
         await message.answer("Private prompt added successfully.")
     else:
         await message.answer("Please provide a prompt text to add.")
@@ -163,14 +269,66 @@ async def pull_model_handler(message: Message) -> None:
     model_name = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else None  # Get the model name from the command arguments
     logging.info(f"Downloading {model_name}")
     if model_name:
-        response = await ollama_client.manage_model("pull", model_name)
-        if response.status == 200:
-            await message.answer(f"Model '{model_name}' is being pulled.")
-        else:
-            await message.answer(f"Failed to pull model '{model_name}': {response.reason}")
+        # Runs in the background; the status message shows progress and has a Cancel button
+        await model_pulls.start(model_name, message)
     else:
         await message.answer("Please provide a model name to pull.")
 
+@dp.message(Command("storage"))
+@perms_admins
+async def storage_command_handler(message: Message) -> None:
+    if message.text.split()[1:] == ["vacuum"]:
+        # The switch rewrites the whole database file, every other write waits until it is done
+        await message.answer("Switching the database to incremental vacuum, messages are not saved until it is done...")
+        switched = await db_manager.enable_incremental_vacuum()
+        await message.answer("Done." if switched else "The database already uses incremental vacuum.")
+        return
+    db_size, free_size = await db_manager.get_database_size()
+    auto_vacuum = await db_manager.get_auto_vacuum()
+    archives = archive_files()
+    users = await db_manager.get_user_storage(limit=10)
+    archive_lines = "\n".join(f"<code>{name}: {format_size(size)}</code>" for name, size in archives) or "<code>none</code>"
+    user_lines = "\n".join(
+        f"<code>{html.escape(str(name or user_id))}: {live_rows} turns {format_size(live_bytes)}, "
+        f"archived {archived_rows} turns {format_size(archived_bytes)}</code>"
+        for user_id, name, live_rows, live_bytes, archived_rows, archived_bytes in users
+    ) or "<code>none yet</code>"
+    retention_text = f"{chat_retention.retention_days:g} days" if chat_retention.enabled else "off"
+    last_run = chat_retention.last_run
+    last_run_text = (
+        f"{last_run['at']:%Y-%m-%d %H:%M} UTC, {last_run['archived']} turns archived, {last_run['vacuumed_pages']} pages vacuumed"
+        if last_run else "not yet"
+    )
+    await message.answer(
+        f"""<b><u>Storage</u></b>
+
+<b>Database:</b> <code>{format_size(db_size)} ({format_size(free_size)} free)</code>
+<b>Vacuum:</b> <code>{"incremental" if auto_vacuum == 2 else "not incremental, switch with /storage vacuum"}</code>
+<b>Retention:</b> <code>{retention_text}</code>
+<b>Last Run:</b> <code>{last_run_text}</code>
+<b>Archives:</b>
+{archive_lines}
+<b>Largest Users:</b>
+{user_lines}""",
+        parse_mode=ParseMode.HTML,
+    )
+
+@dp.callback_query(lambda query: query.data.startswith("cancelpull_"))
+async def cancel_pull_callback_handler(query: types.CallbackQuery):
+    job_id = query.data.split("cancelpull_", 1)[1]
+    job = model_pulls.find(job_id)
+    if job is None:
+        await query.answer("This pull is no longer running")
+        return
+    # Status messages can be seen by everyone in a group, only admins and the users who asked for the pull may cancel it
+    if not auth_cache.is_admin(query.from_user.id) and not model_pulls.may_cancel(job_id, query.from_user.id):
+        await query.answer("Only admins and whoever started this pull can cancel it")
+        return
+    if model_pulls.cancel(job_id):
+        await query.answer(f"Cancelling pull of {job.model_name}")
+    else:
+        await query.answer(f"{job.model_name} is not being pulled")
+
 @dp.callback_query(lambda query: query.data == "settings")
 async def settings_callback_handler(query: types.CallbackQuery):
     await bot.send_message(
@@ -204,15 +362,21 @@ async def switchllm_callback_handler(query: types.CallbackQuery):
     await query.message.edit_text(
         f"{len(models)} models available.\n🦙 = Regular\n🦙📷 = Multimodal", reply_markup=switchllm_builder.as_markup(),
     )
-    save_global_settings_to_db()
 
 @dp.callback_query(lambda query: query.data.startswith("model_"))
 async def model_callback_handler(query: types.CallbackQuery):
     global modelname
     global modelfamily
-    modelname = query.data.split("model_")[1]
+    chosen_model = query.data.split("model_")[1]
+    # The keyboard may be older than the catalogue, so check the model is still installed
+    if await ollama_client.get_model(chosen_model) is None:
+        await query.answer(f"Model {chosen_model} is no longer available")
+        return
+    modelname = chosen_model
     await query.answer(f"Chosen model: {modelname}")
-    save_global_settings_to_db()
+    await save_global_settings_to_db()
+    # Load it now rather than inside the first user's generation
+    model_residency.schedule_warm(modelname, "switch")
 
 @dp.callback_query(lambda query: query.data == "about")
 @perms_admins
@@ -224,12 +388,9 @@ async def about_callback_handler(query: types.CallbackQuery):
 
     # Fetch the selected prompt name
     selected_prompt_name = "None"
-    if selected_prompt_id is not None:
-        prompts = db_manager.get_system_prompts(user_id=query.from_user.id, is_global=None)
-        for prompt in prompts:
-            if prompt[0] == selected_prompt_id:
-                selected_prompt_name = prompt[2]  # prompt[2] is the prompt text
-                break
+    selected_prompt = await prompt_registry.get_for_user(selected_prompt_id, query.from_user.id)
+    if selected_prompt is not None:
+        selected_prompt_name = selected_prompt[2]  # prompt[2] is the prompt text
 
     # Get the current chat key
     chat_key = get_chat_key(query.message)
@@ -237,18 +398,33 @@ async def about_callback_handler(query: types.CallbackQuery):
     # Fetch current temperature for the chat
     current_temperature = DEFAULT_TEMPERATURE  # Default value
     chat_data = await ACTIVE_CHATS.get(chat_key)
-    if chat_data:
-        current_temperature = chat_data.get("temperature", DEFAULT_TEMPERATURE)
+    if chat_data and chat_data["temperature"] is not None:
+        current_temperature = chat_data["temperature"]
+    used_tokens, context_budget = await ACTIVE_CHATS.context_usage(chat_key)
+    queue_metrics = generation_scheduler.metrics()
+    last_load = model_residency.last_load.get(modelname)
+    model_load_text = f"{last_load:.1f}s (last preload)" if last_load is not None else "not preloaded"
+    backend_lines = "\n".join(
+        f"<code>{backend['backend']}: {'up' if backend['healthy'] else 'down'}, {backend['in_flight']} running, "
+        f"{backend['errors']} errors, loaded: {', '.join(backend['loaded_models']) or 'none'}</code>"
+        for backend in ollama_client.backend_stats()
+    )
 
     await bot.send_message(
         chat_id=query.message.chat.id,
         text=f"""<b><u>Bot Info</u></b>
 
 <b>Current Model:</b> <code>{modelname}</code>
+<b>Model Load Time:</b> <code>{model_load_text}</code>
 <b>Default Model (.env):</b> <code>{dotenv_model}</code>
 
 <b>Selected Prompt:</b> <code>{selected_prompt_name}</code>
 <b>Current Temperature:</b> <code>{current_temperature}</code>
+<b>Context Usage:</b> <code>~{used_tokens}/{context_budget} tokens</code>
+<b>Generation Queue:</b> <code>{queue_metrics['in_flight']}/{generation_scheduler.max_concurrency} running, {queue_metrics['queue_depth']} waiting, avg wait {queue_metrics['average_wait']:.1f}s</code>
+<b>Coalesced Group Messages:</b> <code>{message_coalescer.stats['saved_generations']} generations saved</code>
+<b>Ollama Backends:</b>
+{backend_lines}
 
 This project is under <a href='https://github.com/ruecat/ollama-telegram/blob/main/LICENSE'>MIT License.</a>
 <a href='https://github.com/ruecat/ollama-telegram'>Source Code</a>""",
@@ -259,7 +435,7 @@ This project is under <a href='https://github.com/ruecat/ollama-telegram/blob/ma
 @dp.callback_query(lambda query: query.data == "list_users")
 @perms_admins
 async def list_users_callback_handler(query: types.CallbackQuery):
-    users = db_manager.get_all_users() # Use DatabaseManager method
+    users = await db_manager.get_all_users()
     user_kb = InlineKeyboardBuilder()
     for user_id, user_name in users:
         user_kb.row(types.InlineKeyboardButton(text=f"{user_name} ({user_id})", callback_data=f"remove_{user_id}"))
@@ -270,7 +446,7 @@ async def list_users_callback_handler(query: types.CallbackQuery):
 @perms_admins
 async def remove_user_from_list_handler(query: types.CallbackQuery):
     user_id = int(query.data.split("_")[1])
-    if db_manager.remove_user(user_id): # Use DatabaseManager method
+    if await db_manager.remove_user(user_id):
         await query.answer(f"User {user_id} has been removed.")
         await query.message.edit_text(f"User {user_id} has been removed.")
     else:
@@ -283,7 +459,7 @@ async def cancel_remove_handler(query: types.CallbackQuery):
 
 @dp.callback_query(lambda query: query.data == "select_prompt")
 async def select_prompt_callback_handler(query: types.CallbackQuery):
-    prompts = db_manager.get_system_prompts(user_id=query.from_user.id) # Use DatabaseManager method
+    prompts = await db_manager.get_system_prompts(user_id=query.from_user.id)
     prompt_kb = InlineKeyboardBuilder()
     for prompt in prompts:
         prompt_id, _, prompt_text, _, _ = prompt
@@ -295,38 +471,28 @@ async def select_prompt_callback_handler(query: types.CallbackQuery):
     await query.message.edit_text(
         f"{len(prompts)} system prompts available.", reply_markup=prompt_kb.as_markup()
     )
-    save_global_settings_to_db()
-
-    all_chats = await ACTIVE_CHATS.get_all()
-    for chat_key in all_chats:
-        await ACTIVE_CHATS.update_selected_prompt_id(chat_key, selected_prompt_id)
 
 @dp.callback_query(lambda query: query.data.startswith("prompt_"))
 async def prompt_callback_handler(query: types.CallbackQuery):
     global selected_prompt_id
     prompt_id = int(query.data.split("prompt_")[1])
     selected_prompt_id = prompt_id
-    save_global_settings_to_db()
+    await save_global_settings_to_db()
 
-    # Fetch the selected prompt text from the database
-    prompts = db_manager.get_system_prompts(user_id=query.from_user.id)
-    selected_prompt_name = "Unknown Prompt"  # Default value if prompt not found
-    for prompt in prompts:
-        if prompt[0] == prompt_id:
-            selected_prompt_name = prompt[2]  # prompt[2] is the prompt text
-            break
+    # Fetch the selected prompt text
+    selected_prompt = await prompt_registry.get_for_user(prompt_id, query.from_user.id)
+    selected_prompt_name = selected_prompt[2] if selected_prompt else "Unknown Prompt"  # prompt[2] is the prompt text
 
     # Truncate the prompt name for the answer.  Keep it short!
     truncated_prompt_name = (selected_prompt_name[:50] + '...') if len(selected_prompt_name) > 50 else selected_prompt_name
     await query.answer(f"Prompt '{truncated_prompt_name}' selected!", show_alert=True)
 
-    all_chats = await ACTIVE_CHATS.get_all()
-    for chat_key in all_chats:
-        await ACTIVE_CHATS.update_selected_prompt_id(chat_key, selected_prompt_id)
+    for chat_key in await ACTIVE_CHATS.update_all(selected_prompt_id=selected_prompt_id):
+        await save_active_chat_context_to_db(chat_key)
 
 @dp.callback_query(lambda query: query.data == "delete_prompt")
 async def delete_prompt_callback_handler(query: types.CallbackQuery):
-    prompts = db_manager.get_system_prompts(user_id=query.from_user.id) # Use DatabaseManager method
+    prompts = await db_manager.get_system_prompts(user_id=query.from_user.id)
     delete_prompt_kb = InlineKeyboardBuilder()
     for prompt in prompts:
         prompt_id, _, prompt_text, _, _ = prompt
@@ -342,7 +508,7 @@ async def delete_prompt_callback_handler(query: types.CallbackQuery):
 @dp.callback_query(lambda query: query.data.startswith("delete_prompt_"))
 async def delete_prompt_confirm_handler(query: types.CallbackQuery):
     prompt_id = int(query.data.split("delete_prompt_")[1])
-    db_manager.delete_system_prompt(prompt_id) # Use DatabaseManager method
+    await db_manager.delete_system_prompt(prompt_id)
     await query.answer(f"Deleted prompt ID: {prompt_id}")
 
 @dp.callback_query(lambda query: query.data == "delete_model")
@@ -382,6 +548,21 @@ async def set_temperature_command(message: types.Message):
     except (ValueError, IndexError):
         await message.answer("Usage: /temp [temperature value between 0.0 and 1.0]")
 
+@dp.message(Command("context"))
+async def set_context_budget_command(message: types.Message):
+    chat_key = get_chat_key(message)
+    try:
+        budget = int(message.text.split(maxsplit=1)[1])
+        if budget >= 0:
+            await ACTIVE_CHATS.update_context_budget(chat_key, budget)
+            used_tokens, _ = await ACTIVE_CHATS.trim_context(chat_key)
+            await message.answer(f"Context budget set to {budget} tokens for this chat (~{used_tokens} in use). 0 disables trimming.")
+        else:
+            await message.answer("Context budget must be 0 or a positive number of tokens.")
+    except (ValueError, IndexError):
+        used_tokens, context_budget = await ACTIVE_CHATS.context_usage(chat_key)
+        await message.answer(f"Context: ~{used_tokens}/{context_budget} tokens.\nUsage: /context [token budget, 0 for unlimited]")
+
 @dp.message()
 @perms_allowed
 async def handle_message(message: types.Message):
@@ -440,12 +621,17 @@ def format_thread_for_prompt(thread):
     return prompt
 
 async def process_image(message):
-    image_base64 = ""
+    """Store the largest photo of the message and return its image store reference ("" without a photo)."""
+    image_ref = ""
     if message.content_type == "photo":
-        image_buffer = io.BytesIO()
-        await bot.download(message.photo[-1], destination=image_buffer)
-        image_base64 = base64.b64encode(image_buffer.getvalue()).decode("utf-8")
-    return image_base64
+        photo = message.photo[-1]
+        # Forwarded photos keep their file_unique_id, so they are not downloaded again
+        image_ref = await image_store.find(photo.file_unique_id)
+        if image_ref is None:
+            image_buffer = io.BytesIO()
+            await bot.download(photo, destination=image_buffer)
+            image_ref = await image_store.put(image_buffer.getvalue(), photo.file_unique_id)
+    return image_ref
 
 def get_chat_key(message: types.Message) -> str:
     """Generate a unique key for each chat context"""
@@ -454,48 +640,42 @@ def get_chat_key(message: types.Message) -> str:
     else:
         return f"group_{message.chat.id}"  # Only use group ID for group chats
 
-async def add_prompt_to_active_chats(message, prompt, image_base64, modelname, system_prompt=None):
+def format_user_turn(message, prompt):
+    """Prefix the prompt with the sender's name in groups, where several people talk to the bot."""
+    user_identifier = (
+        message.from_user.first_name if message.chat.type != "private" else ""
+    )
+    return f"{user_identifier + ': ' if user_identifier else ''}{prompt}"
+
+async def add_prompt_to_active_chats(message, prompt, image_refs, modelname, system_prompt=None, burst=()):
     chat_key = get_chat_key(message)
     await ACTIVE_CHATS.initialize_chat(chat_key, modelname, DEFAULT_TEMPERATURE, selected_prompt_id)
 
-    # 2. Prepare the messages list:  Append to existing messages, don't overwrite
-    messages = (await ACTIVE_CHATS.get(chat_key))["messages"]
-
-    # 3. Add system prompt if provided and not already present
+    # 1. Add system prompt if provided and not already present
     if system_prompt:
-        # Check if a system prompt already exists.  Only add if it doesn't.
-        existing_system_messages = [
-            msg for msg in messages if msg.get("role") == "system"
-        ]
-        if not existing_system_messages:
-            messages.append({"role": "system", "content": system_prompt})
-
-    # 4. Add the new user message
-    user_identifier = (
-        message.from_user.first_name if message.chat.type != "private" else ""
-    )
-    content_with_user = (
-        f"{user_identifier + ': ' if user_identifier else ''}{prompt}"
-    )
-    messages.append(
-        {
-            "role": "user",
-            "content": content_with_user,
-            "images": [image_base64] if image_base64 else [],
-        }
+        await ACTIVE_CHATS.add_system_prompt(chat_key, system_prompt)
+
+    # 2. Add the new user message (earlier messages of a coalesced group burst share the same turn)
+    content_with_user = "\n".join(
+        format_user_turn(burst_message, burst_prompt) for burst_message, burst_prompt in [*burst, (message, prompt)]
     )
+    await ACTIVE_CHATS.update_message(chat_key, "user", content_with_user, images=image_refs)
 
-    # 5. Update the ACTIVE_CHATS dictionary *after* modifying the messages list
+    # 3. Update the model used by the chat
     await ACTIVE_CHATS.update_model(chat_key, modelname)
 
-    # 6.  *Don't* re-initialize temperature here.  It's already handled.
+    # Keep the history within the chat's token budget (system prompt and this message are always kept)
+    used_tokens, context_budget = await ACTIVE_CHATS.trim_context(chat_key)
+    logging.debug(f"[Context] {chat_key}: ~{used_tokens}/{context_budget} tokens")
 
-    # 7. Save to DB *after* all changes
-    chat_data = await ACTIVE_CHATS.get(chat_key)
-    save_active_chat_context_to_db(chat_key, chat_data)
+    # 4.  *Don't* re-initialize temperature here.  It's already handled.
 
-def save_active_chat_context_to_db(chat_key, chat_context):
-    db_manager.save_active_chat_context(chat_key, chat_context) # Use DatabaseManager method
+    # 5. Save to DB *after* all changes
+    await save_active_chat_context_to_db(chat_key)
+
+async def save_active_chat_context_to_db(chat_key):
+    """Queue the chat for the next write-behind batch, which stores its state at that time."""
+    write_behind.mark_chat(chat_key)
 
 async def send_response(message, text):
     for page_text in text:
@@ -506,7 +686,7 @@ async def send_response(message, text):
             reply_to_message_id=message.message_id
         )
 
-async def handle_response(message, response_data, full_response):
+async def handle_response(message, response_data, full_response, stream_reply=None):
     chat_key = get_chat_key(message)
     full_response_stripped = full_response.strip()
     if full_response_stripped == "":
@@ -517,53 +697,94 @@ async def handle_response(message, response_data, full_response):
         if (message.chat.id > 0):
             formatted_response = [f"{page}\n\n⚙️ {modelname}\nGenerated in {response_data.get('total_duration') / 1e9:.2f}s." for page in formatted_response]
         text = formatted_response
-        await send_response(message, text)
+        if stream_reply is not None:
+            await stream_reply.finish(text)
+        else:
+            await send_response(message, text)
         await ACTIVE_CHATS.update_message(chat_key, "assistant", full_response_stripped)
 
         logging.info(
             f"[Response]: '{full_response_stripped}' for {message.from_user.first_name} {message.from_user.last_name}"
         )
-        chat_data = await ACTIVE_CHATS.get(chat_key)
-        save_active_chat_context_to_db(chat_key, chat_data)
-        if response_data.get('total_duration') and response_data.get('total_tokens'):
-            duration_sec = response_data.get('total_duration') / 1e9
-            tokens_per_sec = response_data.get('total_tokens') / duration_sec if duration_sec > 0 else 0
-            logging.info(f"[Token Usage] Model: {modelname}, Duration: {duration_sec:.2f}s, Tokens: {response_data.get('total_tokens')}, Throughput: {tokens_per_sec:.2f} tokens/sec")
+        await save_active_chat_context_to_db(chat_key)
+        observe_generation(response_data, modelname, message.chat.type)
+        if response_data.get('total_duration') and response_data.get('eval_count') and response_data.get('eval_duration'):
+            load_sec = (response_data.get('load_duration') or 0) / 1e9
+            duration_sec = response_data.get('total_duration') / 1e9 - load_sec
+            tokens_per_sec = response_data.get('eval_count') / (response_data.get('eval_duration') / 1e9)
+            logging.info(f"[Token Usage] Model: {modelname}, Duration: {duration_sec:.2f}s, Model load: {load_sec:.2f}s, Prompt tokens: {response_data.get('prompt_eval_count')}, Tokens: {response_data.get('eval_count')}, Throughput: {tokens_per_sec:.2f} tokens/sec")
         return True
     return False
 
 async def ollama_request(message: types.Message, prompt: str = None):
+    """
+    Queue a generation for the chat; each chat gets at most one at a time.
+    In groups, messages that arrive while a generation is waiting are folded into it.
+    """
+    chat_key = get_chat_key(message)
+
+    async def notify_queue_position(position):
+        await message.reply(f"⏳ Queued, position {position}. I'll answer as soon as it's your turn.")
+
+    async def schedule(take_burst):
+        async def job():
+            # The burst is closed when the generation starts; later messages open the next one
+            *burst, (last_message, last_prompt) = take_burst()
+            await generate_reply(last_message, last_prompt, burst)
+
+        await generation_scheduler.submit(chat_key, job, on_queued=notify_queue_position)
+
+    if chat_key.startswith("group_"):
+        start_generation(message_coalescer.add(chat_key, (message, prompt), schedule))
+    else:
+        start_generation(schedule(lambda: [(message, prompt)]))
+
+def start_generation(coroutine):
+    # Tasks start in creation order, so a chat's messages still reach the coalescer and the scheduler in order
+    task = asyncio.create_task(coroutine)
+    generation_tasks.add(task)
+    task.add_done_callback(generation_done)
+
+def generation_done(task):
+    generation_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Generation failed: {task.exception()}", exc_info=task.exception())
+
+async def generate_reply(message: types.Message, prompt: str = None, burst=()):
+    """Answer the message; burst holds earlier (message, prompt) pairs of the same group burst."""
     user_full_name = f"{message.from_user.first_name} {message.from_user.last_name}"
     user_id = message.from_user.id
     chat_key = get_chat_key(message)
+    started_at = time.monotonic()
     try:
         full_response = ""
         await bot.send_chat_action(message.chat.id, "typing") # Start typing here
-        image_base64 = await process_image(message)
-        
-        # Determine the prompt
+
+        # Determine the prompts and store the images of every message of the turn
+        burst = [(burst_message, burst_prompt or burst_message.text or burst_message.caption) for burst_message, burst_prompt in burst]
         if prompt is None:
             prompt = message.text or message.caption
+        image_refs = []
+        for turn_message, _ in [*burst, (message, prompt)]:
+            image_ref = await process_image(turn_message)
+            if image_ref:
+                image_refs.append(image_ref)
 
         # Retrieve and prepare system prompt if selected
         system_prompt = None
         if selected_prompt_id is not None:
-            system_prompts = db_manager.get_system_prompts(user_id=message.from_user.id, is_global=None)
-            if system_prompts:
-                # Find the specific prompt by ID
-                for sp in system_prompts:
-                    if sp[0] == selected_prompt_id:
-                        system_prompt = sp[2]
-                        break
-                
-                if system_prompt is None:
-                    logging.warning(f"Selected prompt ID {selected_prompt_id} not found for user {message.from_user.id}")
-
-        # Save the user's message
-        save_chat_message(message.from_user.id, "user", prompt)
+            selected_prompt = await prompt_registry.get_for_user(selected_prompt_id, message.from_user.id)
+            if selected_prompt is not None:
+                system_prompt = selected_prompt[2]
+            else:
+                logging.warning(f"Selected prompt ID {selected_prompt_id} not found for user {message.from_user.id}")
+
+        # Save the user's messages
+        for turn_message, turn_prompt in [*burst, (message, prompt)]:
+            await save_chat_message(turn_message.from_user.id, "user", turn_prompt, chat_key)
 
         # Prepare the active chat with the system prompt
-        await add_prompt_to_active_chats(message, prompt, image_base64, modelname, system_prompt)
+        await add_prompt_to_active_chats(message, prompt, image_refs, modelname, system_prompt, burst)
         
         logging.info(
             f"[OllamaAPI]: Processing '{prompt}' for {user_full_name}"
@@ -573,18 +794,31 @@ async def ollama_request(message: types.Message, prompt: str = None):
         payload = await ACTIVE_CHATS.get(chat_key)
         payload["selected_prompt_id"] = selected_prompt_id
         temperature = payload.get("temperature")
+        # Images are kept as references and only encoded for the request
+        payload = {**payload, "messages": await image_store.resolve_messages(payload["messages"])}
         
+        stream_reply = None
+        if STREAM_RESPONSES:
+            stream_reply = StreamingReply(bot, message, started_at, hide_thinking=message.chat.id < 0)
+
         # Generate response
         async for response_data in ollama_client.generate(payload, modelname, prompt, temperature=temperature):
             msg = response_data.get("message")
             if msg is None:
                 continue
             chunk = msg.get("content", "")
+            if chunk and not full_response:
+                time_to_first_token.observe(
+                    time.monotonic() - started_at, model=modelname, chat_type=chat_type_label(message.chat.type)
+                )
             full_response += chunk
 
+            if stream_reply is not None and not response_data.get("done"):
+                await stream_reply.update(full_response)
+
             if any([c in chunk for c in ".\n!?"]) or response_data.get("done"):
-                if await handle_response(message, response_data, full_response):
-                    save_chat_message(message.from_user.id, "assistant", full_response)
+                if await handle_response(message, response_data, full_response, stream_reply):
+                    await save_chat_message(message.from_user.id, "assistant", full_response, chat_key)
                     break
 
     except Exception as e:
@@ -597,23 +831,46 @@ async def ollama_request(message: types.Message, prompt: str = None):
     finally:
         await bot.send_chat_action(message.chat.id, "cancel") # Stop typing in finally block
 
-def save_context_to_db(chat_key):
-    """Save the active chat to DB"""
-    print(f"\nSaving context for {chat_key} to database...")
-    db_manager.save_active_chat_context(chat_key, ACTIVE_CHATS.get(chat_key, {})) # Use DatabaseManager method
-    print(f"Context for {chat_key} saved successfully!")
-
-def signal_handler(sig, frame):
-    """Handle Ctrl+C by saving context before exit"""
-    print("\nCtrl+C detected!")
-    save_global_settings_to_db()
-    asyncio.run(asyncio.coroutine(save_active_chats_to_db)())
-    sys.exit(0)
-
-def load_global_settings_from_db():
+def signal_handler(sig):
+    """Handle Ctrl+C and SIGTERM by stopping the bot; main() saves the queued changes before exit"""
+    if shutdown_event.is_set():
+        print(f"\n{signal.Signals(sig).name} received, still saving queued changes...")
+        return
+    print(f"\n{signal.Signals(sig).name} received, shutting down...")
+    shutdown_event.set()
+
+async def poll_until_shutdown():
+    """Poll for updates until shutdown_event is set. A signal may arrive before polling has started."""
+    polling = asyncio.create_task(dp.start_polling(bot, skip_update=True, handle_signals=False))
+    stopping = asyncio.create_task(shutdown_event.wait())
+    await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    stopping.cancel()
+    if not polling.done():
+        try:
+            await dp.stop_polling()
+        except RuntimeError:
+            # Polling has not started yet
+            polling.cancel()
+    await asyncio.gather(polling, return_exceptions=True)
+    if not polling.cancelled() and polling.exception() is not None:
+        raise polling.exception()
+
+async def finish_running_tasks(timeout=shutdown_handler_timeout):
+    """Give running handlers and generations timeout seconds to finish, then cancel the rest."""
+    tasks = (handler_tasks | generation_tasks) - {asyncio.current_task()}
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        logging.warning(f"{len(pending)} handlers and generations still running after {timeout}s, cancelling them")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def load_global_settings_from_db():
     global modelname
     global selected_prompt_id
-    modelname, selected_prompt_id = db_manager.load_global_settings() # Use DatabaseManager method
+    modelname, selected_prompt_id = await db_manager.load_global_settings()
 
     # Load SYSTEM_PROMPT from env
     env_system_prompt = os.getenv("SYSTEM_PROMPT")
@@ -622,8 +879,7 @@ def load_global_settings_from_db():
     if env_system_prompt and selected_prompt_id is None:
         print("Condition 'env_system_prompt and selected_prompt_id is None' is TRUE - Checking for existing prompt...")
         # Check if a system prompt with this text already exists
-        prompts = db_manager.get_system_prompts() # Get prompts again to find the new one
-        existing_prompt = next((p for p in prompts if p[2] == env_system_prompt), None) # Find prompt by text
+        existing_prompt = await prompt_registry.find_by_text(env_system_prompt)
 
         if existing_prompt:
             selected_prompt_id = existing_prompt[0]
@@ -631,12 +887,9 @@ def load_global_settings_from_db():
         else:
             print("No existing system prompt found, creating a new one...")
             # Create a new system prompt
-            db_manager.add_system_prompt(None, env_system_prompt, True) # Use DatabaseManager method, user_id=None for global
-            # Retrieve the last inserted row ID which should be the new prompt's ID
-            prompts_after_insert = db_manager.get_system_prompts() # Get prompts again to find the new one
-            new_prompt = next((p for p in prompts_after_insert if p[2] == env_system_prompt), None) # Find the new prompt
-            if new_prompt:
-                selected_prompt_id = new_prompt[0]
+            new_prompt_id = await db_manager.add_system_prompt(None, env_system_prompt, True) # user_id=None for global
+            if new_prompt_id is not None:
+                selected_prompt_id = new_prompt_id
                 print(f"Created new system prompt from .env with ID: {selected_prompt_id}")
             else:
                 print("Failed to retrieve new system prompt ID after insertion.")
@@ -646,39 +899,84 @@ def load_global_settings_from_db():
 
     print(f"Global settings loaded from database: modelname={modelname}, selected_prompt_id={selected_prompt_id}")
 
-def save_global_settings_to_db():
-    global modelname
-    global selected_prompt_id
-    global DEFAULT_TEMPERATURE
-    db_manager.save_global_settings(modelname, selected_prompt_id, DEFAULT_TEMPERATURE) # Use DatabaseManager method
-
-async def load_active_chats_from_db():  # Make the function async
-    global ACTIVE_CHATS
-    loaded_chats = await db_manager.load_active_chats() # Use DatabaseManager method and await
-    await ACTIVE_CHATS.set_all(loaded_chats)  # Await the set_all call
-
-async def save_active_chats_to_db():
-    all_chats = await ACTIVE_CHATS.get_all() # get all chats
-    await db_manager.save_active_chats(all_chats) # Use DatabaseManager method and await
-
-def delete_active_chat_context_from_db(chat_key):
-    db_manager.delete_active_chat_context(chat_key) # Use DatabaseManager method
+async def save_global_settings_to_db():
+    # The current values are read when the batch is written
+    write_behind.mark_settings()
+
+async def delete_active_chat_context_from_db(chat_key):
+    await db_manager.delete_active_chat_context(chat_key)
+
+async def image_gc_loop():
+    """Periodically remove image blobs that no active chat refers to any more."""
+    while True:
+        try:
+            # Chats in memory or being evicted may hold images not saved yet, evicted chats only have their stored
+            # references. Memory is read first, so a chat that leaves it in between has already been counted
+            chats = await ACTIVE_CHATS.get_all(include_evicting=True)
+            stored_refs = await db_manager.get_active_chat_image_refs()
+            await image_store.collect_garbage(chats, extra_refs=stored_refs)
+        except Exception as e:
+            logging.error(f"[ImageStore] Garbage collection failed: {e}")
+        await asyncio.sleep(image_gc_interval)
+
+async def chat_eviction_loop():
+    """Drop chat contexts that have been idle for CHAT_IDLE_EVICTION seconds from memory."""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await ACTIVE_CHATS.evict_idle()
+        except Exception as e:
+            logging.error(f"[ActiveChats] Idle eviction failed: {e}")
 
 async def main():
-    # Register signal handler for Ctrl+C
-    signal.signal(signal.SIGINT, signal_handler)
+    # Register signal handlers for Ctrl+C and SIGTERM (docker stop)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, signal_handler, sig)
     
-    init_db()
-    load_global_settings_from_db()
-    await load_active_chats_from_db()  # Await the loading
-    allowed_ids = db_manager.load_allowed_user_ids() # Use DatabaseManager method
-    print(f"allowed_ids: {allowed_ids}")
+    await init_db()
+    await load_global_settings_from_db()
+    await auth_cache.load()
+    await ollama_client.start()
+    model_residency.start()
+    metrics_runner = await start_metrics_server()
     await bot.set_my_commands(commands)
+    image_gc_task = asyncio.create_task(image_gc_loop())
+    chat_eviction_task = asyncio.create_task(chat_eviction_loop())
+    chat_retention.start()
+    write_behind.start()
+    webhook_server = None
     try:
-        await dp.start_polling(bot, skip_update=True)
+        if shutdown_event.is_set():
+            pass  # Stopped while starting up
+        elif bot_mode == "webhook":
+            webhook_server = WebhookServer(bot, dp)
+            await webhook_server.start()
+            await shutdown_event.wait()  # Serve until the process is stopped
+        else:
+            # getUpdates is refused while a webhook is set, e.g. after a run with BOT_MODE=webhook
+            await bot.delete_webhook()
+            await poll_until_shutdown()
     except Exception as e:
         logging.error(f"Error during polling: {e}", exc_info=True)
         print(f"Bot polling stopped due to error: {e}")
+    finally:
+        # Intake is stopped first, then the work already started finishes, and only then are the changes written
+        if webhook_server is not None:
+            await webhook_server.stop()
+        await finish_running_tasks()
+        image_gc_task.cancel()
+        chat_eviction_task.cancel()
+        chat_retention.stop()
+        model_residency.stop()
+        await write_behind.drain()
+        await ACTIVE_CHATS.wait_evictions()
+        await ollama_client.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        # Polling closes it too, but not when the bot was stopped before polling started or runs a webhook
+        await bot.session.close()
+        db_manager.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,44 @@
+"""
+Golden outputs of convert_markdown_for_telegram.
+
+markdown_golden.json holds replies with the output of the previous regex converter ("cases") and the few inputs
+where the single-pass renderer deliberately differs from it ("changed", with the previous output for reference).
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+from func.telegram_markdown import TelegramMarkdownRenderer, convert_markdown_for_telegram, paginate_for_telegram
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "markdown_golden.json"), encoding="utf-8") as f:
+    GOLDEN = json.load(f)
+
+ALL_CASES = GOLDEN["cases"] + GOLDEN["changed"]
+
+def _ids(cases):
+    return [case["name"] for case in cases]
+
+@pytest.mark.parametrize("case", GOLDEN["cases"], ids=_ids(GOLDEN["cases"]))
+def test_matches_previous_converter(case):
+    assert convert_markdown_for_telegram(case["input"], case["is_group"]) == case["output"]
+
+@pytest.mark.parametrize("case", GOLDEN["changed"], ids=_ids(GOLDEN["changed"]))
+def test_documented_changes(case):
+    output = convert_markdown_for_telegram(case["input"], case["is_group"])
+    assert output == case["output"]
+    assert output != case["previous_output"]
+
+@pytest.mark.parametrize("case", ALL_CASES, ids=_ids(ALL_CASES))
+def test_incremental_rendering_matches(case):
+    # Streamed replies are fed a few characters at a time and rendered after every chunk
+    renderer = TelegramMarkdownRenderer(case["is_group"])
+    text = case["input"]
+    for start in range(0, len(text), 7):
+        renderer.feed(text[start:start + 7])
+        renderer.render()
+    assert paginate_for_telegram(renderer.render(final=True)) == case["output"]